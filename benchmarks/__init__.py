@@ -0,0 +1,5 @@
+"""
+Benchmarks for the catalog builders and the web app against a synthetic DATA_ROOT.
+
+See benchmarks/run.py.
+"""
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the private ERDDAP, serving tabledap/<dataset>.ncCFMA files
+rendered from synthetic profiles, so replication can be exercised and load tested
+without a live ERDDAP.
+
+Responses behave like ERDDAP's where replication depends on them: a time>
+constraint returns only newer profiles, a query without matching rows is a 404,
+and each response carries an ETag and Last-Modified that change only when the
+dataset grows. It also answers If-None-Match/If-Modified-Since with a 304 and
+Range/If-Range requests with a 206. ETags can be turned off, latency and
+bandwidth throttled, and every request is counted.
+
+Standalone, serving every deployment under a private ERDDAP data root:
+    python -m benchmarks.erddap_standin /data/data/priv_erddap --port 8080 --profiles 500
+"""
+import os
+import time
+import urllib
+import hashlib
+import calendar
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from datetime import datetime
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+from benchmarks.netcdf import write_classic_netcdf
+
+EPOCH = calendar.timegm(datetime(2014, 1, 1).utctimetuple())
+PROFILE_INTERVAL = 3 * 60 * 60
+
+class SyntheticDataset(object):
+    """
+    A deployment with a growing number of profiles, each of obs rows of variables
+    observation variables.
+    """
+    def __init__(self, dataset_id, profiles=100, obs=50, variables=4):
+        self.dataset_id = dataset_id
+        self.profiles   = profiles
+        self.obs        = obs
+        self.variables  = variables
+        self.modified   = time.time()
+
+    def grow(self, profiles=1):
+        self.profiles += profiles
+        # Last-Modified has one second resolution, so make sure it moves
+        self.modified = max(time.time(), self.modified + 1)
+
+    def profile_times(self, since=None):
+        times = [EPOCH + i * PROFILE_INTERVAL for i in range(self.profiles)]
+        if since is not None:
+            times = [t for t in times if t > since]
+        return times
+
+    @property
+    def etag(self):
+        return '"%s-%d-%d-%d"' % (hashlib.md5(self.dataset_id).hexdigest()[:8],
+                                  self.profiles, self.obs, self.variables)
+
+    def render(self, path, since=None):
+        """
+        Writes the ncCFMA file of the profiles newer than since (epoch seconds) to
+        path. Returns False if there are none.
+        """
+        times = self.profile_times(since)
+        if not times:
+            return False
+
+        first = (times[0] - EPOCH) // PROFILE_INTERVAL
+        n, m = len(times), self.obs
+        dims = ['trajectory', 'profile']
+        obs_dims = dims + ['obs']
+
+        variables = [('time', dims, times, {'units': 'seconds since 1970-01-01T00:00:00Z'}),
+                     ('latitude', dims, [30 + (first + i) * 0.01 for i in range(n)], {'units': 'degrees_north'}),
+                     ('longitude', dims, [-75 + (first + i) * 0.01 for i in range(n)], {'units': 'degrees_east'}),
+                     ('depth', obs_dims, [j * 2.0 for i in range(n) for j in range(m)], {'units': 'm'})]
+        for v in range(self.variables):
+            variables.append(('var%d' % v, obs_dims,
+                              [v + (first + i) % 7 + j * 0.1 for i in range(n) for j in range(m)], {}))
+
+        write_classic_netcdf(path,
+                             [('trajectory', 1), ('profile', n), ('obs', m)],
+                             variables,
+                             {'featureType': 'TrajectoryProfile', 'cdm_data_type': 'TrajectoryProfile',
+                              'title': self.dataset_id})
+        return True
+
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests   = 0
+            self.bytes_sent = 0
+            self.statuses   = {}
+
+    def record(self, status, sent=0):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {'requests': self.requests, 'bytes_sent': self.bytes_sent,
+                    'statuses': dict(self.statuses)}
+
+class ErddapHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _reply(self, status, headers=None, body=''):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        self.send_response(status)
+        for k, v in (headers or {}).iteritems():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        bandwidth = self.server.bandwidth
+        chunk = max(bandwidth // 10, 64 * 1024) if bandwidth else len(body) or 1
+        for i in range(0, len(body), chunk):
+            self.wfile.write(body[i:i + chunk])
+            if bandwidth:
+                time.sleep(float(chunk) / bandwidth)
+
+        self.server.stats.record(status, len(body))
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        prefix = '/erddap/tabledap/'
+        if not path.startswith(prefix) or not path.endswith('.ncCFMA'):
+            return self._reply(404, body='Not found')
+
+        dataset = self.server.datasets.get(path[len(prefix):-len('.ncCFMA')])
+        if dataset is None:
+            return self._reply(404, body='Resource not found: unknown datasetID')
+
+        since = None
+        for constraint in urllib.unquote(query).split('&'):
+            if constraint.startswith('time>'):
+                # like ERDDAP, either epoch seconds or an ISO 8601 time
+                try:
+                    since = float(constraint[5:])
+                except ValueError:
+                    since = calendar.timegm(datetime.strptime(constraint[5:], '%Y-%m-%dT%H:%M:%SZ').utctimetuple())
+
+        headers = {'Last-Modified' : formatdate(dataset.modified, usegmt=True),
+                   'Accept-Ranges' : 'bytes'}
+        if self.server.etags:
+            headers['ETag'] = dataset.etag
+
+        if self.server.etags and self.headers.get('If-None-Match'):
+            if self.headers['If-None-Match'] == dataset.etag:
+                return self._reply(304, headers)
+        elif self.headers.get('If-Modified-Since'):
+            since_header = parsedate_tz(self.headers['If-Modified-Since'])
+            if since_header and int(dataset.modified) <= mktime_tz(since_header):
+                return self._reply(304, headers)
+
+        body = self.server.render(dataset, since)
+        if body is None:
+            return self._reply(404, body='Your query produced no matching results.')
+
+        byte_range = self.headers.get('Range', '')
+        if byte_range.startswith('bytes=') and self.headers.get('If-Range') in (None, dataset.etag, headers['Last-Modified']):
+            start = int(byte_range[6:].split('-')[0] or 0)
+            if start >= len(body):
+                return self._reply(416, headers)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, len(body) - 1, len(body))
+            return self._reply(206, headers, body[start:])
+
+        return self._reply(200, headers, body)
+
+class ErddapStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves datasets (dataset id -> SyntheticDataset) on localhost:port; port 0 picks
+    a free one. Rendered files are cached until the dataset changes.
+    """
+    daemon_threads = True
+
+    def __init__(self, datasets, port=0, latency=0, bandwidth=None, etags=True, work_dir='/tmp', verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), ErddapHandler)
+        self.datasets  = datasets
+        self.etags     = etags
+        self.latency   = latency
+        self.bandwidth = bandwidth
+        self.work_dir  = work_dir
+        self.verbose   = verbose
+        self.stats     = Stats()
+        self._cache    = {}
+        self._lock     = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/erddap' % self.server_address[1]
+
+    def render(self, dataset, since):
+        key = (dataset.dataset_id, dataset.etag, since)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+
+        path = os.path.join(self.work_dir, '.standin-%s-%d.nc' % (dataset.dataset_id, threading.current_thread().ident))
+        try:
+            body = open(path, 'rb').read() if dataset.render(path, since) else None
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+        with self._lock:
+            for stale in [k for k in self._cache if k[0] == dataset.dataset_id and k[1] != dataset.etag]:
+                del self._cache[stale]
+            self._cache[key] = body
+        return body
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+def datasets_from_root(data_root, profiles, obs, variables):
+    datasets = {}
+    for user in sorted(os.listdir(data_root)):
+        user_dir = os.path.join(data_root, user)
+        if os.path.isdir(user_dir):
+            for name in sorted(os.listdir(user_dir)):
+                datasets[name] = SyntheticDataset(name, profiles, obs, variables)
+    return datasets
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_root', help='Private ERDDAP data root whose deployments are served')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--profiles', type=int, default=100, help='Profiles per dataset')
+    parser.add_argument('--obs', type=int, default=50, help='Observations per profile')
+    parser.add_argument('--variables', type=int, default=4, help='Observation variables per dataset')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every response')
+    parser.add_argument('--bandwidth', type=int, help='Bytes per second per response')
+    parser.add_argument('--no-etags', action='store_true', help='Only send Last-Modified validators')
+    args = parser.parse_args()
+
+    server = ErddapStandIn(datasets_from_root(args.data_root, args.profiles, args.obs, args.variables),
+                           args.port, args.latency, args.bandwidth, not args.no_etags, verbose=True)
+    print "Serving %d datasets at %s" % (len(server.datasets), server.url)
+    server.serve_forever()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Times the /api/deployments/search query against the scan it replaces, at
+archive scale, in a scratch MongoDB (its name must contain "bench").
+
+The deployments collection is filled with synthetic deployments carrying a
+track box, time coverage, operator, WKT estimated location and geometry as the
+web app stores them, some not yet with any files, and SEARCH_INDEXES is built.
+Then, for random searches (a box of --box-degrees, a window of --window-days,
+an operator for half of them, no box for some) it times:
+
+    indexed : the search query, with the documents MongoDB examined
+    scan    : loading every deployment and filtering in Python, which is what
+              finding the deployments in a region took before
+
+and counts searches where the two disagree, which only happens for deployments
+touching the box's edges, as the index follows great circles between the points
+placed along them.
+
+Usage:
+    python -m benchmarks.geosearch --mongo-uri mongodb://localhost/glider_bench \
+        --deployments 100000 --searches 200 --output geosearch.json
+    python -m benchmarks.geosearch ... --compare geosearch.json
+"""
+import os
+import json
+import time
+import random
+import urlparse
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+import pymongo
+from bson.objectid import ObjectId
+
+from glider_util.geo import bbox_geometry, wkt_to_geojson
+
+EPOCH = datetime(2008, 1, 1)
+
+# where synthetic gliders fly: Gulf of Mexico / US east coast, and the west coast
+REGIONS = [(-98, 18, -60, 45), (-130, 30, -117, 48)]
+
+SCAN_FIELDS = {'operator': 1, 'estimated_deploy_location': 1, 'time_coverage_start': 1,
+               'time_coverage_end': 1, 'lon_min': 1, 'lat_min': 1, 'lon_max': 1, 'lat_max': 1}
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def make_deployments(count, operators, rng):
+    """
+    Yields deployment documents shaped like the web app's.
+    """
+    for i in range(count):
+        lon_min, lat_min, lon_max, lat_max = rng.choice(REGIONS)
+        lon = rng.uniform(lon_min, lon_max - 3)
+        lat = rng.uniform(lat_min, lat_max - 3)
+        start = EPOCH + timedelta(days=rng.uniform(0, 8 * 365))
+
+        doc = {'_id'                       : ObjectId(),
+               'name'                      : u'bench_glider%07d' % i,
+               'username'                  : u'user%03d' % (i % 200),
+               'operator'                  : u'Operator %d' % rng.randrange(operators),
+               'estimated_deploy_date'     : start,
+               'estimated_deploy_location' : u'POINT (%f %f)' % (lon, lat),
+               'updated'                   : start}
+
+        # most have reported data by now
+        if rng.random() < 0.9:
+            doc.update({'time_coverage_start' : start,
+                        'time_coverage_end'   : start + timedelta(days=rng.uniform(10, 120)),
+                        'lon_min'             : lon,
+                        'lat_min'             : lat,
+                        'lon_max'             : lon + rng.uniform(0.05, 3),
+                        'lat_max'             : lat + rng.uniform(0.05, 3),
+                        'profile_count'       : rng.randint(1, 5000)})
+            doc['geometry'] = bbox_geometry(doc['lon_min'], doc['lat_min'], doc['lon_max'], doc['lat_max'])
+        else:
+            doc['geometry'] = wkt_to_geojson(doc['estimated_deploy_location'])
+
+        yield doc
+
+def make_searches(count, operators, box_degrees, window_days, rng):
+    searches = []
+    for _ in range(count):
+        bbox = None
+        if rng.random() < 0.9:
+            lon_min, lat_min, lon_max, lat_max = rng.choice(REGIONS)
+            lon = rng.uniform(lon_min, lon_max - box_degrees)
+            lat = rng.uniform(lat_min, lat_max - box_degrees)
+            bbox = [lon, lat, lon + box_degrees, lat + box_degrees]
+        start = EPOCH + timedelta(days=rng.uniform(0, 8 * 365))
+        operator = u'Operator %d' % rng.randrange(operators) if rng.random() < 0.5 else None
+        searches.append({'bbox': bbox, 'start': start, 'end': start + timedelta(days=window_days),
+                         'operator': operator})
+    return searches
+
+def scan_matches(doc, search):
+    """
+    The search done in Python over a loaded deployment, as before the index.
+    """
+    if search['operator'] and doc.get('operator') != search['operator']:
+        return False
+
+    if doc.get('time_coverage_start') is None:
+        return False
+    if doc['time_coverage_end'] < search['start'] or doc['time_coverage_start'] > search['end']:
+        return False
+
+    if search['bbox'] is not None:
+        lon_min, lat_min, lon_max, lat_max = search['bbox']
+        if doc.get('lon_min') is not None:
+            box = doc['lon_min'], doc['lat_min'], doc['lon_max'], doc['lat_max']
+        else:
+            lon, lat = wkt_to_geojson(doc['estimated_deploy_location'])['coordinates']
+            box = lon, lat, lon, lat
+        if box[2] < lon_min or box[0] > lon_max or box[3] < lat_min or box[1] > lat_max:
+            return False
+
+    return True
+
+def examined(cursor):
+    """
+    Documents MongoDB examined for the query, from explain(), if it says.
+    """
+    explain = cursor.explain()
+    if 'nscannedObjects' in explain:
+        return explain['nscannedObjects']
+    return explain.get('executionStats', {}).get('totalDocsExamined')
+
+def main(args):
+    db_name = urlparse.urlparse(args.mongo_uri).path[1:]
+    if 'bench' not in db_name:
+        raise ValueError("Refusing to load benchmark data into %s, use a database named *bench*" % db_name)
+
+    # the app reads its configuration from the environment when imported
+    scratch = tempfile.mkdtemp(prefix='glider-dac-bench-')
+    os.environ.update({'MONGO_URI'    : args.mongo_uri,
+                       'DATA_ROOT'    : scratch,
+                       'USER_DB_FILE' : os.path.join(scratch, 'users.db'),
+                       'SECRET_KEY'   : 'benchmark'})
+    from glider_dac.views.api import search_query, SEARCH_INDEXES
+
+    rng = random.Random(args.seed)
+    client = pymongo.MongoClient(args.mongo_uri)
+    collection = client[db_name].deployments
+
+    start = time.time()
+    collection.drop()
+    batch = []
+    for doc in make_deployments(args.deployments, args.operators, rng):
+        batch.append(doc)
+        if len(batch) == 1000:
+            collection.insert(batch)
+            batch = []
+    if batch:
+        collection.insert(batch)
+    load_seconds = time.time() - start
+
+    start = time.time()
+    for index in SEARCH_INDEXES:
+        collection.ensure_index(index)
+    index_seconds = time.time() - start
+    print "Loaded %d deployments in %.1fs, indexed in %.1fs" % (args.deployments, load_seconds, index_seconds)
+
+    searches = make_searches(args.searches, args.operators, args.box_degrees, args.window_days, rng)
+
+    indexed_times, scan_times, docs_examined, matches = [], [], [], []
+    mismatches = 0
+    for i, search in enumerate(searches):
+        query = search_query(**search)
+
+        start = time.time()
+        found = set(d['_id'] for d in collection.find(query, {'_id': 1}))
+        indexed_times.append(time.time() - start)
+        matches.append(len(found))
+
+        n = examined(collection.find(query, {'_id': 1}))
+        if n is not None:
+            docs_examined.append(n)
+
+        if i < args.scan_searches:
+            start = time.time()
+            scanned = set(d['_id'] for d in collection.find({}, SCAN_FIELDS) if scan_matches(d, search))
+            scan_times.append(time.time() - start)
+            if scanned != found:
+                mismatches += 1
+
+    result = {'deployments'      : args.deployments,
+              'searches'         : len(searches),
+              'matches_p50'      : percentile(matches, 50),
+              'indexed_p50'      : percentile(indexed_times, 50),
+              'indexed_p95'      : percentile(indexed_times, 95),
+              'examined_p50'     : percentile(docs_examined, 50),
+              'examined_p95'     : percentile(docs_examined, 95),
+              'scan_searches'    : len(scan_times),
+              'scan_p50'         : percentile(scan_times, 50),
+              'scan_p95'         : percentile(scan_times, 95),
+              'mismatches'       : mismatches}
+
+    def ms(value):
+        return '%.1fms' % (value * 1000) if value is not None else '-'
+
+    print "indexed: p50 %s p95 %s, %s/%s documents examined (p50/p95), %s matches (p50)" % (
+        ms(result['indexed_p50']), ms(result['indexed_p95']),
+        result['examined_p50'], result['examined_p95'], result['matches_p50'])
+    print "scan:    p50 %s p95 %s over %d searches, %d disagreed with the index" % (
+        ms(result['scan_p50']), ms(result['scan_p95']), result['scan_searches'], mismatches)
+
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)['result']
+        print "indexed p50 %s -> %s, p95 %s -> %s (%d -> %d deployments)" % (
+            ms(before['indexed_p50']), ms(result['indexed_p50']),
+            ms(before['indexed_p95']), ms(result['indexed_p95']),
+            before['deployments'], result['deployments'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'run_at' : datetime.utcnow().isoformat(),
+                       'params' : vars(args),
+                       'result' : result}, f, indent=2)
+
+    if not args.keep:
+        collection.drop()
+    client.close()
+    os.rmdir(scratch)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mongo-uri', required=True, help='Scratch MongoDB, its database name must contain "bench"')
+    parser.add_argument('--deployments', type=int, default=100000)
+    parser.add_argument('--operators', type=int, default=40)
+    parser.add_argument('--searches', type=int, default=200)
+    parser.add_argument('--scan-searches', type=int, default=10,
+                        help='Searches also timed as a full scan, which is slow at scale')
+    parser.add_argument('--box-degrees', type=float, default=5)
+    parser.add_argument('--window-days', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write machine readable results to this JSON file')
+    parser.add_argument('--compare', help='Results JSON of an earlier run to compare against')
+    parser.add_argument('--keep', action='store_true', help='Leave the deployments in the scratch database')
+
+    main(parser.parse_args())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+Measures how many concurrent requests a running web app can serve, optionally
+while other clients hold long requests open (event streams, slow uploads), which
+is what starves a small pool of sync workers.
+
+For each concurrency level, that many clients request the URLs round robin until
+--requests have been made, and throughput, latency percentiles and errors are
+recorded. Run it once against each gunicorn worker class to compare, e.g.:
+
+    gunicorn app:app -b 127.0.0.1:8000 -w 2
+    python -m benchmarks.loadtest http://127.0.0.1:8000/api/deployments \
+        --hold http://127.0.0.1:8000/events --holders 4 --label sync --output sync.json
+
+    gunicorn app:app -b 127.0.0.1:8000 -w 2 -k gevent
+    python -m benchmarks.loadtest http://127.0.0.1:8000/api/deployments \
+        --hold http://127.0.0.1:8000/events --holders 4 --label gevent --compare sync.json
+"""
+import sys
+import json
+import time
+import socket
+import urllib2
+import argparse
+import threading
+from datetime import datetime
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+class Holder(threading.Thread):
+    """
+    Keeps a request to url open, reading whatever trickles in, until stopped.
+    """
+    daemon = True
+
+    def __init__(self, url, timeout=1):
+        threading.Thread.__init__(self)
+        self.url       = url
+        self.timeout   = timeout
+        self.connected = False
+        self.stopped   = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                response = urllib2.urlopen(self.url, timeout=self.timeout)
+                self.connected = True
+                while not self.stopped.is_set():
+                    try:
+                        if not response.read(1):
+                            break
+                    except socket.timeout:
+                        # quiet stream, check whether to stop
+                        pass
+                response.close()
+            except (urllib2.URLError, socket.error, IOError):
+                time.sleep(0.1)
+            finally:
+                self.connected = False
+
+def load(urls, concurrency, requests, timeout):
+    """
+    Makes requests requests to urls from concurrency clients. Returns the results.
+    """
+    lock = threading.Lock()
+    state = {'next': 0}
+    latencies = []
+    statuses = {}
+    errors = {}
+
+    def client():
+        while True:
+            with lock:
+                i = state['next']
+                if i >= requests:
+                    return
+                state['next'] += 1
+
+            url = urls[i % len(urls)]
+            start = time.time()
+            try:
+                response = urllib2.urlopen(url, timeout=timeout)
+                response.read()
+                status = response.getcode()
+            except urllib2.HTTPError as e:
+                status = e.code
+            except (urllib2.URLError, socket.error, IOError) as e:
+                reason = getattr(e, 'reason', e)
+                with lock:
+                    key = 'timeout' if isinstance(reason, socket.timeout) else type(reason).__name__
+                    errors[key] = errors.get(key, 0) + 1
+                continue
+
+            seconds = time.time() - start
+            with lock:
+                latencies.append(seconds)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.time() - start
+
+    return {'concurrency'     : concurrency,
+            'requests'        : requests,
+            'seconds'         : seconds,
+            'completed'       : len(latencies),
+            'requests_per_sec': len(latencies) / seconds if seconds else 0,
+            'p50'             : percentile(latencies, 50),
+            'p95'             : percentile(latencies, 95),
+            'p99'             : percentile(latencies, 99),
+            'max'             : max(latencies) if latencies else None,
+            'statuses'        : statuses,
+            'errors'          : errors}
+
+def ms(value):
+    return '%8.1f' % (value * 1000) if value is not None else '       -'
+
+def main(args):
+    holders = [Holder(url) for url in (args.hold or []) for _ in range(args.holders)]
+    for h in holders:
+        h.start()
+    if holders:
+        # give the holders a chance to take their connections before measuring
+        deadline = time.time() + args.timeout
+        while time.time() < deadline and not all(h.connected for h in holders):
+            time.sleep(0.1)
+        print "%d of %d held connections open" % (sum(1 for h in holders if h.connected), len(holders))
+
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            result = load(args.urls, concurrency, args.requests, args.timeout)
+            results.append(result)
+            print "%-8s concurrency %4d: %8.1f req/s  p50 %sms  p95 %sms  max %sms  %d/%d ok  %s" % (
+                args.label or '', concurrency, result['requests_per_sec'],
+                ms(result['p50']), ms(result['p95']), ms(result['max']),
+                result['completed'], result['requests'],
+                ' '.join('%s:%d' % e for e in sorted(result['errors'].items())))
+    finally:
+        for h in holders:
+            h.stopped.set()
+        for h in holders:
+            h.join()
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        before = dict((r['concurrency'], r) for r in previous['results'])
+        for r in results:
+            b = before.get(r['concurrency'])
+            if b:
+                print "concurrency %4d vs %s: %.1f -> %.1f req/s, p95 %sms -> %sms, %d -> %d of %d ok" % (
+                    r['concurrency'], previous.get('label') or args.compare,
+                    b['requests_per_sec'], r['requests_per_sec'], ms(b['p95']).strip(), ms(r['p95']).strip(),
+                    b['completed'], r['completed'], r['requests'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'run_at'  : datetime.utcnow().isoformat(),
+                       'label'   : args.label,
+                       'params'  : vars(args),
+                       'results' : results}, f, indent=2)
+
+    return 1 if any(r['completed'] < r['requests'] for r in results) else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('urls', nargs='+', help='URLs requested round robin')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 5, 20, 50])
+    parser.add_argument('--requests', type=int, default=200, help='Requests per concurrency level')
+    parser.add_argument('--timeout', type=float, default=10, help='Seconds before a request counts as failed')
+    parser.add_argument('--hold', nargs='+', help='URLs kept open by --holders clients each while measuring')
+    parser.add_argument('--holders', type=int, default=4)
+    parser.add_argument('--label', help='Name for this run, e.g. the worker class')
+    parser.add_argument('--output', help='Write machine readable results to this JSON file')
+    parser.add_argument('--compare', help='Results JSON of an earlier run to compare against')
+
+    sys.exit(main(parser.parse_args()))
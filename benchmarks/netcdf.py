@@ -0,0 +1,94 @@
+"""
+A minimal writer for NetCDF classic (CDF-1) files, so synthetic glider profiles can
+be generated without the netCDF libraries installed.
+
+Supports fixed size dimensions, double and char variables, and text or numeric
+attributes, which is all the synthetic data needs.
+"""
+import struct
+
+NC_DIMENSION = 0x0A
+NC_VARIABLE  = 0x0B
+NC_ATTRIBUTE = 0x0C
+
+NC_CHAR   = 2
+NC_DOUBLE = 6
+
+def _pad(data):
+    return data + '\x00' * (-len(data) % 4)
+
+def _name(name):
+    return struct.pack('>i', len(name)) + _pad(name)
+
+def _attrs(attrs):
+    if not attrs:
+        return struct.pack('>ii', 0, 0)
+
+    out = struct.pack('>ii', NC_ATTRIBUTE, len(attrs))
+    for key, value in sorted(attrs.iteritems()):
+        out += _name(key)
+        if isinstance(value, basestring):
+            value = str(value)
+            out += struct.pack('>ii', NC_CHAR, len(value)) + _pad(value)
+        else:
+            values = value if isinstance(value, (list, tuple)) else [value]
+            out += struct.pack('>ii', NC_DOUBLE, len(values)) + struct.pack('>%dd' % len(values), *values)
+
+    return out
+
+def write_classic_netcdf(path, dimensions, variables, global_attrs=None):
+    """
+    Writes a NetCDF classic file.
+
+    dimensions is a list of (name, length); variables a list of
+    (name, dimension names, list of doubles, attrs dict).
+    """
+    dim_ids = dict((name, i) for i, (name, _) in enumerate(dimensions))
+    dim_len = dict(dimensions)
+
+    header = 'CDF\x01' + struct.pack('>i', 0)
+
+    if dimensions:
+        header += struct.pack('>ii', NC_DIMENSION, len(dimensions))
+        for name, length in dimensions:
+            header += _name(name) + struct.pack('>i', length)
+    else:
+        header += struct.pack('>ii', 0, 0)
+
+    header += _attrs(global_attrs)
+
+    # every variable's begin offset is a fixed width field, so the header length
+    # can be worked out before the offsets are known
+    var_headers = []
+    for name, dims, values, attrs in variables:
+        count = 1
+        for d in dims:
+            count *= dim_len[d]
+        if len(values) != count:
+            raise ValueError("%s has %d values, expected %d" % (name, len(values), count))
+
+        var_header = _name(name) + struct.pack('>i', len(dims))
+        for d in dims:
+            var_header += struct.pack('>i', dim_ids[d])
+        var_header += _attrs(attrs) + struct.pack('>ii', NC_DOUBLE, count * 8)
+        var_headers.append(var_header)
+
+    if variables:
+        var_list = struct.pack('>ii', NC_VARIABLE, len(variables))
+    else:
+        var_list = struct.pack('>ii', 0, 0)
+
+    offset = len(header) + len(var_list) + sum(len(v) + 4 for v in var_headers)
+
+    data = []
+    for var_header, (name, dims, values, attrs) in zip(var_headers, variables):
+        var_list += var_header + struct.pack('>i', offset)
+        chunk = struct.pack('>%dd' % len(values), *values)
+        data.append(chunk)
+        offset += len(chunk)
+
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(var_list)
+        for chunk in data:
+            f.write(chunk)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Measures replicatePrivateErddapDeployments.py against the local ERDDAP stand-in.
+
+Each scenario (worker count x full/incremental fetching) starts from an empty
+replica, runs an initial replication, then a number of cycles in which a fraction
+of the deployments gain new profiles and have their deployment.json touched, as
+they would between cron runs. Another fraction only has its deployment.json
+touched, like a metadata edit, which conditional requests should answer with a
+304. Wall time, requests, response statuses and bytes transferred are recorded
+per cycle.
+
+Usage:
+    python -m benchmarks.replication --users 5 --deployments 10 --profiles 200 \
+        --workers 1 4 8 --incremental --latency 0.05 --output replication.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+
+from benchmarks.erddap_standin import ErddapStandIn, SyntheticDataset
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+
+import replicatePrivateErddapDeployments as replication
+from replication_util import ReplicationState
+
+def make_tree(root, users, deployments):
+    """
+    Creates the priv_erddap/pub_erddap/thredds user/deployment directories and
+    returns the user/deployment names.
+    """
+    names = []
+    for u in range(users):
+        for d in range(deployments):
+            name = 'user%03d/user%03d_glider%03d' % (u, u, d)
+            for data_root in ('priv_erddap', 'pub_erddap', 'thredds'):
+                os.makedirs(os.path.join(root, data_root, name))
+            names.append(name)
+    return names
+
+def touch_deployment(root, name):
+    with open(os.path.join(root, 'priv_erddap', name, 'deployment.json'), 'w') as f:
+        json.dump({'updated': time.time() * 1000}, f)
+
+def run_scenario(args, workers, incremental):
+    root = tempfile.mkdtemp(prefix='glider-dac-replication-')
+    rng = random.Random(args.seed)
+
+    try:
+        names = make_tree(root, args.users, args.deployments)
+        datasets = dict((n.split('/')[-1], SyntheticDataset(n.split('/')[-1], args.profiles, args.obs, args.variables))
+                        for n in names)
+        for name in names:
+            touch_deployment(root, name)
+
+        server = ErddapStandIn(datasets, latency=args.latency, bandwidth=args.bandwidth,
+                               etags=not args.no_etags, work_dir=root)
+        server.start()
+
+        replication.SERVER       = server.url
+        replication.JSON_DIR     = os.path.join(root, 'priv_erddap') + '/'
+        replication.path2priv    = replication.JSON_DIR
+        replication.path2pub     = os.path.join(root, 'pub_erddap') + '/'
+        replication.path2thredds = os.path.join(root, 'thredds') + '/'
+        state = ReplicationState(os.path.join(root, 'replication.sqlite'))
+
+        cycles = []
+        for cycle in range(args.cycles + 1):
+            if cycle:
+                # deployment.json times have a millisecond resolution
+                time.sleep(0.01)
+                changed = rng.sample(names, max(1, int(len(names) * args.active)))
+                for name in changed:
+                    datasets[name.split('/')[-1]].grow(args.grow)
+                    touch_deployment(root, name)
+                unchanged = [n for n in names if n not in changed]
+                for name in rng.sample(unchanged, min(len(unchanged), int(len(names) * args.touched))):
+                    touch_deployment(root, name)
+
+            server.stats.reset()
+            start = time.time()
+            results = replication.replicate(names, state, workers, incremental)
+            seconds = time.time() - start
+
+            stats = server.stats.snapshot()
+            received = sum(r['bytes'] for r in results)
+            cycles.append({'cycle'         : cycle,
+                           'seconds'       : seconds,
+                           'replicated'    : sum(1 for r in results if r['status'] == 'replicated'),
+                           'failed'        : sum(1 for r in results if r['status'] == 'failed'),
+                           'requests'      : stats['requests'],
+                           'statuses'      : stats['statuses'],
+                           'bytes_sent'    : stats['bytes_sent'],
+                           'bytes_received': received,
+                           'bytes_per_sec' : received / seconds if seconds else 0})
+
+        server.shutdown()
+        server.server_close()
+    finally:
+        shutil.rmtree(root)
+
+    return {'workers': workers, 'incremental': incremental, 'cycles': cycles}
+
+def main(args):
+    modes = [False, True] if args.incremental else [False]
+    scenarios = []
+    for incremental in modes:
+        for workers in args.workers:
+            scenario = run_scenario(args, workers, incremental)
+            scenarios.append(scenario)
+
+            for c in scenario['cycles']:
+                print "workers %2d %-11s cycle %d: %7.2fs %4d requests %12d bytes %10.0f B/s %s" % (
+                    workers, 'incremental' if incremental else 'full', c['cycle'], c['seconds'],
+                    c['requests'], c['bytes_received'], c['bytes_per_sec'],
+                    ' '.join('%s:%d' % s for s in sorted(c['statuses'].items())))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'run_at'    : datetime.utcnow().isoformat(),
+                       'params'    : vars(args),
+                       'scenarios' : scenarios}, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=3)
+    parser.add_argument('--deployments', type=int, default=5, help='Deployments per user')
+    parser.add_argument('--profiles', type=int, default=100, help='Initial profiles per deployment')
+    parser.add_argument('--obs', type=int, default=50, help='Observations per profile')
+    parser.add_argument('--variables', type=int, default=4, help='Observation variables per dataset')
+    parser.add_argument('--cycles', type=int, default=3, help='Replication cycles after the initial one')
+    parser.add_argument('--active', type=float, default=0.2,
+                        help='Fraction of deployments updated between cycles')
+    parser.add_argument('--touched', type=float, default=0.1,
+                        help='Fraction of deployments whose deployment.json changes without new data')
+    parser.add_argument('--grow', type=int, default=8, help='Profiles added to an updated deployment')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--incremental', action='store_true',
+                        help='Also run every scenario with incremental fetches (needs netCDF4)')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds the stand-in adds to every response')
+    parser.add_argument('--bandwidth', type=int, help='Bytes per second per stand-in response')
+    parser.add_argument('--no-etags', action='store_true', help='Stand-in only sends Last-Modified')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write machine readable results to this JSON file')
+
+    args = parser.parse_args()
+
+    # the replication script logs every deployment
+    logging.getLogger().setLevel(logging.WARNING)
+
+    main(args)
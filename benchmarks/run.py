@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+Times the catalog builders and key web routes against a synthetic archive.
+
+Usage:
+    python -m benchmarks.run --users 10 --deployments 20 --files 100 --output results.json
+    python -m benchmarks.run ... --compare previous-results.json
+
+Catalog builds are timed cold (empty fragment cache) and warm, with deployments
+discovered from the files and from a stand-in deployments collection. With
+--mongo-uri pointing at a scratch database (its name must contain "bench"), the
+synthetic documents are loaded into it and the web routes are timed as well.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+from benchmarks.synthetic import generate, write_templates, StandInCollection
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+
+import build_catalogs
+
+def timed(fn, repeat):
+    """
+    Runs fn repeat times, returning the wall clock seconds of each run.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return times
+
+def summarize(name, times):
+    ordered = sorted(times)
+    return {'name'   : name,
+            'runs'   : times,
+            'min'    : ordered[0],
+            'median' : ordered[len(ordered) // 2],
+            'max'    : ordered[-1]}
+
+def bench_catalogs(out_dir, template_root, deployment_docs, repeat):
+    results = []
+    dap = os.path.join(out_dir, 'dap')
+    source_root = os.path.join(dap, 'priv_erddap')
+
+    results.append(summarize('discovery.files', timed(
+        lambda: build_catalogs.discover_deployments(source_root), repeat)))
+
+    collection = StandInCollection(deployment_docs)
+    results.append(summarize('discovery.collection', timed(
+        lambda: build_catalogs.discover_deployments_from_collection(collection, source_root), repeat)))
+
+    deployments = build_catalogs.discover_deployments(source_root)
+
+    outputs = [build_catalogs.ErddapOutput('priv_erddap', source_root, os.path.join(template_root, 'private')),
+               build_catalogs.ErddapOutput('pub_erddap', os.path.join(dap, 'pub_erddap'), os.path.join(template_root, 'public')),
+               build_catalogs.ThreddsOutput('thredds', os.path.join(dap, 'thredds'), os.path.join(template_root, 'thredds')),
+               build_catalogs.NcmlOutput('ncml', os.path.join(dap, 'thredds'), os.path.join(template_root, 'thredds'))]
+
+    for output in outputs:
+        catalog_root = tempfile.mkdtemp(dir=out_dir, prefix='catalog-')
+        cache_dir = tempfile.mkdtemp(dir=out_dir, prefix='cache-')
+        build_catalogs.make_all_dirs(catalog_root, output.catalog_dir)
+
+        # the first build renders everything; later ones reuse the fragment cache
+        results.append(summarize('catalog.%s.cold' % output.name, timed(
+            lambda: output.build(deployments, catalog_root, cache_dir), 1)))
+        results.append(summarize('catalog.%s.warm' % output.name, timed(
+            lambda: output.build(deployments, catalog_root, cache_dir), repeat)))
+        results.append(summarize('catalog.%s.full' % output.name, timed(
+            lambda: output.build(deployments, catalog_root, cache_dir, full=True), repeat)))
+
+    catalog_root = tempfile.mkdtemp(dir=out_dir, prefix='catalog-')
+    cache_dir = tempfile.mkdtemp(dir=out_dir, prefix='cache-')
+    results.append(summarize('catalog.all', timed(
+        lambda: build_catalogs.build_catalogs(source_root, catalog_root, outputs, cache_dir), repeat)))
+
+    return results
+
+def bench_web(out_dir, mongo_uri, user_docs, deployment_docs, repeat):
+    """
+    Loads the synthetic documents into the scratch database and times the web
+    routes through Flask's test client.
+    """
+    import urlparse
+    import pymongo
+
+    db_name = urlparse.urlparse(mongo_uri).path[1:]
+    if 'bench' not in db_name:
+        raise ValueError("Refusing to load benchmark data into %s, use a database named *bench*" % db_name)
+
+    client = pymongo.MongoClient(mongo_uri)
+    database = client[db_name]
+    for name, docs in (('users', user_docs), ('deployments', deployment_docs)):
+        database[name].drop()
+        database[name].insert(docs)
+
+    os.environ.update({'MONGO_URI'    : mongo_uri,
+                       'DATA_ROOT'    : os.path.join(out_dir, 'ftp'),
+                       'USER_DB_FILE' : os.path.join(out_dir, 'users.db'),
+                       'SECRET_KEY'   : 'benchmark'})
+
+    from glider_dac import app
+    app.config['DATA_ROOT'] = os.environ['DATA_ROOT']
+    client = app.test_client()
+
+    deployment = deployment_docs[len(deployment_docs) // 2]
+    routes = [('web.index', '/'),
+              ('web.list_user_deployments', '/users/%s/deployments' % deployment['username']),
+              ('web.show_deployment', '/users/%s/deployment/%s' % (deployment['username'], deployment['_id']))]
+
+    results = []
+    for name, url in routes:
+        def get():
+            rv = client.get(url)
+            assert rv.status_code == 200, "%s returned %s" % (url, rv.status_code)
+        results.append(summarize(name, timed(get, repeat)))
+
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SCRIPTS_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous = dict((r['name'], r) for r in json.load(f)['results'])
+
+    print "%-40s %10s %10s %8s" % ("benchmark", "before", "after", "ratio")
+    for r in results:
+        p = previous.get(r['name'])
+        if p is None:
+            continue
+        print "%-40s %9.4fs %9.4fs %7.2fx" % (r['name'], p['median'], r['median'], r['median'] / max(p['median'], 1e-9))
+
+def main(args):
+    out_dir = args.keep or tempfile.mkdtemp(prefix='glider-dac-bench-')
+    template_root = os.path.join(out_dir, 'templates')
+
+    try:
+        start = time.time()
+        user_docs, deployment_docs = generate(out_dir, args.users, args.deployments, args.files, args.obs, args.seed)
+        write_templates(template_root)
+        generate_seconds = time.time() - start
+
+        results = bench_catalogs(out_dir, template_root, deployment_docs, args.repeat)
+        if args.mongo_uri:
+            results.extend(bench_web(out_dir, args.mongo_uri, user_docs, deployment_docs, args.repeat))
+    finally:
+        if not args.keep:
+            shutil.rmtree(out_dir)
+
+    report = {'revision'         : git_revision(),
+              'run_at'           : datetime.utcnow().isoformat(),
+              'params'           : {'users': args.users, 'deployments': args.deployments,
+                                    'files': args.files, 'obs': args.obs, 'repeat': args.repeat},
+              'generate_seconds' : generate_seconds,
+              'results'          : results}
+
+    for r in results:
+        print "%-40s min %9.4fs  median %9.4fs" % (r['name'], r['min'], r['median'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--deployments', type=int, default=10, help='Deployments per user')
+    parser.add_argument('--files', type=int, default=50, help='Profile files per deployment')
+    parser.add_argument('--obs', type=int, default=20, help='Observations per profile file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--mongo-uri', help='Scratch MongoDB to time the web routes against')
+    parser.add_argument('--output', help='Write machine readable results to this JSON file')
+    parser.add_argument('--compare', help='Previous results JSON to compare against')
+    parser.add_argument('--keep', help='Generate into this directory and keep it')
+
+    args = parser.parse_args()
+
+    # the builders log every fragment
+    logging.getLogger().setLevel(logging.WARNING)
+
+    main(args)
@@ -0,0 +1,161 @@
+"""
+Generates a synthetic Glider DAC archive for benchmarking.
+
+Two trees are written under the output directory, mirroring production:
+
+    ftp/<user>/upload/<deployment>/...     the web app's DATA_ROOT
+    dap/priv_erddap/<user>/<deployment>/   the DAP side the catalogs are built from
+    dap/pub_erddap/..., dap/thredds/...    the directory-only copies (create_data_dirs)
+
+Each deployment gets deployment.json, wmoid.txt and a number of small NetCDF
+profile files, and matching user/deployment documents are produced for loading
+into MongoDB (or a stand-in collection).
+"""
+import os
+import json
+import random
+import calendar
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+from benchmarks.netcdf import write_classic_netcdf
+
+EPOCH = datetime(2014, 1, 1)
+
+def write_profile(path, rng, start, lat, lon, obs=20):
+    """
+    Writes a small trajectory profile file resembling a Glider DAC upload.
+    """
+    profile_time = calendar.timegm(start.utctimetuple())
+    times  = [profile_time + i * 10.0 for i in range(obs)]
+    lats   = [lat + rng.uniform(-0.001, 0.001) for _ in range(obs)]
+    lons   = [lon + rng.uniform(-0.001, 0.001) for _ in range(obs)]
+    depths = [i * 2.0 for i in range(obs)]
+    temps  = [rng.uniform(4, 28) for _ in range(obs)]
+
+    write_classic_netcdf(path,
+                         [('time', obs)],
+                         [('time', ['time'], times, {'units': 'seconds since 1970-01-01T00:00:00Z'}),
+                          ('lat', ['time'], lats, {'units': 'degrees_north'}),
+                          ('lon', ['time'], lons, {'units': 'degrees_east'}),
+                          ('depth', ['time'], depths, {'units': 'm'}),
+                          ('temperature', ['time'], temps, {'units': 'Celsius'}),
+                          ('profile_time', [], [profile_time], {'units': 'seconds since 1970-01-01T00:00:00Z'}),
+                          ('profile_lat', [], [lat], {'units': 'degrees_north'}),
+                          ('profile_lon', [], [lon], {'units': 'degrees_east'})],
+                         {'title': os.path.basename(path),
+                          'featureType': 'trajectoryProfile'})
+
+def generate(out_dir, users=5, deployments=10, files=50, obs=20, seed=0):
+    """
+    Writes the synthetic archive under out_dir.
+
+    Returns (user documents, deployment documents) to load into MongoDB.
+    """
+    rng = random.Random(seed)
+
+    ftp_root  = os.path.join(out_dir, 'ftp')
+    dap_roots = dict((m, os.path.join(out_dir, 'dap', m)) for m in ('priv_erddap', 'pub_erddap', 'thredds'))
+
+    user_docs = []
+    deployment_docs = []
+
+    for u in range(users):
+        username = u'user%03d' % u
+        user_id  = ObjectId()
+        user_docs.append({'_id': user_id, 'username': username, 'name': username.title(),
+                          'created': EPOCH})
+
+        for d in range(deployments):
+            name  = u'%s_glider%03d' % (username, d)
+            start = EPOCH + timedelta(days=rng.randint(0, 365))
+            lat   = rng.uniform(20, 45)
+            lon   = rng.uniform(-98, -65)
+            wmo   = u'%07d' % rng.randint(0, 9999999) if rng.random() < 0.7 else None
+
+            deployment_dir = os.path.join(ftp_root, username, 'upload', name)
+            dap_dirs = [os.path.join(root, username, name) for root in dap_roots.itervalues()]
+            for dd in [deployment_dir] + dap_dirs:
+                os.makedirs(dd)
+
+            doc = {'_id'                       : ObjectId(),
+                   'name'                      : name,
+                   'user_id'                   : user_id,
+                   'username'                  : username,
+                   'operator'                  : u'Operator %d' % (u % 3),
+                   'deployment_dir'            : unicode(deployment_dir),
+                   'estimated_deploy_date'     : start,
+                   'estimated_deploy_location' : u'POINT (%f %f)' % (lon, lat),
+                   'wmo_id'                    : wmo,
+                   'completed'                 : rng.random() < 0.5,
+                   'created'                   : start,
+                   'updated'                   : start + timedelta(days=files)}
+            deployment_docs.append(doc)
+
+            js = dict(doc, _id=str(doc['_id']), user_id=str(user_id))
+            for key in ('estimated_deploy_date', 'created', 'updated'):
+                js[key] = js[key].isoformat()
+
+            priv_dir = os.path.join(dap_roots['priv_erddap'], username, name)
+            for dd in (deployment_dir, priv_dir):
+                with open(os.path.join(dd, 'deployment.json'), 'w') as f:
+                    json.dump(js, f)
+                if wmo:
+                    with open(os.path.join(dd, 'wmoid.txt'), 'w') as f:
+                        f.write(wmo)
+
+            for i in range(files):
+                fname = '%s_%04d.nc' % (name, i)
+                path  = os.path.join(deployment_dir, fname)
+                write_profile(path, rng, start + timedelta(hours=i * 3), lat + i * 0.01, lon + i * 0.01, obs)
+                os.link(path, os.path.join(priv_dir, fname))
+
+    return user_docs, deployment_docs
+
+def write_templates(template_root):
+    """
+    Writes minimal ERDDAP/THREDDS catalog templates with the same placeholders as
+    the production ones.
+    """
+    templates = {
+        'private/datasets.head.xml'      : '<erddapDatasets>\n',
+        'private/datasets.tail.xml'      : '</erddapDatasets>\n',
+        'private/dataset.deployment.xml' : '<dataset type="EDDTableFromNcFiles" datasetID="$dataset_id">'
+                                           '<fileDir>$dataset_dir</fileDir><institution>$institution</institution></dataset>\n',
+        'public/datasets.head.xml'       : '<erddapDatasets>\n',
+        'public/datasets.tail.xml'       : '</erddapDatasets>\n',
+        'public/dataset.deployment.xml'  : '<dataset type="EDDTableFromNcCFFiles" datasetID="$dataset_id">'
+                                           '<fileDir>$dataset_dir</fileDir><institution>$institution</institution></dataset>\n',
+        'public/dataset.agg.xml'         : '<dataset type="EDDTableFromNcCFFiles" datasetID="$dataset_id">'
+                                           '<fileDir>$dataset_dir</fileDir><title>$dataset_title</title></dataset>\n',
+        'thredds/catalog.head.xml'       : '<catalog xmlns="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0" '
+                                           'xmlns:xlink="http://www.w3.org/1999/xlink">\n',
+        'thredds/catalog.tail.xml'       : '</catalog>\n',
+        'thredds/catalog.deployment.xml' : '<dataset name="$deployment" ID="$dataset_id" urlPath="$user/$deployment_file">'
+                                           '<location>$deployment_path</location></dataset>\n',
+    }
+
+    for rel_path, contents in templates.iteritems():
+        path = os.path.join(template_root, rel_path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+class StandInCollection(object):
+    """
+    An in-process stand-in for a MongoDB collection supporting the find() calls the
+    catalog source makes, for benchmarking without a mongod.
+    """
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, spec=None, fields=None):
+        for doc in self.docs:
+            if spec and any(doc.get(k) != v for k, v in spec.iteritems()):
+                continue
+            if fields:
+                yield dict((k, doc.get(k)) for k in fields if k in doc)
+            else:
+                yield doc
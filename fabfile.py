@@ -24,6 +24,9 @@ import time
         rsync_to_path = x
         dev_catalog_root = x
         prod_catalog_root = x
+        dap_priv_erddap_flag_dir = x
+        dap_pub_erddap_flag_dir = x
+        dap_reload_command = x (optional, run by the scheduler after the catalogs are built)
         mongo_db = x
         admins = x,y,z
         user_db_file = x
@@ -34,11 +37,16 @@ code_dir = "/home/glider/glider-dac"
 def deploy_dap():
     crontab_file = "/home/glider/crontab.txt"
     with settings(sudo_user='glider'):
+        stop_supervisord(conf="/home/glider/supervisord-dap.conf")
         with cd(code_dir):
             sudo("git pull origin master")
             update_libs(virtual_env="gliderdac")
             update_full_sync()
+            update_scheduler_config()
             update_crontab(src_file="deploy/glider_crontab.txt", dst_file=crontab_file)
+            update_supervisord(src_file="deploy/supervisord-dap.conf", dst_file="/home/glider/supervisord-dap.conf", virtual_env="gliderdac")
+            start_supervisord(conf="/home/glider/supervisord-dap.conf", virtual_env="gliderdac")
+            start_supervisor_processes(conf="/home/glider/supervisord-dap.conf", virtual_env="gliderdac")
 
 def deploy_ftp():
     with settings(sudo_user='glider'):
@@ -63,6 +71,11 @@ def update_full_sync():
     upload_template("scripts/full_sync.j2", "/tmp/full_sync", context=copy(env), use_jinja=True, use_sudo=False, backup=False, mirror_local_mode=True)
     sudo("cp /tmp/full_sync /home/glider/full_sync")
 
+def update_scheduler_config():
+    # @BUG: same
+    upload_template("deploy/scheduler.ini", "/tmp/scheduler.ini", context=copy(env), use_jinja=True, use_sudo=False, backup=False, mirror_local_mode=True)
+    sudo("cp /tmp/scheduler.ini /home/glider/scheduler.ini")
+
 def update_crontab(src_file, dst_file):
     # @BUG: same
     upload_template(src_file, "/tmp/glider-crontab.txt", context=copy(env), use_jinja=True, use_sudo=False, backup=False, mirror_local_mode=True)
@@ -149,4 +162,17 @@ def create_index():
     MONGODB_DATABASE = url.path[1:]
 
     run('mongo "%s" --eval "db.deployments.ensureIndex({\'name\':1}, {unique:true})"' % MONGODB_DATABASE)
+    run('mongo "%s" --eval "db.deployments.ensureIndex({\'updated\':1})"' % MONGODB_DATABASE)
+    # /api/deployments/search, see SEARCH_INDEXES in glider_dac/views/api.py
+    run('mongo "%s" --eval "db.deployments.ensureIndex({\'geometry\':\'2dsphere\', \'time_coverage_start\':1, \'time_coverage_end\':1, \'operator\':1})"' % MONGODB_DATABASE)
+    run('mongo "%s" --eval "db.deployments.ensureIndex({\'operator\':1, \'time_coverage_start\':1})"' % MONGODB_DATABASE)
+    # expires the web app's write fingerprints, see glider_util/fingerprint.py
+    run('mongo "%s" --eval "db.self_writes.ensureIndex({\'recorded\':1}, {expireAfterSeconds:86400})"' % MONGODB_DATABASE)
+    run('mongo "%s" --eval "db.mail_outbox.ensureIndex({\'status\':1, \'next_attempt\':1})"' % MONGODB_DATABASE)
+    # NetCDF header metadata, see glider_util/nc_metadata.py
+    run('mongo "%s" --eval "db.file_metadata.ensureIndex({\'deployment_id\':1, \'time_coverage_start\':1})"' % MONGODB_DATABASE)
+    run('mongo "%s" --eval "db.file_metadata.ensureIndex({\'time_coverage_start\':1, \'time_coverage_end\':1})"' % MONGODB_DATABASE)
+    run('mongo "%s" --eval "db.file_metadata.ensureIndex({\'lat_min\':1, \'lon_min\':1})"' % MONGODB_DATABASE)
+    # tailed by the web app's /events stream, see glider_util/file_events.py
+    run('mongo "%s" --eval "db.createCollection(\'file_events\', {capped:true, size:4194304})"' % MONGODB_DATABASE)
 
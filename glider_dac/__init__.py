@@ -133,6 +133,16 @@ def slugify(value):
     value = unicode(re.sub('[^\w\s-]', '', value).strip())
     return unicode(re.sub('[-\s]+', '-', value))
 
+# Collections the app needs set up once per worker rather than on every use
+@app.before_first_request
+def prepare_collections():
+    from glider_util.fingerprint import WriteFingerprints
+    from glider_util.file_events import FileEvents
+    from glider_util.nc_metadata import FileMetadata
+    WriteFingerprints(db.self_writes).ensure_index()
+    FileEvents(db.file_events).ensure_capped()
+    FileMetadata(db.file_metadata).ensure_indexes()
+
 # Import everything
 import glider_dac.views
 import glider_dac.models
@@ -16,6 +16,15 @@ ADMINS = os.environ.get("ADMINS", "").split(",")
 DATA_ROOT = os.environ.get("DATA_ROOT")
 ARCHIVE_PATH = os.environ.get("ARCHIVE_PATH")
 
+# internal nginx location serving DATA_ROOT; when set, file downloads are
+# handed to nginx with X-Accel-Redirect instead of being sent by the app
+X_ACCEL_REDIRECT = os.environ.get("X_ACCEL_REDIRECT")
+
+# live page updates (/events); each open stream holds a worker for up to
+# EVENT_STREAM_SECONDS, so only turn this on with an async gunicorn worker
+EVENT_STREAM = os.environ.get("EVENT_STREAM", "false").lower() in ("true", "1", "yes")
+EVENT_STREAM_SECONDS = int(os.environ.get("EVENT_STREAM_SECONDS", 300))
+
 # database
 MONGO_URI = os.environ.get('MONGO_URI')
 url = urlparse.urlparse(MONGO_URI)
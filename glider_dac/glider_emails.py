@@ -1,8 +1,18 @@
 import os
+import socket
+import smtplib
+from datetime import datetime, timedelta
 from flask.ext.mail import Message
 
+import pymongo
 from flask import render_template
-from glider_dac import app, mail
+from glider_dac import app, db, mail
+
+# the Message attributes kept in the outbox
+MESSAGE_FIELDS = ['subject', 'sender', 'recipients', 'cc', 'bcc', 'reply_to', 'body', 'html']
+
+# a message claimed by a sender that died is retried after this long
+CLAIM_TIMEOUT = timedelta(minutes=10)
 
 def send_wmoid_email(username, deployment):
     # sender comes from MAIL_DEFAULT_SENDER in env
@@ -15,5 +25,89 @@ def send_wmoid_email(username, deployment):
     msg            = Message(subject, recipients=recipients, cc=cc_recipients)
     msg.body       = render_template('wmoid_email.txt', deployment=deployment, username=username)
 
-    mail.send(msg)
+    queue_email(msg)
+
+def queue_email(msg):
+    """
+    Adds msg to the mail_outbox collection, from which glider_dac_mailer.py sends
+    it, so requests never wait on (or fail with) the SMTP server.
+    """
+    doc = dict((f, getattr(msg, f)) for f in MESSAGE_FIELDS)
+    now = datetime.utcnow()
+    doc.update({'status'       : 'pending',
+                'attempts'     : 0,
+                'created'      : now,
+                'next_attempt' : now})
+    return db.mail_outbox.insert(doc)
+
+def _claim(outbox, now):
+    """
+    Marks the oldest due message as being sent and returns it, or None.
+    """
+    return outbox.find_and_modify(
+        {'$or': [{'status': 'pending', 'next_attempt': {'$lte': now}},
+                 {'status': 'sending', 'claimed': {'$lt': now - CLAIM_TIMEOUT}}]},
+        {'$set': {'status': 'sending', 'claimed': now}},
+        sort=[('next_attempt', pymongo.ASCENDING)],
+        new=True)
+
+def _failed(outbox, doc, error, backoff, max_backoff, max_attempts):
+    attempts = doc.get('attempts', 0) + 1
+    delay = min(backoff * 2 ** (attempts - 1), max_backoff)
+    outbox.update({'_id': doc['_id']},
+                  {'$set': {'status'       : 'failed' if attempts >= max_attempts else 'pending',
+                            'attempts'     : attempts,
+                            'last_error'   : error,
+                            'next_attempt' : datetime.utcnow() + timedelta(seconds=delay)},
+                   '$unset': {'claimed': 1}})
+
+def send_outbox(batch_size=50, backoff=60, max_backoff=3600, max_attempts=10):
+    """
+    Sends up to batch_size due messages from the outbox over a single SMTP
+    connection. A message that can't be sent is retried after an exponentially
+    growing delay, and marked failed after max_attempts. Returns (sent, failed).
+    """
+    outbox = db.mail_outbox
+    now = datetime.utcnow()
+
+    batch = []
+    while len(batch) < batch_size:
+        doc = _claim(outbox, now)
+        if doc is None:
+            break
+        batch.append(doc)
+
+    if not batch:
+        return 0, 0
+
+    sent = failed = 0
+    remaining = list(batch)
+    try:
+        with mail.connect() as conn:
+            while remaining:
+                doc = remaining[0]
+                msg = Message(**dict((f, doc.get(f)) for f in MESSAGE_FIELDS))
+                try:
+                    conn.send(msg)
+                except smtplib.SMTPServerDisconnected:
+                    # the connection is gone, leave the rest for the handler below
+                    raise
+                except smtplib.SMTPException as e:
+                    # refused by the server, e.g. a bad recipient
+                    app.logger.warning("Could not send '%s': %s", doc.get('subject'), e)
+                    _failed(outbox, doc, str(e), backoff, max_backoff, max_attempts)
+                    failed += 1
+                else:
+                    outbox.update({'_id': doc['_id']},
+                                  {'$set': {'status': 'sent', 'sent': datetime.utcnow(),
+                                            'attempts': doc.get('attempts', 0) + 1},
+                                   '$unset': {'claimed': 1, 'last_error': 1}})
+                    sent += 1
+                remaining.pop(0)
+    except (smtplib.SMTPException, socket.error) as e:
+        app.logger.warning("SMTP server unavailable, %d messages delayed: %s", len(remaining), e)
+        for doc in remaining:
+            _failed(outbox, doc, str(e), backoff, max_backoff, max_attempts)
+        failed += len(remaining)
 
+    return sent, failed
@@ -2,9 +2,13 @@ import os
 import urllib
 import hashlib
 import subprocess
+import tempfile
 import warnings
 
 from glider_dac import app, db, slugify
+from glider_util.fingerprint import WriteFingerprints
+from glider_util.offload import offload
+from glider_util.geo import wkt_to_geojson
 from datetime import datetime
 from flask.ext.mongokit import Document
 from bson.objectid import ObjectId
@@ -29,6 +33,17 @@ class Deployment(Document):
         'updated'                   : datetime
     }
 
+    # What the deployment's files actually cover, maintained by
+    # FileMetadata.add_to_deployment from each new file's header:
+    #   time_coverage_start, time_coverage_end : datetime
+    #   lat_min, lat_max, lon_min, lon_max     : float
+    #   last_position                          : {'time': datetime, 'lat': float, 'lon': float}
+    #   profile_count                          : int
+    # They are left out of structure, which would store them as null until the
+    # first file arrives, and $min/$max never replace a null. So is geometry,
+    # the GeoJSON searched with the 2dsphere index (see location_geometry).
+    # save() never writes the extent fields back.
+
     default_values = {
         'created': datetime.utcnow,
         'completed': False
@@ -39,6 +54,9 @@ class Deployment(Document):
             'fields': 'name',
             'unique': True,
         },
+        {
+            'fields': 'updated',
+        },
     ]
 
     def save(self):
@@ -48,8 +66,45 @@ class Deployment(Document):
 
         self.updated = datetime.utcnow()
 
+        action = 'update' if self.get('_id') else 'create'
+
         self.sync()
-        super(Deployment, self).save()
+
+        geometry = self.location_geometry()
+        if action == 'create':
+            if geometry is not None:
+                self['geometry'] = geometry
+            super(Deployment, self).save()
+        else:
+            # only the structure fields are written back: the fields kept by
+            # FileMetadata.add_to_deployment may have moved on since this copy
+            # was loaded, and writing the whole document would undo that
+            self.validate()
+            self.collection.update({'_id': self._id},
+                                   {'$set': dict((f, self.get(f)) for f in self.structure)})
+            # the same goes for geometry once the files give it a box
+            self.collection.update({'_id': self._id, 'lon_min': {'$exists': False}},
+                                   {'$set': {'geometry': geometry}} if geometry is not None else
+                                   {'$unset': {'geometry': 1}})
+
+        self.publish_catalog_event(action)
+
+    def delete(self):
+        super(Deployment, self).delete()
+        self.publish_catalog_event('delete')
+
+    def publish_catalog_event(self, action):
+        """
+        Queues a deployment create/update/delete for scripts/catalog_trigger.py, which
+        debounces these into incremental ERDDAP/THREDDS catalog rebuilds.
+        """
+        db.catalog_events.insert({
+            'action'        : action,
+            'deployment_id' : self._id,
+            'name'          : self.name,
+            'username'      : self.username,
+            'created'       : datetime.utcnow()
+        })
 
     @property
     def dap(self):
@@ -68,6 +123,28 @@ class Deployment(Document):
         query = urllib.urlencode({ 'catalog' : catalog_parameter, 'dataset' : dataset_parameter })
         return u"http://tds.gliders.ioos.us/thredds/iso/%s_%s_Time.ncml?%s" % (title, name, query)
 
+    @property
+    def bbox(self):
+        """
+        [lon_min, lat_min, lon_max, lat_max] of the deployment's files, or None.
+        """
+        bbox = [self.get(f) for f in ('lon_min', 'lat_min', 'lon_max', 'lat_max')]
+        if None in bbox:
+            return None
+        return bbox
+
+    def location_geometry(self):
+        """
+        The GeoJSON of the estimated deploy location, or None. It is the geometry
+        /api/deployments/search matches until the deployment's files give it a
+        box (see FileMetadata.add_to_deployment).
+        """
+        try:
+            return wkt_to_geojson(self.estimated_deploy_location)
+        except ValueError as e:
+            warnings.warn("No geometry for %s: %s" % (self.name, e))
+            return None
+
     @property
     def title(self):
         if self.operator is not None and self.operator != "":
@@ -84,7 +161,7 @@ class Deployment(Document):
         md5 = hashlib.md5()
 
         with open(fname, 'rb') as f:
-            for chunk in iter(lambda: f.read(128), b''):
+            for chunk in iter(lambda: f.read(65536), b''):
                 md5.update(chunk)
 
         return md5.hexdigest()
@@ -120,7 +197,7 @@ class Deployment(Document):
                     if os.path.exists(md5_file):
                         continue
 
-                    md5_value = self._hash_file(full_file)
+                    md5_value = offload(self._hash_file, full_file)
 
                     md5_file = full_file + ".md5"
                     with open(md5_file, 'w') as mf:
@@ -145,9 +222,9 @@ class Deployment(Document):
                 # local test
                 #os.symlink(self.deployment_dir, archive_mdir)
 
-                not_mounted = subprocess.call(['mountpoint', '-q', archive_mdir])
+                not_mounted = offload(subprocess.call, ['mountpoint', '-q', archive_mdir])
                 if not_mounted == 1:
-                    subprocess.call(['/usr/local/bin/bindfs', '-r', self.deployment_dir, archive_mdir])
+                    offload(subprocess.call, ['/usr/local/bin/bindfs', '-r', self.deployment_dir, archive_mdir])
 
             except Exception as e:
                 warnings.warn("Could not link %s to %s: %s" % (self.deployment_dir, archive_mdir, e))
@@ -160,33 +237,74 @@ class Deployment(Document):
                 archive_mdir = os.path.join(archive_path, mname)
 
                 if os.path.exists(archive_mdir):
-                    not_mounted = subprocess.call(['mountpoint', '-q', archive_mdir])
+                    not_mounted = offload(subprocess.call, ['mountpoint', '-q', archive_mdir])
                     if not_mounted == 0:
-                        subprocess.call(['/usr/local/bin/bindfs', '-r', self.deployment_dir, archive_mdir])
+                        offload(subprocess.call, ['/usr/local/bin/bindfs', '-r', self.deployment_dir, archive_mdir])
 
             except Exception as e:
                 warnings.warn("Could not unlink %s: %s" % (archive_mdir, e))
 
+    def _write_file(self, path, contents):
+        """
+        Writes contents to path, unless it already holds exactly that, and records a
+        fingerprint of the write so glider_dac_db_sync.py does not act on it.
+
+        The contents go to a hidden temporary file that is fingerprinted and then
+        renamed over path, so the fingerprint exists before the daemon can see
+        any event for path.
+        """
+        if os.path.exists(path):
+            with open(path) as f:
+                if f.read() == contents:
+                    return
+
+        dirname, filename = os.path.split(path)
+        with tempfile.NamedTemporaryFile(dir=dirname, prefix='.%s.' % filename, delete=False) as f:
+            f.write(contents)
+        try:
+            os.chmod(f.name, 0644)
+            WriteFingerprints(db.self_writes).record(path, source=f.name)
+            os.rename(f.name, path)
+        except:
+            os.remove(f.name)
+            raise
+
+    def _make_deployment_dir(self):
+        """
+        Creates deployment_dir the same way as _write_file writes files: as a
+        hidden temporary directory, fingerprinted, then renamed into place.
+        """
+        parent = os.path.dirname(self.deployment_dir)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.%s.' % os.path.basename(self.deployment_dir))
+        try:
+            os.chmod(tmp, 0755)
+            WriteFingerprints(db.self_writes).record(self.deployment_dir, source=tmp)
+            os.rename(tmp, self.deployment_dir)
+        except:
+            os.rmdir(tmp)
+            raise
+
     def sync(self):
         if not os.path.exists(self.deployment_dir):
             try:
-                os.makedirs(self.deployment_dir)
+                self._make_deployment_dir()
             except OSError:
                 pass
 
         # Keep the WMO file updated if it is edited via the web form
         if self.wmo_id is not None and self.wmo_id != "":
             wmo_id_file = os.path.join(self.deployment_dir, "wmoid.txt")
-            with open(wmo_id_file, 'w') as f:
-                f.write(self.wmo_id)
+            self._write_file(wmo_id_file, self.wmo_id)
 
         # trigger any completed tasks if necessary
         self.on_complete()
 
         # Serialize Deployment model to disk
         json_file = os.path.join(self.deployment_dir, "deployment.json")
-        with open(json_file, 'w') as f:
-            f.write(self.to_json())
+        self._write_file(json_file, self.to_json())
 
     @classmethod
     def get_deployment_count_by_operator(cls):
@@ -6,6 +6,7 @@ from datetime import datetime
 from glider_dac import app, db
 from flask_login import UserMixin
 from glider_util.bdb import UserDB
+from glider_util.offload import offload
 from flask.ext.mongokit import Document
 from bson import ObjectId
 
@@ -35,7 +36,7 @@ class User(Document):
         password = str(password)
 
         u = UserDB(app.config.get('USER_DB_FILE'))
-        return u.check(username, password)
+        return offload(u.check, username, password)
 
     @classmethod
     def authenticate(cls, username, password):
@@ -56,7 +57,7 @@ class User(Document):
         password = str(password)
 
         u = UserDB(app.config.get('USER_DB_FILE'))
-        return u.set(username, password)
+        return offload(u.set, username, password)
 
     @property
     def data_root(self):
@@ -1 +1 @@
-from glider_dac.views import index, deployment, user
+from glider_dac.views import index, deployment, user, api, events, downloads
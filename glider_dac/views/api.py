@@ -0,0 +1,411 @@
+import os
+import json
+import gzip
+import hashlib
+from cStringIO import StringIO
+from datetime import datetime
+
+import pymongo
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
+from flask import make_response, request, url_for, Response, stream_with_context
+from glider_dac import app, db
+from glider_util.geo import bbox_geometry
+
+# fields a client can ask for with ?fields=, and the Mongo fields each one needs
+API_FIELDS = {
+    'id'                        : ['_id'],
+    'name'                      : ['name'],
+    'username'                  : ['username'],
+    'operator'                  : ['operator'],
+    'wmo_id'                    : ['wmo_id'],
+    'completed'                 : ['completed'],
+    'estimated_deploy_date'     : ['estimated_deploy_date'],
+    'estimated_deploy_location' : ['estimated_deploy_location'],
+    'created'                   : ['created'],
+    'updated'                   : ['updated'],
+    # extent of the deployment's files, see FileMetadata.add_to_deployment
+    'time_coverage_start'       : ['time_coverage_start'],
+    'time_coverage_end'         : ['time_coverage_end'],
+    'bbox'                      : ['lon_min', 'lat_min', 'lon_max', 'lat_max'],
+    'last_position'             : ['last_position'],
+    'profile_count'             : ['profile_count'],
+    # GeoJSON: the box the files cover, or the estimated deploy location
+    'geometry'                  : ['geometry'],
+    # links derived from the model, see Deployment.dap/sos/iso
+    'dap'                       : ['name', 'operator', 'username'],
+    'sos'                       : ['name', 'operator', 'username'],
+    'iso'                       : ['name', 'operator', 'username'],
+}
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT     = 1000
+
+# don't bother compressing tiny responses
+GZIP_MIN_SIZE = 500
+
+# deployment directory bookkeeping files, not data
+SKIP_FILES = ["deployment.json", "wmoid.txt", "completed.txt"]
+
+# documents fetched from Mongo per round trip while exporting
+EXPORT_BATCH_SIZE = 100
+
+# /api/deployments/search answers a bbox and any other filters in one scan of
+# the first index; the second serves operator/time searches without a bbox,
+# which a 2dsphere index can't (see fabfile.create_index)
+SEARCH_INDEXES = [[('geometry', pymongo.GEOSPHERE),
+                   ('time_coverage_start', pymongo.ASCENDING),
+                   ('time_coverage_end', pymongo.ASCENDING),
+                   ('operator', pymongo.ASCENDING)],
+                  [('operator', pymongo.ASCENDING),
+                   ('time_coverage_start', pymongo.ASCENDING)]]
+
+class APIError(Exception):
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+@app.errorhandler(APIError)
+def api_error(error):
+    return json_response({'error': error.message}, error.status)
+
+def parse_datetime(value):
+    """
+    Parses an ISO 8601 UTC timestamp (date, minutes or seconds, optionally with
+    fractional seconds and a Z).
+    """
+    value = value.rstrip('Z')
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise APIError("Could not parse date %s, expected ISO 8601 such as 2014-06-01T00:00:00Z" % value)
+
+def parse_fields(value):
+    if not value:
+        return sorted(API_FIELDS)
+
+    fields = [f.strip() for f in value.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in API_FIELDS]
+    if unknown:
+        raise APIError("Unknown fields: %s. Available: %s" % (", ".join(unknown), ", ".join(sorted(API_FIELDS))))
+    return fields
+
+def parse_limit(args):
+    try:
+        limit = min(int(args.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+    except ValueError:
+        raise APIError("limit must be an integer")
+    if limit < 1:
+        raise APIError("limit must be positive")
+    return limit
+
+def parse_cursor(value):
+    try:
+        return ObjectId(value)
+    except InvalidId:
+        raise APIError("Invalid cursor")
+
+def parse_bbox(value):
+    """
+    lon_min,lat_min,lon_max,lat_max as four floats. lon_min > lon_max means the
+    box crosses the antimeridian.
+    """
+    try:
+        bbox = [float(v) for v in value.split(',')]
+    except ValueError:
+        bbox = []
+    if len(bbox) != 4:
+        raise APIError("bbox must be lon_min,lat_min,lon_max,lat_max")
+    lon_min, lat_min, lon_max, lat_max = bbox
+    if not (-180 <= lon_min <= 180 and -180 <= lon_max <= 180 and -90 <= lat_min <= lat_max <= 90):
+        raise APIError("bbox out of range, expected lon_min,lat_min,lon_max,lat_max in degrees")
+    return bbox
+
+def search_query(bbox=None, start=None, end=None, operator=None):
+    """
+    The Mongo query for deployments whose geometry intersects bbox, whose time
+    coverage overlaps start to end and whose operator is operator, leaving out
+    any that is None. Each combination is answered from one of SEARCH_INDEXES.
+    """
+    query = {}
+    if bbox is not None:
+        try:
+            geometry = bbox_geometry(*bbox)
+        except ValueError as e:
+            raise APIError(str(e))
+        query['geometry'] = {'$geoIntersects': {'$geometry': geometry}}
+    if start is not None:
+        query['time_coverage_end'] = {'$gte': start}
+    if end is not None:
+        query['time_coverage_start'] = {'$lte': end}
+    if operator:
+        query['operator'] = operator
+    return query
+
+def deployment_query(args):
+    """
+    Builds the Mongo query for the user, operator, completed and updated_since
+    filters in args.
+    """
+    query = {}
+    if args.get('user'):
+        query['username'] = args['user']
+    if args.get('operator'):
+        query['operator'] = args['operator']
+    if args.get('completed'):
+        query['completed'] = args['completed'].lower() in ('true', '1', 'yes')
+    if args.get('updated_since'):
+        query['updated'] = {'$gt': parse_datetime(args['updated_since'])}
+    return query
+
+def serialize_date(date):
+    if date is not None:
+        return date.isoformat() + 'Z'
+
+def serialize_deployment(deployment, fields):
+    """
+    The API representation of a Deployment, limited to fields.
+    """
+    values = {}
+    for field in fields:
+        if field == 'id':
+            values['id'] = str(deployment._id)
+        elif field in ('dap', 'sos', 'iso'):
+            values[field] = getattr(deployment, field)
+        elif field in ('estimated_deploy_date', 'created', 'updated', 'time_coverage_start', 'time_coverage_end'):
+            values[field] = serialize_date(deployment.get(field))
+        elif field == 'bbox':
+            values['bbox'] = deployment.bbox
+        elif field == 'last_position':
+            position = deployment.get('last_position')
+            values['last_position'] = position and {'time' : serialize_date(position['time']),
+                                                    'lat'  : position['lat'],
+                                                    'lon'  : position['lon']}
+        elif field == 'profile_count':
+            values['profile_count'] = deployment.get('profile_count', 0)
+        else:
+            values[field] = deployment.get(field)
+    return values
+
+def accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+def json_response(data, status=200, etag=None):
+    """
+    A JSON response, gzipped if the client accepts it. The gzipped body is a
+    different representation, so it gets etag with a -gz suffix.
+    """
+    body = json.dumps(data, separators=(',', ':'))
+    response = make_response(body, status)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+
+    if len(body) >= GZIP_MIN_SIZE and accepts_gzip():
+        buf = StringIO()
+        with gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=6) as f:
+            f.write(body)
+        response.set_data(buf.getvalue())
+        response.headers['Content-Encoding'] = 'gzip'
+        if etag is not None:
+            etag += '-gz'
+
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+def not_modified(etag):
+    """
+    A 304 if the client's If-None-Match holds etag, or its -gz form and the
+    client accepts gzip, else None.
+    """
+    tags = [etag + '-gz', etag] if accepts_gzip() else [etag]
+    for tag in tags:
+        if request.if_none_match.contains(tag):
+            response = make_response('', 304)
+            response.headers['Vary'] = 'Accept-Encoding'
+            response.set_etag(tag)
+            return response
+    return None
+
+@app.route('/api/deployments', methods=['GET'])
+def api_deployments():
+    """
+    Lists deployments, filtered by ?user=, ?operator=, ?completed=true|false and
+    ?updated_since=<ISO 8601>, in _id order.
+
+    ?fields=name,updated,dap limits what is returned for each deployment. Pages
+    hold ?limit= deployments (default 100); the next page is fetched with
+    ?cursor=<next_cursor from the previous page>, also given as a Link header.
+
+    The ETag covers the ids and updated times of the page, which are checked with
+    a cheap projected query before any documents are loaded, so polling with
+    If-None-Match costs one index scan when nothing changed.
+    """
+    fields = parse_fields(request.args.get('fields'))
+    query = deployment_query(request.args)
+    limit = parse_limit(request.args)
+    if request.args.get('cursor'):
+        query['_id'] = {'$gt': parse_cursor(request.args['cursor'])}
+
+    # one past the page size tells whether there is a next page
+    page = list(db.deployments.find(query, {'_id': 1, 'updated': 1},
+                                    sort=[('_id', pymongo.ASCENDING)], limit=limit + 1))
+    has_more = len(page) > limit
+    page = page[:limit]
+
+    etag = hashlib.md5(json.dumps([request.full_path, fields] +
+                                  [(str(d['_id']), serialize_date(d.get('updated'))) for d in page])).hexdigest()
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    projection = dict((f, 1) for field in fields for f in API_FIELDS[field])
+    ids = [d['_id'] for d in page]
+    deployments = db.Deployment.find({'_id': {'$in': ids}}, projection, sort=[('_id', pymongo.ASCENDING)])
+
+    data = {'deployments' : [serialize_deployment(d, fields) for d in deployments],
+            'next_cursor' : str(ids[-1]) if has_more else None}
+
+    response = json_response(data, etag=etag)
+    if has_more:
+        args = request.args.to_dict()
+        args['cursor'] = data['next_cursor']
+        response.headers['Link'] = '<%s>; rel="next"' % url_for('api_deployments', _external=True, **args)
+    return response
+
+@app.route('/api/deployments/search', methods=['GET'])
+def api_search_deployments():
+    """
+    Deployments with data inside ?bbox=lon_min,lat_min,lon_max,lat_max between
+    ?start= and ?end= (ISO 8601), from ?operator=, in _id order. A deployment
+    whose files haven't been read yet is placed at its estimated deploy
+    location and has no time coverage, so it only matches searches without a
+    time window.
+
+    ?fields=, ?limit= and ?cursor= work as for /api/deployments.
+    """
+    fields = parse_fields(request.args.get('fields'))
+    limit  = parse_limit(request.args)
+
+    bbox  = parse_bbox(request.args['bbox']) if request.args.get('bbox') else None
+    start = parse_datetime(request.args['start']) if request.args.get('start') else None
+    end   = parse_datetime(request.args['end']) if request.args.get('end') else None
+    if start is not None and end is not None and end < start:
+        raise APIError("end is before start")
+
+    query = search_query(bbox, start, end, request.args.get('operator'))
+    if request.args.get('cursor'):
+        query['_id'] = {'$gt': parse_cursor(request.args['cursor'])}
+
+    projection = dict((f, 1) for field in fields for f in API_FIELDS[field])
+    deployments = list(db.Deployment.find(query, projection, sort=[('_id', pymongo.ASCENDING)], limit=limit + 1))
+    has_more = len(deployments) > limit
+    deployments = deployments[:limit]
+
+    data = {'deployments' : [serialize_deployment(d, fields) for d in deployments],
+            'next_cursor' : str(deployments[-1]._id) if has_more else None}
+
+    response = json_response(data)
+    if has_more:
+        args = request.args.to_dict()
+        args['cursor'] = data['next_cursor']
+        response.headers['Link'] = '<%s>; rel="next"' % url_for('api_search_deployments', _external=True, **args)
+    return response
+
+@app.route('/api/deployments/<ObjectId:deployment_id>', methods=['GET'])
+def api_deployment(deployment_id):
+    fields = parse_fields(request.args.get('fields'))
+
+    deployment = db.Deployment.find_one({'_id': deployment_id})
+    if deployment is None:
+        raise APIError("No deployment %s" % deployment_id, 404)
+
+    etag = hashlib.md5(json.dumps([str(deployment._id), serialize_date(deployment.updated), fields])).hexdigest()
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    return json_response(serialize_deployment(deployment, fields), etag=etag)
+
+def list_files(deployment_dir):
+    """
+    Yields name, size, mtime and (where a .md5 file exists) md5 for each data file
+    in deployment_dir.
+    """
+    try:
+        names = sorted(os.listdir(deployment_dir))
+    except OSError:
+        return
+
+    for name in names:
+        if name in SKIP_FILES or name.endswith(".md5"):
+            continue
+
+        path = os.path.join(deployment_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if not os.path.isfile(path):
+            continue
+
+        entry = {'name'  : name,
+                 'size'  : st.st_size,
+                 'mtime' : serialize_date(datetime.utcfromtimestamp(st.st_mtime))}
+
+        if name + ".md5" in names:
+            try:
+                with open(path + ".md5") as f:
+                    entry['md5'] = f.read().strip()
+            except IOError:
+                pass
+
+        yield entry
+
+def export_deployments(updated_since=None, files=True):
+    """
+    Yields one NDJSON line per deployment, updated since updated_since (a datetime)
+    if given, oldest update first. With files=True each line also lists the
+    deployment's files.
+
+    Deployments are read from a cursor in batches and each line is produced as it
+    is needed, so memory use does not grow with the size of the archive.
+    """
+    query = {}
+    if updated_since is not None:
+        query['updated'] = {'$gt': updated_since}
+
+    fields = sorted(API_FIELDS)
+    deployments = db.Deployment.find(query, sort=[('updated', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    deployments.batch_size(EXPORT_BATCH_SIZE)
+
+    for deployment in deployments:
+        record = serialize_deployment(deployment, fields)
+        if files:
+            record['files'] = list(list_files(deployment.deployment_dir))
+        yield json.dumps(record, separators=(',', ':')) + '\n'
+
+@app.route('/api/deployments/export.ndjson', methods=['GET'])
+def api_export_deployments():
+    """
+    Streams every deployment with its files as newline delimited JSON.
+
+    ?updated_since=<ISO 8601> limits the export to deployments updated since then,
+    and ?files=false leaves out the file listings. The X-Next-Updated-Since header
+    gives the updated_since to use for the next incremental export.
+    """
+    updated_since = None
+    if request.args.get('updated_since'):
+        updated_since = parse_datetime(request.args['updated_since'])
+    files = request.args.get('files', 'true').lower() not in ('false', '0', 'no')
+
+    # anything updated once the export starts is picked up by the next one
+    next_updated_since = serialize_date(datetime.utcnow())
+
+    response = Response(stream_with_context(export_deployments(updated_since, files)),
+                        mimetype='application/x-ndjson')
+    response.headers['X-Next-Updated-Since'] = next_updated_since
+    return response
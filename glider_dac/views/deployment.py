@@ -9,14 +9,23 @@ from flask import render_template, make_response, redirect, jsonify, flash, url_
 from flask_login import login_required, login_user, logout_user, current_user
 from glider_dac import app, db, datetimeformat
 from glider_dac.glider_emails import send_wmoid_email
+from glider_util.offload import offload
+from glider_util.geo import wkt_to_geojson
 
 from flask.ext.wtf import Form
 from wtforms import TextField, SubmitField, BooleanField, validators
+import pymongo
 from pymongo.errors import DuplicateKeyError
 
+def valid_wkt(form, field):
+    try:
+        wkt_to_geojson(field.data)
+    except ValueError as e:
+        raise validators.ValidationError(str(e))
+
 class DeploymentForm(Form):
     estimated_deploy_date       = TextField(u'Estimated Deploy Date (yyyy-mm-dd)')
-    estimated_deploy_location   = TextField(u'Estimated Deploy Location (WKT)')
+    estimated_deploy_location   = TextField(u'Estimated Deploy Location (WKT)', [valid_wkt])
     operator                    = TextField(u'Operator')
     wmo_id                      = TextField(u'WMO ID')
     completed                   = BooleanField(u'Completed')
@@ -27,10 +36,24 @@ class NewDeploymentForm(Form):
     wmo_id  = TextField(u'WMO ID')
     submit  = SubmitField(u"Create")
 
+def list_files(deployment_dir):
+    """
+    (filename, mtime) of the data files in deployment_dir, newest first.
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(deployment_dir):
+        for f in filenames:
+            if f in ["deployment.json", "wmoid.txt", "completed.txt"] or f.endswith(".md5"):
+                continue
+            files.append((f, datetime.utcfromtimestamp(os.path.getmtime(os.path.join(dirpath, f)))))
+
+    return sorted(files, lambda a,b: cmp(b[1], a[1]))
+
 @app.route('/users/<string:username>/deployments')
 def list_user_deployments(username):
     user = db.User.find_one( {'username' : username } )
-    deployments = list(db.Deployment.find( { 'user_id' : user._id } ))
+    # updated is bumped as new files change the extent (see FileMetadata.add_to_deployment)
+    deployments = list(db.Deployment.find( { 'user_id' : user._id }, sort=[('updated', pymongo.DESCENDING)] ))
 
     kwargs = {}
     if current_user and current_user.is_active() and (current_user.is_admin() or current_user == user):
@@ -38,27 +61,11 @@ def list_user_deployments(username):
         form = NewDeploymentForm()
         kwargs['form'] = form
 
-    for m in deployments:
-        if not os.path.exists(m.deployment_dir):   # wat
-            continue
-
-        m.updated = datetime.utcfromtimestamp(os.path.getmtime(m.deployment_dir))
-
-    deployments = sorted(deployments, lambda a, b: cmp(b.updated, a.updated))
-
     return render_template('user_deployments.html', username=username, deployments=deployments, **kwargs)
 
 @app.route('/operators/<string:operator>/deployments')
 def list_operator_deployments(operator):
-    deployments = list(db.Deployment.find( { 'operator' : unicode(operator) } ))
-
-    for m in deployments:
-        if not os.path.exists(m.deployment_dir):
-            continue
-
-        m.updated = datetime.utcfromtimestamp(os.path.getmtime(m.deployment_dir))
-
-    deployments = sorted(deployments, lambda a, b: cmp(b.updated, a.updated))
+    deployments = list(db.Deployment.find( { 'operator' : unicode(operator) }, sort=[('updated', pymongo.DESCENDING)] ))
 
     return render_template('operator_deployments.html', operator=operator, deployments=deployments)
 
@@ -67,14 +74,7 @@ def show_deployment(username, deployment_id):
     user = db.User.find_one( {'username' : username } )
     deployment = db.Deployment.find_one({'_id':deployment_id})
 
-    files = []
-    for dirpath, dirnames, filenames in os.walk(deployment.deployment_dir):
-        for f in filenames:
-            if f in ["deployment.json", "wmoid.txt", "completed.txt"] or f.endswith(".md5"):
-                continue
-            files.append((f, datetime.utcfromtimestamp(os.path.getmtime(os.path.join(dirpath, f)))))
-
-    files = sorted(files, lambda a,b: cmp(b[1], a[1]))
+    files = offload(list_files, deployment.deployment_dir)
 
     kwargs = {}
 
@@ -187,7 +187,7 @@ def post_deployment_file(username, deployment_id):
 
     editable = current_user and current_user.is_active() and (current_user.is_admin() or current_user == user)
 
-    return render_template("_deployment_files.html", files=retval, editable=editable)
+    return render_template("_deployment_files.html", username=username, deployment=deployment, files=retval, editable=editable)
 
 @app.route('/users/<string:username>/deployment/<ObjectId:deployment_id>/delete_files', methods=['POST'])
 @login_required
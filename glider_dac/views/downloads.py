@@ -0,0 +1,206 @@
+import os
+import json
+import zlib
+import urllib
+import hashlib
+import mimetypes
+from datetime import datetime
+
+from flask import Response, request, abort
+from werkzeug.wsgi import wrap_file
+from glider_dac import app, db
+from glider_util.archive import CHUNK_SIZE, Member, TarStream, ZipStream
+from glider_util.offload import offload
+
+# deployment directory bookkeeping files, not data
+SKIP_FILES = ["deployment.json", "wmoid.txt", "completed.txt"]
+
+def get_deployment(username, deployment_id):
+    """
+    The deployment, if it exists and belongs to username, otherwise a 404.
+    """
+    user = db.User.find_one({'username': username})
+    deployment = db.Deployment.find_one({'_id': deployment_id})
+    if user is None or deployment is None or deployment.user_id != user._id:
+        abort(404)
+    return deployment
+
+def archive_members(deployment):
+    """
+    The data files of deployment under a directory named after it, followed by a
+    MANIFEST.md5 (md5sum -c format) built from the .md5 files of completed
+    deployments.
+    """
+    members = []
+    manifest = []
+    try:
+        names = sorted(os.listdir(deployment.deployment_dir))
+    except OSError:
+        names = []
+
+    for name in names:
+        if name in SKIP_FILES or name.endswith(".md5"):
+            continue
+        path = os.path.join(deployment.deployment_dir, name)
+        if not os.path.isfile(path):
+            continue
+
+        st = os.stat(path)
+        members.append(Member(u'%s/%s' % (deployment.name, name), st.st_mtime, path=path, size=st.st_size))
+
+        if name + ".md5" in names:
+            with open(path + ".md5") as f:
+                manifest.append("%s  %s\n" % (f.read().strip(), name))
+
+    if manifest:
+        newest = max(m.mtime for m in members)
+        members.append(Member(u'%s/MANIFEST.md5' % deployment.name, newest, data=''.join(manifest)))
+
+    return members
+
+def archive_etag(members):
+    return hashlib.md5(json.dumps([(m.name, m.size, m.mtime) for m in members])).hexdigest()
+
+def byte_range(length, etag, last_modified):
+    """
+    The (start, stop) the request's Range header asks for, or None for the whole
+    entity: no Range, or an If-Range that no longer matches. Aborts with a 416 if
+    the range can't be satisfied.
+    """
+    if request.range is None:
+        return None
+
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and (last_modified is None or if_range.date < last_modified.replace(microsecond=0)):
+        return None
+
+    rng = request.range.range_for_length(length)
+    if rng is None:
+        response = Response(status=416)
+        response.headers['Content-Range'] = 'bytes */%d' % length
+        abort(response)
+    return rng
+
+def partial_response(body, length, etag, last_modified, mimetype, filename):
+    """
+    A response streaming body(start, stop), bytes start up to stop of an entity
+    of length bytes, answering conditional and Range requests. body is only
+    called once the response is known to have one, so nothing it opens is left
+    behind by a 304 or 416.
+    """
+    rng = byte_range(length, etag, last_modified)
+    start, stop = rng or (0, length)
+
+    response = Response(mimetype=mimetype, direct_passthrough=True)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    response.headers['Content-Length'] = str(stop - start)
+    if rng is not None:
+        response.status_code = 206
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, length)
+
+    response.make_conditional(request)
+    if response.status_code == 304:
+        del response.headers['Content-Length']
+        del response.headers['Content-Range']
+        return response
+
+    response.response = body(start, stop)
+    return response
+
+@app.route('/users/<string:username>/deployment/<ObjectId:deployment_id>/archive.tar', methods=['GET'])
+def deployment_archive_tar(username, deployment_id):
+    """
+    Streams the deployment's files as a tar archive, straight from disk. The
+    layout is worked out from the directory listing first, so the size is known
+    and interrupted downloads can be resumed with a Range request.
+    """
+    deployment = get_deployment(username, deployment_id)
+    members = offload(archive_members, deployment)
+    tar = TarStream(members)
+
+    last_modified = datetime.utcfromtimestamp(max(m.mtime for m in members)) if members else None
+    return partial_response(tar.iter_range, tar.size, archive_etag(members), last_modified,
+                            'application/x-tar', '%s.tar' % deployment.name)
+
+@app.route('/users/<string:username>/deployment/<ObjectId:deployment_id>/archive.zip', methods=['GET'])
+def deployment_archive_zip(username, deployment_id):
+    """
+    Streams the deployment's files as an uncompressed zip archive. Zip puts
+    checksums of every file at the end, so downloads can't be resumed part way;
+    use archive.tar for that.
+    """
+    deployment = get_deployment(username, deployment_id)
+    members = offload(archive_members, deployment)
+
+    response = Response(iter(ZipStream(members)), mimetype='application/zip',
+                        direct_passthrough=True)
+    response.headers['Content-Disposition'] = 'attachment; filename="%s.zip"' % deployment.name
+    return response
+
+def file_body(path, start, stop, size):
+    """
+    Bytes start up to stop of the file at path. When that runs to the end of the
+    file (a whole download or a resumed one) the open file goes to the server's
+    wsgi.file_wrapper, which gunicorn sends with sendfile(2) from the current
+    position; other ranges are read in chunks here.
+    """
+    if stop < size:
+        return Member('', 0, path=path, size=size).read(start, stop - start)
+
+    f = open(path, 'rb')
+    f.seek(start)
+    return wrap_file(request.environ, f, CHUNK_SIZE)
+
+def accel_redirect(path):
+    """
+    The X-Accel-Redirect location nginx serves path from, or None if
+    X_ACCEL_REDIRECT isn't set or path isn't under DATA_ROOT.
+    """
+    prefix = app.config.get('X_ACCEL_REDIRECT')
+    data_root = app.config.get('DATA_ROOT')
+    if not prefix or not data_root:
+        return None
+
+    relpath = os.path.relpath(path, data_root)
+    if relpath.startswith(os.pardir):
+        return None
+    return prefix.rstrip('/') + '/' + urllib.quote(relpath.encode('utf-8'))
+
+@app.route('/users/<string:username>/deployment/<ObjectId:deployment_id>/files/<path:filename>', methods=['GET'])
+def deployment_file(username, deployment_id, filename):
+    """
+    Downloads one of the deployment's files. With X_ACCEL_REDIRECT set this only
+    decides whether the file may be downloaded and nginx sends it, ranges and
+    conditional requests included. Otherwise the file is sent from here, with
+    sendfile(2) where the server supports it.
+    """
+    deployment = get_deployment(username, deployment_id)
+    if os.path.basename(filename) != filename or filename.startswith('.') or filename in SKIP_FILES:
+        abort(404)
+
+    path = os.path.join(deployment.deployment_dir, filename)
+    try:
+        st = os.stat(path)
+    except OSError:
+        abort(404)
+    if not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    location = accel_redirect(path)
+    if location is not None:
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = location
+        response.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return response
+
+    etag = '%d-%d-%d' % (st.st_mtime, st.st_size, zlib.adler32(path.encode('utf-8')) & 0xFFFFFFFF)
+    return partial_response(lambda start, stop: file_body(path, start, stop, st.st_size),
+                            st.st_size, etag, datetime.utcfromtimestamp(st.st_mtime), mimetype, filename)
@@ -0,0 +1,66 @@
+import json
+import time
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
+from flask import Response, request, stream_with_context, abort
+from glider_dac import app, db
+from glider_util.file_events import FileEvents
+
+def server_sent_event(event):
+    data = {'deployment_id' : str(event['deployment_id']),
+            'deployment'    : event['deployment'],
+            'username'      : event['username']}
+    for k in ('file', 'wmo_id'):
+        if k in event:
+            data[k] = event[k]
+    for k in ('mtime', 'updated'):
+        if event.get(k) is not None:
+            data[k] = event[k].isoformat() + 'Z'
+
+    return "id: %s\nevent: %s\ndata: %s\n\n" % (event['_id'], event['type'], json.dumps(data))
+
+@app.route('/events', methods=['GET'])
+def events():
+    """
+    Server-Sent Events stream of new files ("file" events) and deployment updates
+    ("deployment" events), optionally only for ?deployment_id=.
+
+    Streams end after EVENT_STREAM_SECONDS; browsers reconnect on their own with
+    the Last-Event-ID header so nothing published in between is missed. Each open
+    stream holds a worker for that long, which is only affordable with gunicorn's
+    async worker, so the stream is off unless EVENT_STREAM is set.
+    """
+    if not app.config.get('EVENT_STREAM'):
+        abort(404)
+
+    query = {}
+    if request.args.get('deployment_id'):
+        try:
+            query['deployment_id'] = ObjectId(request.args['deployment_id'])
+        except InvalidId:
+            abort(400)
+
+    file_events = FileEvents(db.file_events)
+
+    try:
+        after = ObjectId(request.headers['Last-Event-ID'])
+    except (KeyError, InvalidId, TypeError):
+        after = file_events.newest()
+
+    until = time.time() + app.config.get('EVENT_STREAM_SECONDS', 300)
+
+    def stream():
+        yield "retry: 5000\n\n"
+        for event in file_events.tail(query, after, until=until):
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield server_sent_event(event)
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # don't let nginx buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -9,6 +9,7 @@ from bson.objectid import ObjectId
 from flask import render_template, make_response, redirect, jsonify, flash, url_for, request
 from glider_dac import app, login_manager, db
 from glider_dac.models.user import User
+from glider_util.offload import offload
 from flask_login import login_required, login_user, logout_user, current_user
 from flask.ext.wtf import Form
 from wtforms import TextField, PasswordField
@@ -17,26 +18,18 @@ class LoginForm(Form):
     username = TextField(u'Name')
     password = PasswordField(u'Password')
 
-@app.route('/', methods=['GET'])
-def index():
-
-    data_root = app.config.get('DATA_ROOT')
-
-    files = []
-    deployments_by_dir = {}
+def walk_data_files(data_root):
+    """
+    (deployment dir, path parts, mtime) of every data file under data_root laid out
+    as user/upload/deployment-name/file.
+    """
+    entries = []
     for dirpath, dirnames, filenames in os.walk(data_root):
-        rel_path = os.path.relpath(dirpath, data_root)
-        path_parts = rel_path.split(os.sep)
-
         for filename in filenames:
             if filename in ["wmoid.txt", "completed.txt", "deployment.json"] or filename.endswith(".md5"):
                 continue
 
             entry = os.path.join(dirpath, filename)
-
-            if dirpath not in deployments_by_dir:
-                deployments_by_dir[dirpath] = db.Deployment.find_one({'deployment_dir':dirpath})
-
             rel_path = os.path.relpath(entry, data_root)
 
             # user/upload/deployment-name/file
@@ -44,7 +37,21 @@ def index():
             if len(path_parts) != 4:
                 continue
 
-            files.append((path_parts[0], path_parts[2], path_parts[3], datetime.utcfromtimestamp(os.path.getmtime(entry)), deployments_by_dir[dirpath]))
+            entries.append((dirpath, path_parts, datetime.utcfromtimestamp(os.path.getmtime(entry))))
+    return entries
+
+@app.route('/', methods=['GET'])
+def index():
+
+    data_root = app.config.get('DATA_ROOT')
+
+    files = []
+    deployments_by_dir = {}
+    for dirpath, path_parts, mtime in offload(walk_data_files, data_root):
+        if dirpath not in deployments_by_dir:
+            deployments_by_dir[dirpath] = db.Deployment.find_one({'deployment_dir':dirpath})
+
+        files.append((path_parts[0], path_parts[2], path_parts[3], mtime, deployments_by_dir[dirpath]))
 
     files = sorted(files, lambda a,b: cmp(b[3], a[3]))
 
@@ -113,3 +113,35 @@ def admin_delete_user(user_id):
     flash("User deleted", "success")
     return redirect(url_for('admin'))
 
+
+@app.route('/admin/outbox', methods=['GET'])
+@login_required
+def admin_outbox():
+    if not current_user.is_admin():
+        # No permission
+        flash("Permission denied", 'danger')
+        return redirect(url_for("index"))
+
+    status = request.args.get('status')
+    query = {'status': status} if status else {}
+    messages = db.mail_outbox.find(query, sort=[('created', -1)], limit=100)
+
+    counts = {}
+    for s in ('pending', 'sending', 'sent', 'failed'):
+        counts[s] = db.mail_outbox.find({'status': s}).count()
+
+    return render_template('admin_outbox.html', messages=messages, counts=counts, status=status)
+
+@app.route('/admin/outbox/<ObjectId:message_id>/retry', methods=['POST'])
+@login_required
+def admin_retry_mail(message_id):
+    if not current_user.is_admin():
+        # No permission
+        flash("Permission denied", 'danger')
+        return redirect(url_for("index"))
+
+    db.mail_outbox.update({'_id': message_id, 'status': {'$in': ['pending', 'failed']}},
+                          {'$set': {'status': 'pending', 'attempts': 0, 'next_attempt': datetime.utcnow()}})
+
+    flash("Message queued for sending", "success")
+    return redirect(url_for('admin_outbox'))
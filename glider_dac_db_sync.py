@@ -6,82 +6,263 @@ import os
 import argparse
 import logging
 import smtplib
+import threading
 import subprocess
 
 from datetime import datetime
 
-from watchdog.events import FileSystemEventHandler, DirCreatedEvent, DirDeletedEvent, FileCreatedEvent
+from watchdog.events import FileSystemEventHandler, DirCreatedEvent, DirDeletedEvent, DirMovedEvent, FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent
 from watchdog.observers import Observer
 
 from glider_dac import app, db
+from glider_util.fingerprint import WriteFingerprints
+from glider_util.file_events import FileEvents
+from glider_util.nc_metadata import FileMetadata, publish_catalog_updates
+from glider_util.metrics import Metrics, InstrumentedHandlerMixin, report_metrics
 
 logging.basicConfig(level=logging.INFO,
                     format='[%(asctime)s | %(levelname)s]  %(message)s')
 logger = logging.getLogger(__name__)
 
-class HandleDeploymentDB(FileSystemEventHandler):
-    def __init__(self, base):
-        self.base     = base
-
-    def on_created(self, event):
-        if isinstance(event, DirCreatedEvent):
-
-            if self.base not in event.src_path:
-                return
-
-            rel_path = os.path.relpath(event.src_path, self.base)
-
-            # we only care about this path if it's under a user dir
-            # user/upload/deployment-name
-            path_parts = rel_path.split(os.sep)
-
-            if len(path_parts) != 3:
+class HandleDeploymentDB(InstrumentedHandlerMixin, FileSystemEventHandler):
+    # deployment directory bookkeeping files, not data
+    SKIP_FILES = ["deployment.json", "wmoid.txt", "completed.txt"]
+
+    # seconds a NetCDF file must go unchanged before its metadata is read, so
+    # uploads still being written aren't read over and over
+    METADATA_QUIET_SECONDS = 5
+
+    def __init__(self, base, metrics, file_events=None, file_metadata=None):
+        self.base          = base
+        self.metrics       = metrics
+        self.file_events   = file_events
+        self.file_metadata = file_metadata
+        self.counters = {'events'     : 0,
+                         'suppressed' : 0}
+        # path -> time of its last event, for files waiting for their metadata
+        self.pending_metadata = {}
+        self.pending_lock     = threading.Lock()
+
+    def _is_self_write(self, path):
+        """
+        True if path was last written by the web app itself (see Deployment.sync), in
+        which case the event is only an echo of a save that already happened.
+        """
+        self.counters['events'] += 1
+        self.metrics.inc('mongo_round_trips_total', op='self_writes.find_one')
+
+        with app.app_context():
+            if not WriteFingerprints(db.self_writes).matches(path):
+                return False
+
+        self.counters['suppressed'] += 1
+        self.metrics.inc('self_writes_suppressed_total')
+        logger.info("Skipping self-written %s (%d of %d events suppressed)",
+                    os.path.relpath(path, self.base),
+                    self.counters['suppressed'],
+                    self.counters['events'])
+        return True
+
+    def _publish_deployment(self, deployment):
+        if self.file_events is not None:
+            self.metrics.inc('mongo_round_trips_total', op='file_events.insert')
+            self.file_events.publish('deployment', deployment,
+                                     wmo_id=deployment.wmo_id, updated=deployment.updated)
+
+    def _publish_file(self, path):
+        """
+        Publishes a new data file in a deployment directory for pages showing new
+        files live (see FileEvents).
+        """
+        if self.file_events is None or self.base not in path:
+            return
+
+        dirpath, filename = os.path.split(path)
+        if filename in self.SKIP_FILES or filename.endswith(".md5") or filename.startswith("."):
+            return
+
+        # user/upload/deployment-name/file
+        if len(os.path.relpath(path, self.base).split(os.sep)) != 4:
+            return
+
+        try:
+            mtime = datetime.utcfromtimestamp(os.path.getmtime(path))
+        except OSError:
+            # already gone again
+            return
+
+        with app.app_context():
+            self.metrics.inc('mongo_round_trips_total', op='deployments.find_one')
+            deployment = db.Deployment.find_one({'deployment_dir': dirpath})
+            if deployment is None:
                 return
 
-            logger.info("New deployment directory: %s", rel_path)
-
+            self.metrics.inc('mongo_round_trips_total', op='file_events.insert')
+            self.file_events.publish('file', deployment, file=filename, mtime=mtime)
+
+    def _queue_metadata(self, path):
+        if self.file_metadata is None or not path.endswith(".nc") or self.base not in path:
+            return
+        # temporary names, renamed into place once complete
+        if os.path.basename(path).startswith("."):
+            return
+        # user/upload/deployment-name/file
+        if len(os.path.relpath(path, self.base).split(os.sep)) != 4:
+            return
+
+        with self.pending_lock:
+            self.pending_metadata[path] = time.time()
+
+    def index_pending(self):
+        """
+        Reads the metadata of the queued NetCDF files that have been left alone
+        for METADATA_QUIET_SECONDS. Called from the main loop.
+        """
+        now = time.time()
+        with self.pending_lock:
+            ready = [p for p, t in self.pending_metadata.iteritems() if now - t >= self.METADATA_QUIET_SECONDS]
+            for path in ready:
+                del self.pending_metadata[path]
+
+        changed = {}
+        for path in ready:
             with app.app_context():
-                deployment = db.Deployment.find_one({'deployment_dir':event.src_path})
-                if deployment is None:
-                    deployment             = db.Deployment()
+                self.metrics.inc('mongo_round_trips_total', op='deployments.find_one')
+                deployment = db.deployments.find_one({'deployment_dir': os.path.dirname(path)}, {'_id': 1})
+
+                self.metrics.inc('mongo_round_trips_total', op='file_metadata.update')
+                record = self.file_metadata.update(path, deployment and deployment['_id'])
+                if record is None or 'error' in record:
+                    continue
+                self.metrics.inc('files_indexed_total')
+
+                self.metrics.inc('mongo_round_trips_total', op='deployments.update')
+                deployment = self.file_metadata.add_to_deployment(record, db.deployments)
+                if deployment is not None:
+                    changed[deployment['_id']] = deployment
+
+        # one catalog rebuild per deployment, however many of its files arrived
+        if changed:
+            with app.app_context():
+                self.metrics.inc('mongo_round_trips_total', op='catalog_events.insert')
+                publish_catalog_updates(changed.values(), db.catalog_events)
+
+    def on_moved(self, event):
+        # the web app (see Deployment.sync), and uploads written to a temporary
+        # name first, arrive as a rename
+        if isinstance(event, DirMovedEvent):
+            self._deployment_dir_created(event.dest_path)
+
+        elif isinstance(event, FileMovedEvent):
+            if os.path.basename(event.dest_path) == "wmoid.txt":
+                self._wmoid_written(event.dest_path)
+            else:
+                self._publish_file(event.dest_path)
+                self._queue_metadata(event.dest_path)
+
+            if self.file_metadata is not None and event.src_path.endswith(".nc"):
+                with app.app_context():
+                    self.file_metadata.remove(event.src_path)
+
+    def on_modified(self, event):
+        if isinstance(event, FileModifiedEvent):
+            self._queue_metadata(event.src_path)
 
-                    usr = db.User.find_one( { 'username' : unicode(path_parts[0]) } )
-                    if hasattr(usr, '_id'):
-                        deployment.user_id     = usr._id
-                        deployment.name        = unicode(path_parts[2])
-                        deployment.deployment_dir = unicode(event.src_path)
-                        deployment.updated     = datetime.utcnow()
-                        deployment.save()
+    def on_created(self, event):
+        if isinstance(event, DirCreatedEvent):
+            self._deployment_dir_created(event.src_path)
 
         elif isinstance(event, FileCreatedEvent):
-            if self.base not in event.src_path:
+            if os.path.basename(event.src_path) == "wmoid.txt":
+                self._wmoid_written(event.src_path)
+            else:
+                self._publish_file(event.src_path)
+                self._queue_metadata(event.src_path)
+
+    def _deployment_dir_created(self, path):
+        """
+        Adds a deployment for a new directory user/upload/deployment-name, unless
+        the web app made it for a deployment it just saved.
+        """
+        if self.base not in path:
+            return
+
+        rel_path = os.path.relpath(path, self.base)
+
+        # we only care about this path if it's under a user dir
+        # user/upload/deployment-name
+        path_parts = rel_path.split(os.sep)
+
+        if len(path_parts) != 3:
+            return
+
+        # the web app creates deployment directories under a hidden name
+        # and renames them into place (see Deployment.sync)
+        if path_parts[2].startswith('.'):
+            return
+
+        if self._is_self_write(path):
+            return
+
+        logger.info("New deployment directory: %s", rel_path)
+
+        with app.app_context():
+            self.metrics.inc('mongo_round_trips_total', op='deployments.find_one')
+            deployment = db.Deployment.find_one({'deployment_dir':path})
+            if deployment is None:
+                deployment             = db.Deployment()
+
+                self.metrics.inc('mongo_round_trips_total', op='users.find_one')
+                usr = db.User.find_one( { 'username' : unicode(path_parts[0]) } )
+                if hasattr(usr, '_id'):
+                    deployment.user_id     = usr._id
+                    deployment.name        = unicode(path_parts[2])
+                    deployment.deployment_dir = unicode(path)
+                    deployment.updated     = datetime.utcnow()
+                    self.metrics.inc('mongo_round_trips_total', op='deployments.save')
+                    deployment.save()
+                    self._publish_deployment(deployment)
+
+    def _wmoid_written(self, path):
+        """
+        Updates the deployment's WMO ID from a new wmoid.txt, unless the web app
+        wrote it from the deployment's own value.
+        """
+        if self.base not in path:
+            return
+
+        if self._is_self_write(path):
+            return
+
+        dirpath = os.path.dirname(path)
+        rel_path = os.path.relpath(path, self.base)
+        logger.info("New wmoid.txt in %s", rel_path)
+
+        with app.app_context():
+            self.metrics.inc('mongo_round_trips_total', op='deployments.find_one')
+            deployment = db.Deployment.find_one({'deployment_dir':dirpath})
+            if deployment is None:
+                logger.error("Cannot find deployment for %s", dirpath)
                 return
 
-            path_parts = os.path.split(event.src_path)
+            if deployment.wmo_id:
+                logger.info("Deployment already has wmoid %s.  Updating value with new file.", deployment.wmo_id)
 
-            if path_parts[-1] != "wmoid.txt":
-                return
-
-            rel_path = os.path.relpath(event.src_path, self.base)
-            logger.info("New wmoid.txt in %s", rel_path)
+            with open(path) as wf:
+                deployment.wmo_id = unicode(wf.readline().strip())
 
-            with app.app_context():
-                deployment = db.Deployment.find_one({'deployment_dir':path_parts[0]})
-                if deployment is None:
-                    logger.error("Cannot find deployment for %s", path_parts[0])
-                    return
-
-                if deployment.wmo_id:
-                    logger.info("Deployment already has wmoid %s.  Updating value with new file.", deployment.wmo_id)
-
-                with open(event.src_path) as wf:
-                    deployment.wmo_id = unicode(wf.readline().strip())
-
-                deployment.updated     = datetime.utcnow()
-                deployment.save()
+            deployment.updated     = datetime.utcnow()
+            self.metrics.inc('mongo_round_trips_total', op='deployments.save')
+            deployment.save()
+            self._publish_deployment(deployment)
 
     def on_deleted(self, event):
-        if isinstance(event, DirDeletedEvent):
+        if isinstance(event, FileDeletedEvent):
+            if self.file_metadata is not None and event.src_path.endswith(".nc"):
+                with app.app_context():
+                    self.file_metadata.remove(event.src_path)
+
+        elif isinstance(event, DirDeletedEvent):
             if self.base not in event.src_path:
                 return
 
@@ -97,20 +278,31 @@ class HandleDeploymentDB(FileSystemEventHandler):
             logger.info("Removed deployment directory: %s", rel_path)
 
             with app.app_context():
+                self.metrics.inc('mongo_round_trips_total', op='deployments.find_one')
                 deployment = db.Deployment.find_one({'deployment_dir':event.src_path})
                 if deployment:
+                    self.metrics.inc('mongo_round_trips_total', op='deployments.delete')
                     deployment.delete()
 
-def main(handler):
+def main(handler, metrics_port=None, metrics_file=None, metrics_interval=15):
     observer = Observer()
     observer.schedule(handler, path=handler.base, recursive=True)
     observer.start()
 
     logger.info("Watching user directories in %s", handler.base)
 
+    if metrics_port is not None:
+        handler.metrics.serve(metrics_port)
+        logger.info("Serving metrics on port %d", metrics_port)
+
     try:
+        last_report = 0
         while True:
             time.sleep(1)
+            handler.index_pending()
+            if time.time() - last_report >= metrics_interval:
+                report_metrics(handler.metrics, observer, metrics_file)
+                last_report = time.time()
     except KeyboardInterrupt:
         observer.stop()
 
@@ -121,9 +313,24 @@ if __name__ == "__main__":
     parser.add_argument('basedir',
                         default=os.environ.get('DATA_ROOT', '.'),
                         nargs='?')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus format metrics on this local port')
+    parser.add_argument('--metrics-file',
+                        help='Periodically rewrite this file with the metrics')
+    parser.add_argument('--metrics-interval', type=int, default=15,
+                        help='Seconds between metrics file/rate updates')
 
     args = parser.parse_args()
 
     base = os.path.realpath(args.basedir)
-    main(HandleDeploymentDB(base))
+
+    with app.app_context():
+        WriteFingerprints(db.self_writes).ensure_index()
+        file_events   = FileEvents(db.file_events)
+        file_events.ensure_capped()
+        file_metadata = FileMetadata(db.file_metadata)
+        file_metadata.ensure_indexes()
+
+    main(HandleDeploymentDB(base, Metrics('glider_db_sync'), file_events, file_metadata),
+         args.metrics_port, args.metrics_file, args.metrics_interval)
 
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Writes every deployment and its files as newline delimited JSON, one deployment
+per line, for mirrors and audits. Deployments are streamed from the database so
+the size of the archive doesn't matter.
+
+The updated_since to pass next time for an incremental export is printed to
+stderr.
+
+Usage:
+    ./glider_dac_export.py -o deployments.ndjson
+    ./glider_dac_export.py --updated-since 2014-06-01T00:00:00Z > changed.ndjson
+"""
+import sys
+import argparse
+from datetime import datetime
+
+from glider_dac import app
+from glider_dac.views.api import export_deployments, parse_datetime, serialize_date, APIError
+
+def main(output, updated_since=None, files=True):
+    # anything updated once the export starts is picked up by the next one
+    next_updated_since = serialize_date(datetime.utcnow())
+
+    with app.app_context():
+        count = 0
+        for line in export_deployments(updated_since, files):
+            output.write(line)
+            count += 1
+
+    print >>sys.stderr, "Exported %d deployments, next --updated-since %s" % (count, next_updated_since)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updated-since', help='Only deployments updated since this ISO 8601 time')
+    parser.add_argument('--no-files', action='store_true', help='Leave out the file listings')
+    parser.add_argument('-o', '--output', help='File to write to (default stdout)')
+    args = parser.parse_args()
+
+    updated_since = None
+    if args.updated_since:
+        try:
+            updated_since = parse_datetime(args.updated_since)
+        except APIError as e:
+            parser.error(e.message)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        main(output, updated_since, not args.no_files)
+    finally:
+        if args.output:
+            output.close()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Fills the file_metadata collection (see glider_util.nc_metadata) with the
+NetCDF files already in the deployment directories, and adds them to their
+deployment's extent and profile count. glider_dac_db_sync.py keeps both current
+as new files arrive; run this once after installing it, or at any time to catch
+up. Files whose size and mtime match their record aren't opened, so a rerun only
+reads what changed.
+
+Extents only ever grow as files are added. After files have been deleted or
+replaced, --rebuild recomputes them from the records, still without reopening
+unchanged files.
+
+Usage:
+    ./glider_dac_index_metadata.py [DATA_ROOT] [--prune] [--rebuild]
+"""
+import os
+import logging
+import argparse
+from datetime import datetime
+
+from glider_dac import app, db
+from glider_util.nc_metadata import FileMetadata, EXTENT_FIELDS, publish_catalog_updates
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(asctime)s | %(levelname)s]  %(message)s')
+logger = logging.getLogger(__name__)
+
+def netcdf_files(base):
+    """
+    Yields (deployment_dir, path) of the NetCDF files in base/user/upload/deployment-name.
+    """
+    for username in sorted(os.listdir(base)):
+        upload = os.path.join(base, username, 'upload')
+        if not os.path.isdir(upload):
+            continue
+        for name in sorted(os.listdir(upload)):
+            deployment_dir = os.path.join(upload, name)
+            if not os.path.isdir(deployment_dir):
+                continue
+            for filename in sorted(os.listdir(deployment_dir)):
+                if filename.endswith('.nc') and not filename.startswith('.'):
+                    yield deployment_dir, os.path.join(deployment_dir, filename)
+
+def main(base, prune=False, rebuild=False):
+    started = datetime.utcnow()
+    counts = {'read': 0, 'unchanged': 0, 'errors': 0, 'pruned': 0}
+    seen = set()
+    changed = {}
+
+    with app.app_context():
+        file_metadata = FileMetadata(db.file_metadata)
+        file_metadata.ensure_indexes()
+        deployment_ids = dict((d['deployment_dir'], d['_id'])
+                              for d in db.deployments.find({}, {'deployment_dir': 1}))
+
+        if rebuild:
+            db.deployments.update({'deployment_dir': {'$in': deployment_ids.keys()}},
+                                  {'$unset': dict((f, 1) for f in EXTENT_FIELDS)}, multi=True)
+            db.file_metadata.update({}, {'$unset': {'counted': 1}}, multi=True)
+
+        for deployment_dir, path in netcdf_files(base):
+            seen.add(path)
+            record = file_metadata.update(path, deployment_ids.get(deployment_dir))
+            if record is None:
+                continue
+            if 'error' in record:
+                counts['errors'] += 1
+                continue
+
+            if record['indexed'] >= started:
+                counts['read'] += 1
+            else:
+                counts['unchanged'] += 1
+                # already part of its deployment's extent
+                if record.get('counted'):
+                    continue
+
+            deployment = file_metadata.add_to_deployment(record, db.deployments)
+            if deployment is not None:
+                changed[deployment['_id']] = deployment
+
+        publish_catalog_updates(changed.values(), db.catalog_events)
+
+        if prune:
+            for record in db.file_metadata.find({}, {'_id': 1}):
+                if record['_id'].startswith(base) and record['_id'] not in seen:
+                    file_metadata.remove(record['_id'])
+                    counts['pruned'] += 1
+
+    logger.info("Read %(read)d files, %(unchanged)d unchanged, %(errors)d unreadable, %(pruned)d records pruned", counts)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('basedir',
+                        default=os.environ.get('DATA_ROOT', '.'),
+                        nargs='?')
+    parser.add_argument('--prune', action='store_true',
+                        help='Remove the records of files no longer under basedir')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Recompute the extents of the deployments under basedir')
+    args = parser.parse_args()
+
+    main(os.path.realpath(args.basedir), args.prune, args.rebuild)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Sends the mail the web app queues in the mail_outbox collection (see
+glider_dac.glider_emails.queue_email), one SMTP connection per batch, retrying
+messages the server doesn't take with an exponential backoff.
+
+For local testing, run a debugging SMTP server that prints what it receives:
+    python -m smtpd -n -c DebuggingServer localhost:1025
+    MAIL_SERVER=localhost MAIL_PORT=1025 MAIL_USE_TLS= ./glider_dac_mailer.py --once
+"""
+import time
+import logging
+import argparse
+
+from glider_dac import app
+from glider_dac.glider_emails import send_outbox
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(asctime)s | %(levelname)s]  %(message)s')
+logger = logging.getLogger(__name__)
+
+def main(interval, once=False, **options):
+    logger.info("Sending queued mail every %ds", interval)
+
+    while True:
+        with app.app_context():
+            while True:
+                sent, failed = send_outbox(**options)
+                if sent or failed:
+                    logger.info("Sent %d messages, %d failed", sent, failed)
+                # a full batch means there may be more waiting
+                if sent + failed < options['batch_size']:
+                    break
+
+        if once:
+            return
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--interval', type=int, default=10,
+                        help='Seconds between checks of the outbox')
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help='Messages sent per SMTP connection')
+    parser.add_argument('--backoff', type=int, default=60,
+                        help='Seconds before the first retry of a failed message, doubled on each failure')
+    parser.add_argument('--max-backoff', type=int, default=3600)
+    parser.add_argument('--max-attempts', type=int, default=10,
+                        help='Attempts before a message is marked failed')
+    parser.add_argument('--once', action='store_true', help='Send what is due and exit')
+
+    args = parser.parse_args()
+    main(args.interval, args.once,
+         batch_size=args.batch_size, backoff=args.backoff,
+         max_backoff=args.max_backoff, max_attempts=args.max_attempts)
@@ -0,0 +1,166 @@
+import time
+import struct
+import tarfile
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+class Member(object):
+    """
+    A file in an archive: either the file at path, or data held in memory.
+    """
+    def __init__(self, name, mtime, path=None, size=None, data=None):
+        self.name  = name.encode('utf-8') if isinstance(name, unicode) else name
+        self.mtime = int(mtime)
+        self.path  = path
+        self.data  = data
+        self.size  = len(data) if data is not None else size
+
+    def read(self, offset=0, length=None):
+        """
+        Yields the member's bytes from offset, length of them (default the rest).
+        If the file shrank since it was listed the missing bytes are zeros, so
+        the archive keeps the size it was announced with.
+        """
+        if length is None:
+            length = self.size - offset
+
+        if self.data is not None:
+            yield self.data[offset:offset + length]
+            return
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+
+        while length > 0:
+            chunk = min(CHUNK_SIZE, length)
+            length -= chunk
+            yield '\0' * chunk
+
+class TarStream(object):
+    """
+    A tar archive of members that is never built: the layout (headers, file data,
+    padding) is computed up front, so the total size is known and any byte range
+    can be produced straight from the files, e.g. to resume a download.
+    """
+    def __init__(self, members):
+        self.segments = []
+        offset = 0
+        for m in members:
+            info = tarfile.TarInfo(m.name)
+            info.size  = m.size
+            info.mtime = m.mtime
+            info.mode  = 0644
+            header = info.tobuf(format=tarfile.GNU_FORMAT)
+
+            padding = (tarfile.BLOCKSIZE - m.size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE
+            for segment in (Member('', 0, data=header), m, Member('', 0, data='\0' * padding)):
+                if segment.size:
+                    self.segments.append((offset, segment))
+                    offset += segment.size
+
+        # end of archive marker
+        self.segments.append((offset, Member('', 0, data='\0' * tarfile.BLOCKSIZE * 2)))
+        self.size = offset + tarfile.BLOCKSIZE * 2
+
+    def iter_range(self, start=0, stop=None):
+        """
+        Yields bytes start up to stop (default the end) of the archive.
+        """
+        if stop is None:
+            stop = self.size
+
+        for offset, segment in self.segments:
+            end = offset + segment.size
+            if end <= start:
+                continue
+            if offset >= stop:
+                break
+            skip = max(start - offset, 0)
+            for chunk in segment.read(skip, min(end, stop) - offset - skip):
+                yield chunk
+
+    def __iter__(self):
+        return self.iter_range()
+
+class ZipStream(object):
+    """
+    A zip archive of members (stored, not compressed) written as it is read.
+
+    Each file's CRC is only known once it has been read, so it follows the data
+    in a data descriptor, and the central directory is written at the end. That
+    rules out starting part way through, so unlike TarStream there is no range
+    support. Archives over 4GB get zip64 records; single files over 4GB are not
+    supported.
+    """
+    ZIP64_LIMIT = 0xFFFFFFFF
+    # stands in for a value held in a zip64 field instead
+    ZIP64_MARKER = 0xFFFFFFFF
+
+    def __init__(self, members):
+        self.members = members
+        for m in members:
+            if m.size >= self.ZIP64_MARKER:
+                raise ValueError("%s is too large for a zip archive" % m.name)
+
+    @staticmethod
+    def _dos_time(mtime):
+        t = time.localtime(mtime)
+        if t.tm_year < 1980:
+            return 0, (0 << 9) | (1 << 5) | 1
+        return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+                ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+    def __iter__(self):
+        # data descriptor follows, names are utf-8
+        flags = 0x08 | 0x800
+        offset = 0
+        directory = []
+
+        for m in self.members:
+            mod_time, mod_date = self._dos_time(m.mtime)
+            header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, 0, mod_time, mod_date,
+                                 0, 0, 0, len(m.name), 0) + m.name
+            yield header
+
+            crc = 0
+            for chunk in m.read():
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+            crc &= 0xFFFFFFFF
+
+            yield struct.pack('<IIII', 0x08074b50, crc, m.size, m.size)
+
+            directory.append((m, mod_time, mod_date, crc, offset))
+            offset += len(header) + m.size + 16
+
+        directory_offset = offset
+        directory_size = 0
+        for m, mod_time, mod_date, crc, local_offset in directory:
+            extra = ''
+            if local_offset >= self.ZIP64_LIMIT:
+                extra = struct.pack('<HHQ', 0x0001, 8, local_offset)
+                local_offset = self.ZIP64_MARKER
+            entry = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 45, 45 if extra else 20, flags, 0,
+                                mod_time, mod_date, crc, m.size, m.size, len(m.name), len(extra), 0, 0, 0,
+                                0100644 << 16, local_offset) + m.name + extra
+            directory_size += len(entry)
+            yield entry
+
+        count = len(directory)
+        if count >= 0xFFFF or directory_offset >= self.ZIP64_LIMIT or directory_size >= self.ZIP64_LIMIT:
+            zip64_offset = directory_offset + directory_size
+            yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0,
+                              count, count, directory_size, directory_offset)
+            yield struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1)
+            count = min(count, 0xFFFF)
+            directory_size = min(directory_size, self.ZIP64_MARKER)
+            directory_offset = self.ZIP64_MARKER
+
+        yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, directory_size, directory_offset, 0)
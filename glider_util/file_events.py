@@ -0,0 +1,87 @@
+import time
+from datetime import datetime
+
+from pymongo.errors import CollectionInvalid
+
+class FileEvents(object):
+    """
+    A feed of new files and deployment updates, for pages that show them live.
+
+    glider_dac_db_sync.py publishes an event whenever a file lands in a deployment
+    directory or it updates a deployment, and the web app's /events stream tails
+    them with a tailable cursor, so browsers are pushed new rows instead of
+    reloading pages that walk the whole data root.
+
+    Backed by a capped MongoDB collection: old events fall off the end by
+    themselves and readers wait on the server for new ones rather than polling.
+    """
+    SIZE_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def ensure_capped(self):
+        """
+        Creates the capped collection unless it exists. Called once at startup
+        (see glider_dac and glider_dac_db_sync.py) rather than per stream, and
+        before anything is published, as an insert would create it uncapped.
+        """
+        try:
+            self._collection.database.create_collection(self._collection.name,
+                                                        capped=True, size=self.SIZE_BYTES)
+        except CollectionInvalid:
+            # already there
+            pass
+
+    def publish(self, kind, deployment, **details):
+        event = dict(details,
+                     type          = kind,
+                     deployment_id = deployment._id,
+                     deployment    = deployment.name,
+                     username      = deployment.username,
+                     created       = datetime.utcnow())
+        self._collection.insert(event)
+        return event
+
+    def newest(self):
+        """
+        The _id of the newest event, or None.
+        """
+        event = self._collection.find_one({}, {'_id': 1}, sort=[('$natural', -1)])
+        if event is not None:
+            return event['_id']
+
+    def tail(self, query=None, after=None, heartbeat=15, retry=1, until=None):
+        """
+        Yields the events matching query published after the event with _id after
+        (all retained events if after is None) as they arrive, and None after
+        heartbeat seconds without any so callers get a chance to write to, and
+        notice, a closed connection. Stops at time until, if given.
+        """
+        last_yield = time.time()
+
+        while until is None or time.time() < until:
+            spec = dict(query or {})
+            if after is not None:
+                spec['_id'] = {'$gt': after}
+
+            # blocks on the server for a while when there is nothing new
+            cursor = self._collection.find(spec, tailable=True, await_data=True)
+            while cursor.alive and (until is None or time.time() < until):
+                try:
+                    event = cursor.next()
+                except StopIteration:
+                    if time.time() - last_yield >= heartbeat:
+                        last_yield = time.time()
+                        yield None
+                    continue
+
+                after = event['_id']
+                last_yield = time.time()
+                yield event
+
+            # the cursor dies if the collection is empty or wrapped past it
+            if time.time() - last_yield >= heartbeat:
+                last_yield = time.time()
+                yield None
+            time.sleep(retry)
@@ -0,0 +1,86 @@
+import os
+import hashlib
+from datetime import datetime
+
+class WriteFingerprints(object):
+    """
+    A record of the files and directories the web app itself writes into the
+    deployment tree.
+
+    Deployment.sync() writes wmoid.txt and deployment.json into the same directories
+    glider_dac_db_sync.py watches. Each write is fingerprinted here (path, inode, mtime
+    and content hash) so the daemon can tell an echo of the app's own write from a
+    file a user uploaded and skip it, instead of saving the deployment all over again.
+
+    Backed by a MongoDB collection so it is shared by every web worker and the daemon.
+    """
+    # fingerprints only need to outlive the filesystem event they describe
+    EXPIRE_SECONDS = 24 * 60 * 60
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def ensure_index(self):
+        """
+        Creates the index that expires old fingerprints. Called once at startup
+        (see glider_dac and glider_dac_db_sync.py) rather than per write.
+        """
+        self._collection.ensure_index('recorded', expireAfterSeconds=self.EXPIRE_SECONDS)
+
+    @classmethod
+    def fingerprint(cls, path):
+        """
+        Returns the fingerprint of a path as a dict.
+
+        Directories are identified by inode alone, as their mtime changes whenever the
+        app writes a file inside them.
+        """
+        st = os.stat(path)
+        fp = {'inode': st.st_ino}
+
+        if os.path.isfile(path):
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    md5.update(chunk)
+
+            fp['mtime'] = st.st_mtime
+            fp['md5']   = md5.hexdigest()
+
+        return fp
+
+    def record(self, path, source=None):
+        """
+        Records the fingerprint of path, or of source if given: a file about to be
+        renamed to path, which keeps its inode and mtime. Recording before the
+        rename means the fingerprint is there before any event for path.
+        """
+        fp = self.fingerprint(source or path)
+        fp['recorded'] = datetime.utcnow()
+        self._collection.update({'_id': path}, {'$set': fp}, upsert=True)
+
+    def matches(self, path):
+        """
+        True if path is still exactly as the app last wrote it.
+
+        The cheap stat fields are compared first so a mismatch never reads the file.
+        """
+        rec = self._collection.find_one({'_id': path})
+        if rec is None:
+            return False
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        if rec.get('inode') != st.st_ino:
+            return False
+
+        if 'mtime' not in rec:
+            return True
+
+        if rec['mtime'] != st.st_mtime:
+            return False
+
+        return self.fingerprint(path).get('md5') == rec.get('md5')
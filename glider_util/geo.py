@@ -0,0 +1,79 @@
+import re
+
+# spacing, in degrees, of the points added along the edges of boxes; 2dsphere
+# polygon edges are great circles, so a box given only by its corners bulges
+# away from the parallels its top and bottom edges should follow
+DENSIFY_DEGREES = 1.0
+
+_WKT = re.compile(r'^\s*(POINT|LINESTRING|POLYGON)\s*\((.*)\)\s*$', re.IGNORECASE | re.DOTALL)
+
+def _position(text):
+    values = text.split()
+    if len(values) < 2:
+        raise ValueError("Bad coordinate '%s'" % text)
+    lon, lat = float(values[0]), float(values[1])
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        raise ValueError("Coordinate out of range '%s'" % text)
+    return [lon, lat]
+
+def _positions(text):
+    return [_position(p) for p in text.split(',')]
+
+def wkt_to_geojson(wkt):
+    """
+    The GeoJSON geometry of a WKT POINT, LINESTRING or POLYGON (lon lat order),
+    or None for empty text. Raises ValueError for anything else.
+    """
+    if wkt is None or not wkt.strip():
+        return None
+
+    match = _WKT.match(wkt)
+    if match is None:
+        raise ValueError("Unsupported WKT '%s'" % wkt)
+    kind, body = match.group(1).upper(), match.group(2)
+
+    if kind == 'POINT':
+        return {'type': 'Point', 'coordinates': _position(body)}
+    if kind == 'LINESTRING':
+        return {'type': 'LineString', 'coordinates': _positions(body)}
+
+    rings = [_positions(ring) for ring in re.findall(r'\(([^()]*)\)', body)]
+    if not rings:
+        raise ValueError("Unsupported WKT '%s'" % wkt)
+    for ring in rings:
+        if ring[0] != ring[-1]:
+            ring.append(ring[0])
+    return {'type': 'Polygon', 'coordinates': rings}
+
+def _steps(start, stop):
+    """
+    start up to (not including) stop, DENSIFY_DEGREES apart.
+    """
+    count = max(int(abs(stop - start) / DENSIFY_DEGREES), 1)
+    return [start + (stop - start) * i / float(count) for i in range(count)]
+
+def _wrap(lon):
+    return lon - 360 if lon > 180 else lon
+
+def bbox_geometry(lon_min, lat_min, lon_max, lat_max):
+    """
+    The GeoJSON geometry covering a lon/lat box: a Polygon with points along its
+    edges, or a Point or LineString if the box has no width or height. A box
+    with lon_min > lon_max crosses the antimeridian.
+    """
+    if lon_max < lon_min:
+        lon_max += 360
+    if lon_max - lon_min >= 180:
+        raise ValueError("Boxes must be less than 180 degrees wide")
+
+    if lon_min == lon_max and lat_min == lat_max:
+        return {'type': 'Point', 'coordinates': [_wrap(lon_min), lat_min]}
+    if lon_min == lon_max or lat_min == lat_max:
+        return {'type': 'LineString', 'coordinates': [[_wrap(lon_min), lat_min], [_wrap(lon_max), lat_max]]}
+
+    ring  = [[lon, lat_min] for lon in _steps(lon_min, lon_max)]
+    ring += [[lon_max, lat] for lat in _steps(lat_min, lat_max)]
+    ring += [[lon, lat_max] for lon in _steps(lon_max, lon_min)]
+    ring += [[lon_min, lat] for lat in _steps(lat_max, lat_min)]
+    ring.append(ring[0])
+    return {'type': 'Polygon', 'coordinates': [[[_wrap(lon), lat] for lon, lat in ring]]}
@@ -0,0 +1,182 @@
+import os
+import time
+import threading
+import BaseHTTPServer
+
+# seconds; handler latencies are usually well under a second but perms_monitor sleeps
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# seconds between a file's mtime and the daemon getting to it
+LAG_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+
+class Metrics(object):
+    """
+    A small, thread safe registry of counters, gauges and histograms for the
+    filesystem watcher daemons.
+
+    Rendered in the Prometheus text exposition format, either served over HTTP on a
+    local port or periodically written to a stats file (or both).
+    """
+    def __init__(self, prefix):
+        self.prefix      = prefix
+        self._lock       = threading.Lock()
+        self._types      = {}
+        self._values     = {}
+        self._buckets    = {}
+        self._last_tick  = None
+        self._last_count = {}
+
+    def _key(self, labels):
+        return tuple(sorted(labels.iteritems()))
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._types.setdefault(name, 'counter')
+            series = self._values.setdefault(name, {})
+            key = self._key(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._types.setdefault(name, 'gauge')
+            self._values.setdefault(name, {})[self._key(labels)] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        with self._lock:
+            self._types.setdefault(name, 'histogram')
+            buckets = self._buckets.setdefault(name, tuple(buckets))
+            series = self._values.setdefault(name, {})
+            key = self._key(labels)
+            if key not in series:
+                series[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+
+            h = series[key]
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    h['buckets'][i] += 1
+            h['sum']   += value
+            h['count'] += 1
+
+    def tick(self):
+        """
+        Derives a <counter>_per_second gauge for every counter from how much it grew
+        since the last tick. Call periodically from the daemon's main loop.
+        """
+        now = time.time()
+        with self._lock:
+            counters = dict((name, dict(series)) for name, series in self._values.iteritems()
+                            if self._types[name] == 'counter')
+
+        if self._last_tick is not None and now > self._last_tick:
+            elapsed = now - self._last_tick
+            for name, series in counters.iteritems():
+                previous = self._last_count.get(name, {})
+                for key, value in series.iteritems():
+                    rate = (value - previous.get(key, 0)) / elapsed
+                    self.set('%s_per_second' % name, rate, **dict(key))
+
+        self._last_tick  = now
+        self._last_count = counters
+
+    def _format_labels(self, key, extra=None):
+        labels = list(key)
+        if extra is not None:
+            labels.append(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self._values):
+                full_name = '%s_%s' % (self.prefix, name)
+                kind      = self._types[name]
+                lines.append('# TYPE %s %s' % (full_name, kind))
+
+                for key, value in sorted(self._values[name].iteritems()):
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (full_name, self._format_labels(key), value))
+                        continue
+
+                    for le, count in zip(self._buckets[name], value['buckets']):
+                        lines.append('%s_bucket%s %d' % (full_name, self._format_labels(key, ('le', le)), count))
+                    lines.append('%s_bucket%s %d' % (full_name, self._format_labels(key, ('le', '+Inf')), value['count']))
+                    lines.append('%s_sum%s %s' % (full_name, self._format_labels(key), value['sum']))
+                    lines.append('%s_count%s %d' % (full_name, self._format_labels(key), value['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Atomically replaces the stats file at path with the current metrics.
+        """
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serves the metrics on http://host:port/metrics from a background thread.
+        """
+        metrics = self
+
+        class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), MetricsRequestHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return server
+
+class InstrumentedHandlerMixin(object):
+    """
+    Mixin for watchdog event handlers that records, per event type, the event rate,
+    the lag between the file's mtime and its processing, and the handler latency.
+
+    Mix in ahead of FileSystemEventHandler and set self.metrics.
+    """
+    metrics = None
+
+    def dispatch(self, event):
+        self.metrics.inc('events_total', type=event.event_type)
+
+        try:
+            lag = time.time() - os.path.getmtime(event.src_path)
+            self.metrics.observe('event_lag_seconds', max(lag, 0), buckets=LAG_BUCKETS, type=event.event_type)
+        except OSError:
+            # already gone, e.g. deleted events
+            pass
+
+        start = time.time()
+        try:
+            super(InstrumentedHandlerMixin, self).dispatch(event)
+        finally:
+            self.metrics.observe('handler_latency_seconds', time.time() - start, type=event.event_type)
+
+def report_metrics(metrics, observer, metrics_file=None):
+    """
+    Periodic bookkeeping for a daemon's main loop: event rates, the observer's
+    pending event queue depth and, if configured, the stats file.
+    """
+    try:
+        metrics.set('queue_depth', observer.event_queue.qsize())
+    except AttributeError:
+        pass
+
+    metrics.tick()
+
+    if metrics_file is not None:
+        metrics.write(metrics_file)
@@ -0,0 +1,378 @@
+import os
+import logging
+import multiprocessing
+from datetime import datetime
+from contextlib import closing
+
+import pymongo
+
+from glider_util.geo import bbox_geometry
+
+try:
+    import numpy
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+logger = logging.getLogger(__name__)
+
+# coordinate variables are found by standard_name, or failing that by name
+TIME_NAMES = ('time',)
+LAT_NAMES  = ('lat', 'latitude')
+LON_NAMES  = ('lon', 'longitude')
+
+# the fields of a deployment kept by FileMetadata.add_to_deployment
+EXTENT_FIELDS = ('time_coverage_start', 'time_coverage_end', 'lat_min', 'lat_max',
+                 'lon_min', 'lon_max', 'last_position', 'profile_count')
+
+# in the order bbox_geometry takes them
+BBOX_FIELDS = ('lon_min', 'lat_min', 'lon_max', 'lat_max')
+
+# variable attributes worth keeping; the rest stay in the file
+VARIABLE_ATTRIBUTES = ('units', 'standard_name', 'long_name')
+
+def _plain(value):
+    """
+    value as something BSON can store: numpy scalars and arrays become Python
+    numbers and lists, byte strings become unicode.
+    """
+    if isinstance(value, numpy.ndarray):
+        value = value.tolist()
+        return value[0] if len(value) == 1 else [_plain(v) for v in value]
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def _key(name):
+    # mongo keys can't contain dots or start with $
+    return name.replace('.', '_').lstrip('$')
+
+def _coordinates(nc, standard_name, names):
+    for name, var in nc.variables.iteritems():
+        if getattr(var, 'standard_name', None) == standard_name or name in names:
+            yield var
+
+def _bounds(variables):
+    """
+    (min, max) over the valid values of variables, or (None, None).
+    """
+    low = high = None
+    for var in variables:
+        values = numpy.ma.masked_invalid(var[:])
+        if values.count() == 0:
+            continue
+        vmin, vmax = values.min(), values.max()
+        low  = vmin if low is None else min(low, vmin)
+        high = vmax if high is None else max(high, vmax)
+    if low is None:
+        return None, None
+    return float(low), float(high)
+
+def _to_datetime(value, var):
+    # num2date gives cftime dates on newer netCDF4, so rebuild a datetime
+    d = netCDF4.num2date(value, var.units, getattr(var, 'calendar', 'standard'))
+    return datetime(d.year, d.month, d.day, d.hour, d.minute, d.second)
+
+def _last_position(times, lats, lons):
+    """
+    {'time', 'lat', 'lon'} at the latest time where a time variable and a
+    latitude and longitude variable along the same dimensions are all valid, or
+    None.
+    """
+    last = None
+    for t in times:
+        for lat in lats:
+            for lon in lons:
+                if not (t.dimensions == lat.dimensions == lon.dimensions):
+                    continue
+                tv, yv, xv = [numpy.ma.masked_invalid(numpy.ma.atleast_1d(v[:])).ravel() for v in (t, lat, lon)]
+                valid = ~(numpy.ma.getmaskarray(tv) | numpy.ma.getmaskarray(yv) | numpy.ma.getmaskarray(xv))
+                if not valid.any():
+                    continue
+                i = numpy.flatnonzero(valid)[numpy.argmax(tv.data[valid])]
+                when = _to_datetime(float(tv.data[i]), t)
+                if last is None or when > last['time']:
+                    last = {'time': when, 'lat': float(yv.data[i]), 'lon': float(xv.data[i])}
+    return last
+
+def _profile_count(nc):
+    """
+    Profiles in the file: the length of a profile dimension, else the number of
+    profile_time values, else one.
+    """
+    if 'profile' in nc.dimensions:
+        return len(nc.dimensions['profile'])
+    if 'profile_time' in nc.variables:
+        return max(nc.variables['profile_time'].size, 1)
+    return 1
+
+def read_header(path):
+    """
+    Metadata of the NetCDF file at path: its format, dimensions, variables and
+    global attributes from the header, and the time, latitude and longitude
+    ranges, the last position and the number of profiles from the coordinate
+    variables. No other variable is read.
+    """
+    if netCDF4 is None:
+        raise RuntimeError("netCDF4 is not installed")
+
+    with closing(netCDF4.Dataset(path)) as nc:
+        times = [v for v in _coordinates(nc, 'time', TIME_NAMES) if hasattr(v, 'units')]
+        time_min, time_max = None, None
+        for var in times:
+            low, high = _bounds([var])
+            if low is None:
+                continue
+            try:
+                low, high = _to_datetime(low, var), _to_datetime(high, var)
+            except ValueError as e:
+                logger.warning("Ignoring %s in %s: %s", var.name, path, e)
+                continue
+            time_min = low if time_min is None else min(time_min, low)
+            time_max = high if time_max is None else max(time_max, high)
+
+        lats = list(_coordinates(nc, 'latitude', LAT_NAMES))
+        lons = list(_coordinates(nc, 'longitude', LON_NAMES))
+        lat_min, lat_max = _bounds(lats)
+        lon_min, lon_max = _bounds(lons)
+
+        variables = []
+        for name, var in nc.variables.iteritems():
+            info = {'name': name, 'dimensions': list(var.dimensions)}
+            for attr in VARIABLE_ATTRIBUTES:
+                if attr in var.ncattrs():
+                    info[attr] = _plain(var.getncattr(attr))
+            variables.append(info)
+
+        return {'format'              : nc.file_format,
+                'dimensions'          : dict((_key(name), len(dim)) for name, dim in nc.dimensions.iteritems()),
+                'variables'           : variables,
+                'attributes'          : dict((_key(name), _plain(nc.getncattr(name))) for name in nc.ncattrs()),
+                'time_coverage_start' : time_min,
+                'time_coverage_end'   : time_max,
+                'lat_min'             : lat_min,
+                'lat_max'             : lat_max,
+                'lon_min'             : lon_min,
+                'lon_max'             : lon_max,
+                'last_position'       : _last_position(times, lats, lons),
+                'profile_count'       : _profile_count(nc)}
+
+def _read_into(path, conn):
+    try:
+        conn.send((True, read_header(path)))
+    except Exception as e:
+        conn.send((False, '%s: %s' % (type(e).__name__, e)))
+
+def read_header_isolated(path, timeout=60):
+    """
+    read_header(path) run in a child process. libnetcdf aborts the whole process,
+    rather than raising, on some truncated files, and partial uploads are
+    exactly what arrives here.
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    reader = multiprocessing.Process(target=_read_into, args=(path, sender))
+    reader.start()
+    sender.close()
+
+    try:
+        if not receiver.poll(timeout):
+            reader.terminate()
+            raise RuntimeError("Timed out reading the header")
+        try:
+            ok, result = receiver.recv()
+        except EOFError:
+            reader.join()
+            raise RuntimeError("Reading the header crashed (exit code %s)" % reader.exitcode)
+    finally:
+        receiver.close()
+        reader.join()
+
+    if not ok:
+        raise RuntimeError(result)
+    return result
+
+def publish_catalog_updates(deployments, catalog_events):
+    """
+    Queues one catalog update event for each of deployments (as returned by
+    FileMetadata.add_to_deployment) for scripts/catalog_trigger.py, as
+    Deployment.publish_catalog_event does for edits.
+    """
+    now = datetime.utcnow()
+    events = [{'action'        : 'update',
+               'deployment_id' : d['_id'],
+               'name'          : d.get('name'),
+               'username'      : d.get('username'),
+               'created'       : now} for d in deployments]
+    if events:
+        catalog_events.insert(events)
+
+class FileMetadata(object):
+    """
+    An index of what is inside the NetCDF files uploaded to deployments (see
+    read_header), so questions like "which files cover this area in August" are
+    answered by a query instead of opening files.
+
+    Records are keyed by path and remember the size and mtime the file had when
+    it was read, so a file is only opened again once it has changed. A file that
+    can't be read gets a record with the error, and is tried again when it
+    changes.
+
+    glider_dac_db_sync.py keeps it up to date as files arrive;
+    glider_dac_index_metadata.py fills it in for files already there.
+    """
+    def __init__(self, collection):
+        self._collection = collection
+
+    def ensure_indexes(self):
+        """
+        Creates the indexes the queries need. Called once at startup (see
+        glider_dac, glider_dac_db_sync.py and glider_dac_index_metadata.py)
+        rather than per instance.
+        """
+        self._collection.ensure_index([('deployment_id', pymongo.ASCENDING), ('time_coverage_start', pymongo.ASCENDING)])
+        self._collection.ensure_index([('time_coverage_start', pymongo.ASCENDING), ('time_coverage_end', pymongo.ASCENDING)])
+        self._collection.ensure_index([('lat_min', pymongo.ASCENDING), ('lon_min', pymongo.ASCENDING)])
+
+    def update(self, path, deployment_id=None):
+        """
+        Reads the metadata of the file at path unless the record for its current
+        size and mtime already exists. Returns the record, or None if the file
+        is gone.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.remove(path)
+            return None
+
+        previous = self._collection.find_one({'_id': path})
+        if previous is not None and previous['size'] == st.st_size and previous['mtime'] == st.st_mtime:
+            if deployment_id is not None and previous.get('deployment_id') != deployment_id:
+                # read before its deployment was known
+                self._collection.update({'_id': path}, {'$set': {'deployment_id': deployment_id}})
+                previous['deployment_id'] = deployment_id
+            return previous
+
+        record = {'_id'           : path,
+                  'deployment_id' : deployment_id,
+                  'filename'      : os.path.basename(path),
+                  'size'          : st.st_size,
+                  'mtime'         : st.st_mtime,
+                  'indexed'       : datetime.utcnow()}
+        try:
+            record.update(read_header_isolated(path))
+        except Exception as e:
+            # e.g. a partial upload; retried once the file changes
+            logger.warning("Could not read metadata of %s: %s", path, e)
+            record['error'] = unicode(e)
+
+        # profiles already added to the deployment's count stay counted
+        if previous is not None and previous.get('counted'):
+            record['counted'] = True
+
+        self._collection.save(record)
+        return record
+
+    def add_to_deployment(self, record, deployments):
+        """
+        Widens the time coverage, bounding box (and the GeoJSON geometry searched
+        with the 2dsphere index) and last position of the record's deployment in
+        the deployments collection to take in the file, with $min/$max so
+        concurrent updates can't undo each other, and adds its profiles to the
+        deployment's profile_count the first time the file is seen. Nothing else
+        is read, so this stays cheap however many files the deployment has.
+
+        The file is marked counted before its profiles are added, in one atomic
+        find_and_modify, so a crash in between can lose the file's profiles from
+        the count (--rebuild in glider_dac_index_metadata.py restores them) but
+        never count them twice.
+
+        $min/$max set missing fields but never replace a null, so the fields
+        must never be stored as null (see Deployment).
+
+        The deployment's updated time is bumped only if one of these fields
+        actually changed, so a file read again or inside the extent doesn't move
+        it, while API clients (ETags, updated_since) still see new profiles.
+
+        Returns the deployment (_id, name and username) if the file widened its
+        time coverage or bounding box, which the catalogs carry, else None.
+        Callers queue one catalog rebuild per returned deployment once their
+        batch of files is done (see publish_catalog_updates).
+        """
+        if record.get('deployment_id') is None or 'error' in record:
+            return None
+
+        deployment_id = record['deployment_id']
+        lows  = dict((f, record[f]) for f in ('time_coverage_start', 'lat_min', 'lon_min') if record.get(f) is not None)
+        highs = dict((f, record[f]) for f in ('time_coverage_end', 'lat_max', 'lon_max') if record.get(f) is not None)
+
+        update = {}
+        if lows:
+            update['$min'] = lows
+        if highs:
+            update['$max'] = highs
+        if not record.get('counted'):
+            claimed = self._collection.find_and_modify({'_id': record['_id'], 'counted': {'$ne': True}},
+                                                       {'$set': {'counted': True}}, fields={'_id': 1})
+            record['counted'] = True
+            if claimed is not None:
+                update['$inc'] = {'profile_count': record.get('profile_count') or 0}
+        if not update:
+            return None
+
+        # the deployment as it was, to tell whether this file moved its extent
+        fields = dict((f, 1) for f in BBOX_FIELDS + ('time_coverage_start', 'time_coverage_end', 'name', 'username'))
+        before = deployments.find_and_modify({'_id': deployment_id}, update, fields=fields)
+        if before is None:
+            return None
+        after = dict(before)
+        for f, v in lows.iteritems():
+            after[f] = v if before.get(f) is None else min(v, before[f])
+        for f, v in highs.iteritems():
+            after[f] = v if before.get(f) is None else max(v, before[f])
+
+        # the searchable geometry follows the box, unless another update has
+        # already moved it on again
+        bbox = [after.get(f) for f in BBOX_FIELDS]
+        if None not in bbox and bbox != [before.get(f) for f in BBOX_FIELDS]:
+            try:
+                geometry = bbox_geometry(*bbox)
+            except ValueError as e:
+                logger.warning("No geometry for deployment %s: %s", deployment_id, e)
+            else:
+                deployments.update(dict(zip(BBOX_FIELDS, bbox), _id=deployment_id),
+                                   {'$set': {'geometry': geometry}})
+
+        moved = False
+        position = record.get('last_position')
+        if position is not None:
+            moved = deployments.update({'_id': deployment_id,
+                                        '$or': [{'last_position.time': None},
+                                                {'last_position.time': {'$lt': position['time']}}]},
+                                       {'$set': {'last_position': position}}).get('n')
+
+        extended = after != before
+        if extended or moved or update.get('$inc', {}).get('profile_count'):
+            deployments.update({'_id': deployment_id}, {'$set': {'updated': datetime.utcnow()}})
+        return before if extended else None
+
+    def remove(self, path):
+        self._collection.remove({'_id': path})
+
+    def overlapping(self, start=None, end=None, bbox=None):
+        """
+        The query for records of files with data between start and end (datetimes)
+        and inside bbox (lon_min, lat_min, lon_max, lat_max), for find().
+        """
+        query = {}
+        if start is not None:
+            query['time_coverage_end'] = {'$gte': start}
+        if end is not None:
+            query['time_coverage_start'] = {'$lte': end}
+        if bbox is not None:
+            lon_min, lat_min, lon_max, lat_max = bbox
+            query.update({'lon_max': {'$gte': lon_min}, 'lon_min': {'$lte': lon_max},
+                          'lat_max': {'$gte': lat_min}, 'lat_min': {'$lte': lat_max}})
+        return query
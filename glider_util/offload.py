@@ -0,0 +1,30 @@
+import sys
+
+def _threadpool():
+    """
+    gevent's native thread pool if the process has been monkey patched (as
+    gunicorn's gevent worker does), otherwise None.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is None or 'socket' not in getattr(monkey, 'saved', {}):
+        return None
+
+    import gevent
+    return gevent.get_hub().threadpool
+
+def offload(fn, *args, **kwargs):
+    """
+    Calls fn(*args, **kwargs) and returns its result.
+
+    Under gevent the call runs in a native thread while other greenlets keep
+    serving requests. Monkey patching makes sockets cooperative, but Berkeley DB
+    lookups, long directory walks and file hashing still block the whole worker
+    until they return. Without gevent fn is simply called.
+
+    fn runs outside the request and app context, so must not touch flask's
+    request, app.config or db.
+    """
+    pool = _threadpool()
+    if pool is None:
+        return fn(*args, **kwargs)
+    return pool.apply(fn, args, kwargs)
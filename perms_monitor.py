@@ -19,13 +19,16 @@ import grp
 from watchdog.events import FileSystemEventHandler, DirCreatedEvent, FileModifiedEvent, DirModifiedEvent
 from watchdog.observers import Observer
 
+from glider_util.metrics import Metrics, InstrumentedHandlerMixin, report_metrics
+
 logging.basicConfig(level=logging.INFO,
                     format='[%(asctime)s | %(levelname)s]  %(message)s')
 logger = logging.getLogger(__name__)
 
-class HandleDeploymentDir(FileSystemEventHandler):
-    def __init__(self, base):
-        self.base = base
+class HandleDeploymentDir(InstrumentedHandlerMixin, FileSystemEventHandler):
+    def __init__(self, base, metrics):
+        self.base    = base
+        self.metrics = metrics
 
     def _fix_perms(self, path, rel_path, username, mode):
         logger.info("New path: %s", rel_path)
@@ -78,16 +81,24 @@ class HandleDeploymentDir(FileSystemEventHandler):
         # Touch src directory so on_modified will get called
         os.utime(event.src_path, None)
 
-def main(handler):
+def main(handler, metrics_port=None, metrics_file=None, metrics_interval=15):
     observer = Observer()
     observer.schedule(handler, path=handler.base, recursive=True)
     observer.start()
 
     logger.info("Watching user directories in %s", handler.base)
 
+    if metrics_port is not None:
+        handler.metrics.serve(metrics_port)
+        logger.info("Serving metrics on port %d", metrics_port)
+
     try:
+        last_report = 0
         while True:
             time.sleep(1)
+            if time.time() - last_report >= metrics_interval:
+                report_metrics(handler.metrics, observer, metrics_file)
+                last_report = time.time()
     except KeyboardInterrupt:
         observer.stop()
 
@@ -98,9 +109,16 @@ if __name__ == "__main__":
     parser.add_argument('basedir',
                         default=os.environ.get('DATA_ROOT', '.'),
                         nargs='?')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus format metrics on this local port')
+    parser.add_argument('--metrics-file',
+                        help='Periodically rewrite this file with the metrics')
+    parser.add_argument('--metrics-interval', type=int, default=15,
+                        help='Seconds between metrics file/rate updates')
 
     args = parser.parse_args()
 
     base = os.path.realpath(args.basedir)
-    main(HandleDeploymentDir(base))
+    main(HandleDeploymentDir(base, Metrics('glider_perms_monitor')),
+         args.metrics_port, args.metrics_file, args.metrics_interval)
 
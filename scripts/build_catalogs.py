@@ -0,0 +1,607 @@
+#!/usr/bin/env python
+"""
+Builds every configured ERDDAP/THREDDS catalog from a single discovery pass.
+
+The private ERDDAP, public ERDDAP and THREDDS data roots all mirror the same
+user/deployment tree (see create_data_dirs), so deployments are discovered once,
+from the root that carries the deployment.json files, and each output renders
+that shared model against its own data root and templates.
+
+With --mongo-uri the deployment metadata comes from a single query against the
+web app's MongoDB, falling back to reading the deployment.json files.
+
+Usage:
+    ./build_catalogs.py /data/data/priv_erddap /data/catalog \
+        --priv-erddap /data/data/priv_erddap templates/erddap/templates/private \
+        --pub-erddap /data/data/pub_erddap templates/erddap/templates/public \
+        --thredds /data/data/thredds templates/thredds/templates \
+        --ncml /data/data/thredds templates/thredds/templates
+"""
+import os
+import re
+import json
+import time
+import calendar
+import hashlib
+import argparse
+import logging
+from string import Template
+
+from catalog_util import (DEFAULT_CACHE_DIR, FragmentCache, read_template, read_file,
+                          write_if_changed, make_all_dirs, slugify, touch_flags)
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(asctime)s | %(levelname)s]  %(message)s')
+logger = logging.getLogger(__name__)
+
+# the deployment's extent as kept by the web app (see FileMetadata.add_to_deployment)
+EXTENT_FIELDS = ('time_coverage_start', 'time_coverage_end', 'lat_min', 'lat_max', 'lon_min', 'lon_max')
+
+class CatalogDeployment(object):
+    """
+    What the catalog outputs need to know about a deployment.
+    """
+    def __init__(self, user, name, operator=None, username=None, wmo_id=None, mtime=None, extent=None):
+        self.user     = user
+        self.name     = name
+        self.operator = operator
+        self.username = username
+        self.wmo_id   = wmo_id
+        # deployment.json mtime (or updated time in Mongo), the fragment cache key
+        self.mtime    = mtime
+        # time coverage and bounds of the files, only known from Mongo
+        self.extent   = extent or {}
+
+    @property
+    def key(self):
+        return "%s/%s" % (self.user, self.name)
+
+    @property
+    def institution(self):
+        return self.operator or self.username or self.user
+
+    def extent_attributes(self):
+        """
+        The extent as ACDD attribute values for templates, time_coverage_start,
+        geospatial_lat_min and so on; empty where unknown.
+        """
+        attributes = {}
+        for field in EXTENT_FIELDS:
+            value = self.extent.get(field)
+            name  = field if field.startswith('time') else 'geospatial_' + field
+            if value is None:
+                attributes[name] = ''
+            elif field.startswith('time'):
+                attributes[name] = value.strftime('%Y-%m-%dT%H:%M:%SZ')
+            else:
+                attributes[name] = '%.6f' % value
+        return attributes
+
+def list_deployment_dirs(source_root):
+    """
+    Yields (user, name) for each user/deployment directory under source_root,
+    sorted, from directory listings alone.
+    """
+    for user in sorted(os.listdir(source_root)):
+        user_dir = os.path.join(source_root, user)
+        if not os.path.isdir(user_dir):
+            continue
+
+        for name in sorted(os.listdir(user_dir)):
+            if os.path.isdir(os.path.join(user_dir, name)):
+                yield user, name
+
+def discover_deployments(source_root):
+    """
+    Finds all user/deployment directories under source_root in one pass, reading
+    each deployment.json once. Returns CatalogDeployments sorted by user and name.
+    """
+    deployments = []
+
+    for user, name in list_deployment_dirs(source_root):
+        deployment = CatalogDeployment(user, name)
+        json_path  = os.path.join(source_root, user, name, "deployment.json")
+        try:
+            deployment.mtime = os.path.getmtime(json_path)
+            with open(json_path) as f:
+                js = json.load(f)
+            deployment.operator = js.get('operator')
+            deployment.username = js.get('username')
+            deployment.wmo_id   = (js.get('wmo_id') or '').strip() or None
+        except (OSError, IOError):
+            logger.debug("No deployment.json for %s", deployment.key)
+        except ValueError as e:
+            logger.warning("Could not read %s, cataloging with defaults: %s", json_path, e)
+
+        deployments.append(deployment)
+
+    logger.info("Discovered %d deployments in %s", len(deployments), source_root)
+    return deployments
+
+def discover_deployments_from_mongo(mongo_uri, source_root):
+    """
+    Loads the metadata of all deployments with one projected query against the
+    web app's deployments collection instead of opening every deployment.json.
+    """
+    import urlparse
+    import pymongo
+
+    db_name = urlparse.urlparse(mongo_uri).path[1:]
+    client  = pymongo.MongoClient(mongo_uri)
+    try:
+        return discover_deployments_from_collection(client[db_name].deployments, source_root)
+    finally:
+        client.close()
+
+def discover_deployments_from_collection(collection, source_root):
+    """
+    Builds CatalogDeployments from a deployments collection (or anything with a
+    compatible find()).
+
+    Only deployments whose directory exists under source_root are returned, so
+    the catalogs match the data actually synced to this host. The deployment's
+    updated time stands in for the deployment.json mtime as the cache key.
+    """
+    fields = dict((f, 1) for f in ('username', 'name', 'operator', 'wmo_id', 'updated', 'deployment_dir') + EXTENT_FIELDS)
+    docs   = list(collection.find({}, fields))
+
+    by_key = {}
+    for doc in docs:
+        # the DAP side mirrors user/<deployment dir name>
+        name = os.path.basename(doc.get('deployment_dir') or '') or doc.get('name')
+        if doc.get('username') and name:
+            by_key[(doc['username'], name)] = doc
+
+    deployments = []
+    for user, name in list_deployment_dirs(source_root):
+        doc = by_key.get((user, name))
+        if doc is None:
+            logger.warning("No deployment in Mongo for %s/%s, cataloging with defaults", user, name)
+            deployments.append(CatalogDeployment(user, name))
+            continue
+
+        updated = doc.get('updated')
+        deployments.append(CatalogDeployment(user, name,
+                                             operator=doc.get('operator'),
+                                             username=doc.get('username'),
+                                             wmo_id=(doc.get('wmo_id') or '').strip() or None,
+                                             mtime=calendar.timegm(updated.utctimetuple()) if updated else None,
+                                             extent=dict((f, doc[f]) for f in EXTENT_FIELDS if doc.get(f) is not None)))
+
+    logger.info("Loaded %d deployments from Mongo for %s", len(deployments), source_root)
+    return deployments
+
+def load_deployments(source_root, mongo_uri=None):
+    """
+    Deployments from Mongo if configured and reachable, otherwise from the
+    deployment.json files under source_root.
+    """
+    if mongo_uri:
+        try:
+            return discover_deployments_from_mongo(mongo_uri, source_root)
+        except Exception as e:
+            logger.warning("Could not load deployments from Mongo, falling back to %s: %s", source_root, e)
+
+    return discover_deployments(source_root)
+
+def group_by_user(deployments):
+    users = []
+    by_user = {}
+    for d in deployments:
+        if d.user not in by_user:
+            users.append(d.user)
+            by_user[d.user] = []
+        by_user[d.user].append(d)
+
+    return [(u, by_user[u]) for u in users]
+
+class CatalogOutput(object):
+    """
+    One catalog to emit: a name (its directory under the catalog root), the data
+    root its datasets point at and the directory holding its templates.
+    """
+    def __init__(self, name, data_root, template_dir):
+        self.name         = name
+        self.data_root    = data_root
+        self.template_dir = template_dir
+
+    @property
+    def catalog_dir(self):
+        """
+        Directory under the catalog root the output is written to.
+        """
+        return self.name
+
+    def _template(self, filename):
+        """
+        Reads a template, returning it along with a cache hash that also covers the
+        data root the fragments are rendered against.
+        """
+        template, template_hash = read_template(os.path.join(self.template_dir, filename))
+        return template, hashlib.md5(template_hash + self.data_root).hexdigest()
+
+    def build(self, deployments, catalog_root, cache_dir, full=False):
+        """
+        Writes the output. With full=True nothing is reused from the fragment cache.
+        """
+        raise NotImplementedError
+
+class ErddapOutput(CatalogOutput):
+    """
+    An ERDDAP datasets.xml. If the templates include dataset.agg.xml, an
+    aggregation dataset is added per user (the public ERDDAP).
+
+    Given ERDDAP's flag directory, only the datasets whose fragments were added,
+    changed or removed since the last run are flagged for reloading.
+    """
+    def __init__(self, name, data_root, template_dir, flag_dir=None):
+        super(ErddapOutput, self).__init__(name, data_root, template_dir)
+        self.flag_dir = flag_dir
+
+    def build(self, deployments, catalog_root, cache_dir, full=False):
+        head = read_file(os.path.join(self.template_dir, 'datasets.head.xml'))
+        tail = read_file(os.path.join(self.template_dir, 'datasets.tail.xml'))
+
+        template, template_hash = self._template('dataset.deployment.xml')
+
+        agg_template = None
+        if os.path.exists(os.path.join(self.template_dir, 'dataset.agg.xml')):
+            agg_template, agg_template_hash = self._template('dataset.agg.xml')
+
+        cache = FragmentCache(os.path.join(cache_dir, '%s.fragments.json' % self.name), reuse=not full)
+
+        fragments = [head]
+
+        # for each user deployment, create a dataset fragment
+        for d in deployments:
+            fragment = cache.get(d.key, d.mtime, template_hash)
+            if fragment is None:
+                fragment = self.build_fragment(d, template)
+                cache.put(d.key, d.mtime, template_hash, fragment, d.name)
+
+            fragments.append(fragment)
+
+        # if we have an "agg" file in our templates, fill one out per user
+        if agg_template is not None:
+            for user, user_deployments in group_by_user(deployments):
+                key   = "agg:%s" % user
+                first = user_deployments[0]
+
+                fragment = cache.get(key, first.mtime, agg_template_hash)
+                if fragment is None:
+                    fragment = self.build_agg_fragment(user, first, agg_template)
+                    cache.put(key, first.mtime, agg_template_hash, fragment,
+                              "all%sGliders" % slugify(first.institution))
+
+                fragments.append(fragment)
+
+        fragments.append(tail)
+
+        ds_path = os.path.join(catalog_root, self.name, 'datasets.xml')
+        if write_if_changed(ds_path, "".join(fragments)):
+            logger.info("Wrote %s from %d deployments", ds_path, len(deployments))
+
+        added, changed, removed = cache.diff()
+        logger.info("%s: %d datasets added, %d changed, %d removed",
+                    self.name, len(added), len(changed), len(removed))
+        if removed:
+            logger.info("%s: removed datasets: %s", self.name, ", ".join(removed))
+
+        # flag only after datasets.xml is in place, so ERDDAP reloads the new fragments
+        if self.flag_dir is not None:
+            touch_flags(self.flag_dir, added + changed + removed)
+
+        cache.save()
+
+    def build_fragment(self, deployment, template):
+        """
+        Builds an ERDDAP dataset xml fragment.
+        """
+        logger.info("Building %s catalog fragment for %s", self.name, deployment.key)
+
+        return template.safe_substitute(dataset_id=deployment.name,
+                                        dataset_dir=os.path.join(self.data_root, deployment.user, deployment.name),
+                                        institution=deployment.institution,
+                                        **deployment.extent_attributes())
+
+    def build_agg_fragment(self, user, first_deployment, template):
+        """
+        Builds an aggregate dataset fragment entry, titled after the institution of
+        the user's first deployment.
+        """
+        logger.info("Building %s catalog aggregation fragment for %s", self.name, user)
+
+        institution = first_deployment.institution
+
+        return template.safe_substitute(dataset_id="all%sGliders" % slugify(institution),
+                                        dataset_dir=os.path.join(self.data_root, user),
+                                        dataset_title="All %s Gliders" % institution)
+
+class ThreddsOutput(CatalogOutput):
+    """
+    The THREDDS catalogs: a top level catalog.xml holding a catalogRef per user,
+    and a <user>/catalog.xml per user holding that user's deployments.
+
+    Every catalog file is only rewritten when its contents change, so THREDDS,
+    which re-reads referenced catalogs as their files change, picks up new and
+    changed deployments without restarting. The catalog.head.xml template is
+    used for both levels; the xlink namespace the catalogRef entries need is
+    declared on its catalog element if the template doesn't already.
+
+    catalogRef entries use catalog.ref.xml from the templates if it exists.
+    """
+    DEFAULT_REF_TEMPLATE = Template(
+        '  <catalogRef xlink:href="$catalog_href" xlink:title="$title" name="" />\n')
+
+    XLINK_NAMESPACE = 'http://www.w3.org/1999/xlink'
+
+    @classmethod
+    def declare_xlink(cls, head):
+        """
+        head with xmlns:xlink declared on its <catalog> element.
+        """
+        if 'xmlns:xlink' in head:
+            return head
+        return re.sub(r'<catalog\b', '<catalog xmlns:xlink="%s"' % cls.XLINK_NAMESPACE, head, count=1)
+
+    def build(self, deployments, catalog_root, cache_dir, full=False):
+        head = self.declare_xlink(read_file(os.path.join(self.template_dir, 'catalog.head.xml')))
+        tail = read_file(os.path.join(self.template_dir, 'catalog.tail.xml'))
+
+        template, template_hash = self._template('catalog.deployment.xml')
+
+        ref_template = self.DEFAULT_REF_TEMPLATE
+        if os.path.exists(os.path.join(self.template_dir, 'catalog.ref.xml')):
+            ref_template, _ = read_template(os.path.join(self.template_dir, 'catalog.ref.xml'))
+
+        cache = FragmentCache(os.path.join(cache_dir, '%s.fragments.json' % self.name), reuse=not full)
+
+        refs = [head]
+        users = set()
+        written = 0
+
+        for user, user_deployments in group_by_user(deployments):
+            users.add(user)
+            fragments = [head]
+
+            # for each deployment file create a fragment
+            for d in user_deployments:
+                fragment = cache.get(d.key, d.mtime, template_hash)
+                if fragment is None:
+                    fragment = self.build_fragment(d, template)
+                    cache.put(d.key, d.mtime, template_hash, fragment)
+
+                fragments.append(fragment)
+
+            fragments.append(tail)
+
+            user_dir = os.path.join(catalog_root, self.name, user)
+            if not os.path.exists(user_dir):
+                os.makedirs(user_dir)
+
+            user_catalog_path = os.path.join(user_dir, 'catalog.xml')
+            if write_if_changed(user_catalog_path, "".join(fragments)):
+                logger.info("Wrote %s from %d deployments", user_catalog_path, len(user_deployments))
+                written += 1
+
+            refs.append(ref_template.safe_substitute(user=user,
+                                                     title=user_deployments[0].institution,
+                                                     catalog_href="%s/catalog.xml" % user))
+
+        refs.append(tail)
+
+        catalog_path = os.path.join(catalog_root, self.name, 'catalog.xml')
+        if write_if_changed(catalog_path, "".join(refs)):
+            logger.info("Wrote %s referencing %d user catalogs", catalog_path, len(users))
+
+        # drop the catalogs of users who no longer have any deployments
+        for entry in os.listdir(os.path.join(catalog_root, self.name)):
+            stale_path = os.path.join(catalog_root, self.name, entry, 'catalog.xml')
+            if entry not in users and os.path.exists(stale_path):
+                logger.info("Removing %s", stale_path)
+                os.unlink(stale_path)
+
+        logger.info("%s: %d of %d user catalogs rewritten", self.name, written, len(users))
+
+        cache.save()
+
+    def build_fragment(self, deployment, template):
+        """
+        Builds a thredds catalog entry
+        """
+        logger.info("Building %s catalog fragment for %s", self.name, deployment.key)
+
+        deployment_file = "%s.nc3.nc" % deployment.name
+
+        return template.safe_substitute(user=deployment.user,
+                                        deployment=deployment.name,
+                                        deployment_file=deployment_file,
+                                        dataset_id=slugify("%s_%s" % (deployment.user, deployment.name)),
+                                        deployment_path=os.path.join(self.data_root, deployment.user,
+                                                                     deployment.name, deployment_file))
+
+class NcmlOutput(CatalogOutput):
+    """
+    The timeagg.ncml/timeuvagg.ncml joinExisting aggregations THREDDS serves for
+    each deployment, written to <catalog_root>/thredds/<user>/<deployment>/.
+
+    Uses timeagg.ncml and timeuvagg.ncml from the templates if they exist. Files
+    are only rewritten when their contents change, so their mtimes (and with them
+    THREDDS's aggregation rescans) only move when a deployment actually changed.
+    """
+    DEFAULT_TEMPLATES = {
+        'timeagg.ncml': Template("""<?xml version="1.0" encoding="UTF-8"?>
+<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2">
+  <remove type="variable" name="time_uv"/>
+  <remove type="variable" name="lat_uv"/>
+  <remove type="variable" name="lon_uv"/>
+  <remove type="variable" name="u"/>
+  <remove type="variable" name="u_qc"/>
+  <remove type="variable" name="v_qc"/>
+
+  <variable name="platform">
+    <attribute name="wmo_id" value="$wmo_id" />
+  </variable>
+
+  <aggregation dimName="time" type="joinExisting" recheckEvery="5 min">
+    <scan location="$dir_path" suffix=".nc" subdirs="false" />
+  </aggregation>
+</netcdf>
+"""),
+        'timeuvagg.ncml': Template("""<?xml version="1.0" encoding="UTF-8"?>
+<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2">
+  <remove type="variable" name="time"/>
+  <remove type="variable" name="time_qc"/>
+  <remove type="variable" name="segment_id"/>
+  <remove type="variable" name="profile_id"/>
+  <remove type="variable" name="depth"/>
+  <remove type="variable" name="depth_qc"/>
+  <remove type="variable" name="lat"/>
+  <remove type="variable" name="lat_qc"/>
+  <remove type="variable" name="lon"/>
+  <remove type="variable" name="lon_qc"/>
+  <remove type="variable" name="pressure"/>
+  <remove type="variable" name="pressure_qc"/>
+  <remove type="variable" name="conductivity"/>
+  <remove type="variable" name="conductivity_qc"/>
+  <remove type="variable" name="density"/>
+  <remove type="variable" name="density_qc"/>
+  <remove type="variable" name="salinity"/>
+  <remove type="variable" name="salinity_qc"/>
+  <remove type="variable" name="temperature"/>
+  <remove type="variable" name="temperature_qc"/>
+
+  <variable name="platform">
+    <attribute name="wmo_id" value="$wmo_id" />
+  </variable>
+
+  <aggregation dimName="time_uv" type="joinExisting" recheckEvery="5 min">
+    <scan location="$dir_path" suffix=".nc" subdirs="false" />
+  </aggregation>
+</netcdf>
+"""),
+    }
+
+    catalog_dir = 'thredds'
+
+    def build(self, deployments, catalog_root, cache_dir, full=False):
+        templates = {}
+        for filename, default in self.DEFAULT_TEMPLATES.iteritems():
+            template_path = os.path.join(self.template_dir, filename)
+            if os.path.exists(template_path):
+                templates[filename], _ = read_template(template_path)
+            else:
+                templates[filename] = default
+
+        written = 0
+        for d in deployments:
+            cat_path = os.path.join(catalog_root, self.catalog_dir, d.user, d.name)
+            if not os.path.exists(cat_path):
+                os.makedirs(cat_path)
+
+            for filename, template in sorted(templates.iteritems()):
+                ncml = template.safe_substitute(wmo_id=d.wmo_id or "NotAssigned",
+                                                dir_path=os.path.join(self.data_root, d.user, d.name))
+                if write_if_changed(os.path.join(cat_path, filename), ncml):
+                    logger.info("Wrote %s for %s", filename, d.key)
+                    written += 1
+
+        # drop the NcML of deployments that are gone, so THREDDS stops serving them
+        current = set((d.user, d.name) for d in deployments)
+        removed = 0
+        output_dir = os.path.join(catalog_root, self.catalog_dir)
+        for user in os.listdir(output_dir):
+            user_dir = os.path.join(output_dir, user)
+            if not os.path.isdir(user_dir):
+                continue
+            for name in os.listdir(user_dir):
+                cat_path = os.path.join(user_dir, name)
+                if (user, name) in current or not os.path.isdir(cat_path):
+                    continue
+                for filename in templates:
+                    stale_path = os.path.join(cat_path, filename)
+                    if os.path.exists(stale_path):
+                        logger.info("Removing %s", stale_path)
+                        os.unlink(stale_path)
+                        removed += 1
+                if not os.listdir(cat_path):
+                    os.rmdir(cat_path)
+
+        logger.info("%s: %d NcML files rewritten for %d deployments, %d removed",
+                    self.name, written, len(deployments), removed)
+
+def build_catalogs(source_root, catalog_root, outputs, cache_dir=DEFAULT_CACHE_DIR, mongo_uri=None, full=False):
+    """
+    Discovers deployments once and builds every output from them, logging how long
+    discovery and each output took.
+
+    full=True re-renders every fragment instead of reusing cached ones.
+    """
+    start = time.time()
+    deployments = load_deployments(source_root, mongo_uri)
+    timings = [('discovery', time.time() - start)]
+
+    for output in outputs:
+        # ensure directories exist
+        make_all_dirs(catalog_root, output.catalog_dir)
+
+        output_start = time.time()
+        output.build(deployments, catalog_root, cache_dir, full)
+        timings.append((output.name, time.time() - output_start))
+
+    for name, elapsed in timings:
+        logger.info("%-12s %.3fs", name, elapsed)
+    logger.info("%-12s %.3fs", "total", time.time() - start)
+
+    return timings
+
+def add_arguments(parser):
+    """
+    Adds the source, catalog and output arguments shared by the catalog scripts.
+    """
+    parser.add_argument('source_dir', help='Data root holding the deployment.json files')
+    parser.add_argument('catalog_dir')
+    parser.add_argument('--priv-erddap', nargs=2, metavar=('DATA_DIR', 'TEMPLATES'))
+    parser.add_argument('--pub-erddap', nargs=2, metavar=('DATA_DIR', 'TEMPLATES'))
+    parser.add_argument('--thredds', nargs=2, metavar=('DATA_DIR', 'TEMPLATES'))
+    parser.add_argument('--ncml', nargs=2, metavar=('DATA_DIR', 'TEMPLATES'))
+    parser.add_argument('--priv-erddap-flags', metavar='FLAG_DIR',
+                        help="Private ERDDAP's flag directory, to reload changed datasets")
+    parser.add_argument('--pub-erddap-flags', metavar='FLAG_DIR',
+                        help="Public ERDDAP's flag directory, to reload changed datasets")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='Where rendered fragments are cached between runs')
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI'),
+                        help='Load deployment metadata from this MongoDB rather than deployment.json files')
+
+def outputs_from_args(parser, args):
+    outputs = []
+    for name in ['priv_erddap', 'pub_erddap']:
+        spec = getattr(args, name)
+        if spec is not None:
+            outputs.append(ErddapOutput(name, os.path.realpath(spec[0]), os.path.realpath(spec[1]),
+                                        getattr(args, '%s_flags' % name)))
+    if args.thredds is not None:
+        outputs.append(ThreddsOutput('thredds', os.path.realpath(args.thredds[0]), os.path.realpath(args.thredds[1])))
+    if args.ncml is not None:
+        outputs.append(NcmlOutput('ncml', os.path.realpath(args.ncml[0]), os.path.realpath(args.ncml[1])))
+
+    if not outputs:
+        parser.error("At least one of --priv-erddap, --pub-erddap, --thredds or --ncml is required")
+
+    return outputs
+
+def main(source_root, catalog_root, outputs, cache_dir=DEFAULT_CACHE_DIR, mongo_uri=None, full=False):
+    build_catalogs(source_root, catalog_root, outputs, cache_dir, mongo_uri, full)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument('--full', action='store_true',
+                        help='Re-render every fragment rather than reusing cached ones')
+
+    args    = parser.parse_args()
+    outputs = outputs_from_args(parser, args)
+
+    main(os.path.realpath(args.source_dir), os.path.realpath(args.catalog_dir), outputs,
+         args.cache_dir, args.mongo_uri, args.full)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Rebuilds the catalogs shortly after deployments change instead of waiting for cron.
+
+The web app and glider_dac_db_sync.py queue an event in the catalog_events
+collection whenever a deployment is created, updated or deleted (see
+Deployment.publish_catalog_event). This daemon polls for unprocessed events and,
+once they have been quiet for --debounce seconds (or pending for --max-delay), runs
+one incremental build_catalogs for the whole burst. Every --full-interval seconds it
+also runs a full rebuild as a safety net for changes that never produced an event.
+
+Takes the same source/catalog/output arguments as build_catalogs.py, e.g.:
+    ./catalog_trigger.py /data/data/priv_erddap /data/catalog \
+        --priv-erddap /data/data/priv_erddap templates/erddap/templates/private \
+        --mongo-uri mongodb://localhost/gliderdac \
+        --pre-command "~/glider-dac/scripts/sync_data ..."
+"""
+import os
+import time
+import urlparse
+import argparse
+import logging
+import subprocess
+from datetime import datetime
+
+import pymongo
+
+from build_catalogs import build_catalogs, add_arguments, outputs_from_args
+from scheduler import job_lock
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(asctime)s | %(levelname)s]  %(message)s')
+logger = logging.getLogger(__name__)
+
+class CatalogTrigger(object):
+    # processed events are only kept around for troubleshooting
+    EXPIRE_SECONDS = 7 * 24 * 60 * 60
+
+    def __init__(self, events, rebuild, debounce=30, max_delay=300, full_interval=6*60*60):
+        """
+        events is the catalog_events collection and rebuild a callable taking
+        full=True/False.
+        """
+        self.events        = events
+        self.rebuild       = rebuild
+        self.debounce      = debounce
+        self.max_delay     = max_delay
+        self.full_interval = full_interval
+
+        self._seen          = set()
+        self._first_pending = None
+        self._last_change   = None
+        self._last_full     = None
+        self._failed_full   = None
+
+        self.events.ensure_index('created', expireAfterSeconds=self.EXPIRE_SECONDS)
+
+    def _pending(self):
+        return [e['_id'] for e in self.events.find({'processed': {'$exists': False}}, {'_id': 1})]
+
+    def _run(self, ids, full):
+        start = time.time()
+        try:
+            self.rebuild(full=full)
+        except Exception:
+            logger.exception("Catalog rebuild failed, retrying after the debounce delay")
+            self._last_change = time.time()
+            return False
+
+        if ids:
+            self.events.update({'_id': {'$in': ids}},
+                               {'$set': {'processed': datetime.utcnow()}},
+                               multi=True)
+
+        logger.info("%s rebuild for %d events took %.1fs",
+                    "Full" if full else "Incremental", len(ids), time.time() - start)
+
+        self._seen          = set()
+        self._first_pending = None
+        self._last_change   = None
+        return True
+
+    def poll(self, now=None):
+        """
+        Checks for new events and rebuilds if a burst has settled or a full rebuild
+        is due. Returns 'full', 'incremental' or None.
+        """
+        now = now or time.time()
+        ids = self._pending()
+
+        if set(ids) - self._seen:
+            self._last_change = now
+            if self._first_pending is None:
+                self._first_pending = now
+        self._seen = set(ids)
+
+        if self._last_full is None or now - self._last_full >= self.full_interval:
+            # a failed full rebuild is retried after the debounce delay, and
+            # stays due until it succeeds
+            if self._failed_full is None or now - self._failed_full >= self.debounce:
+                if self._run(ids, full=True):
+                    self._last_full   = now
+                    self._failed_full = None
+                    return 'full'
+                self._failed_full = now
+            return None
+
+        if ids and (now - self._last_change >= self.debounce or now - self._first_pending >= self.max_delay):
+            if self._run(ids, full=False):
+                return 'incremental'
+
+        return None
+
+def main(trigger, poll_interval=5):
+    logger.info("Waiting for catalog events (debounce %ds, max delay %ds, full rebuild every %ds)",
+                trigger.debounce, trigger.max_delay, trigger.full_interval)
+
+    try:
+        while True:
+            trigger.poll()
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument('--debounce', type=int, default=30,
+                        help='Seconds without new events before rebuilding')
+    parser.add_argument('--max-delay', type=int, default=300,
+                        help='Rebuild after this many seconds even if events keep arriving')
+    parser.add_argument('--full-interval', type=int, default=6*60*60,
+                        help='Seconds between full rebuilds')
+    parser.add_argument('--poll', type=int, default=5,
+                        help='Seconds between checks for new events')
+    parser.add_argument('--pre-command',
+                        help='Shell command run before each rebuild, e.g. to sync the data dirs')
+    parser.add_argument('--lock',
+                        help="Lock file held during rebuilds, shared with the scheduler's catalog job")
+
+    args    = parser.parse_args()
+    outputs = outputs_from_args(parser, args)
+
+    if not args.mongo_uri:
+        parser.error("--mongo-uri (or MONGO_URI) is required to receive catalog events")
+
+    source_root  = os.path.realpath(args.source_dir)
+    catalog_root = os.path.realpath(args.catalog_dir)
+
+    def rebuild(full):
+        if args.lock:
+            with job_lock(args.lock, blocking=True):
+                _rebuild(full)
+        else:
+            _rebuild(full)
+
+    def _rebuild(full):
+        if args.pre_command:
+            subprocess.check_call(args.pre_command, shell=True)
+        build_catalogs(source_root, catalog_root, outputs, args.cache_dir, args.mongo_uri, full)
+
+    client = pymongo.MongoClient(args.mongo_uri)
+    events = client[urlparse.urlparse(args.mongo_uri).path[1:]].catalog_events
+
+    main(CatalogTrigger(events, rebuild, args.debounce, args.max_delay, args.full_interval), args.poll)
@@ -0,0 +1,171 @@
+"""
+Helpers shared by the ERDDAP and THREDDS catalog builders.
+"""
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from string import Template
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get('CATALOG_CACHE_DIR', os.path.expanduser('~/.cache/glider-dac'))
+
+def read_template(template_path):
+    """
+    Reads a template file once, returning the Template and a hash of its contents
+    for use in fragment cache keys.
+    """
+    with open(template_path) as f:
+        contents = f.read()
+
+    return Template(contents), hashlib.md5(contents).hexdigest()
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+def get_mtime(path):
+    """
+    mtime of path, or None if it does not exist.
+    """
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def write_if_changed(path, contents):
+    """
+    Atomically replaces path with contents via a temp file and rename.
+
+    Nothing is written, and the mtime is left alone, if path already holds exactly
+    contents. Returns True if the file was written.
+    """
+    try:
+        if read_file(path) == contents:
+            logger.debug("%s is unchanged", path)
+            return False
+    except (OSError, IOError):
+        pass
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+    return True
+
+class FragmentCache(object):
+    """
+    Rendered catalog fragments from previous runs, persisted as JSON.
+
+    An entry is reused as long as the deployment.json mtime and the hash of the
+    template it was rendered from are unchanged, so only deployments that changed
+    are re-rendered. Entries not used during a run are dropped when it is saved.
+
+    With reuse=False every fragment is re-rendered (a full rebuild), while the
+    previous entries are still loaded for diff().
+    """
+    def __init__(self, path, reuse=True):
+        self.path     = path
+        self.reuse    = reuse
+        self._entries = {}
+        self._used    = {}
+        self.hits     = 0
+        self.misses   = 0
+
+        try:
+            with open(path) as f:
+                self._entries = json.load(f)
+        except (OSError, IOError, ValueError):
+            pass
+
+    def get(self, key, mtime, template_hash):
+        entry = self._entries.get(key)
+        if self.reuse and entry is not None and entry['mtime'] == mtime and entry['template_hash'] == template_hash:
+            self._used[key] = entry
+            self.hits += 1
+            return entry['fragment']
+
+        self.misses += 1
+        return None
+
+    def put(self, key, mtime, template_hash, fragment, dataset_id=None):
+        self._used[key] = {'mtime'         : mtime,
+                           'template_hash' : template_hash,
+                           'fragment'      : fragment,
+                           'dataset_id'    : dataset_id}
+
+    def diff(self):
+        """
+        Compares the fragments used this run with the previous run's.
+
+        Returns (added, changed, removed) lists of the dataset ids involved.
+        """
+        added, changed, removed = [], [], []
+
+        for key, entry in sorted(self._used.iteritems()):
+            previous = self._entries.get(key)
+            if previous is None:
+                added.append(entry.get('dataset_id'))
+            elif previous.get('dataset_id') != entry.get('dataset_id'):
+                # e.g. an aggregation renamed after its institution changed
+                added.append(entry.get('dataset_id'))
+                removed.append(previous.get('dataset_id'))
+            elif previous['fragment'] != entry['fragment']:
+                changed.append(entry.get('dataset_id'))
+
+        for key, entry in sorted(self._entries.iteritems()):
+            if key not in self._used:
+                removed.append(entry.get('dataset_id'))
+
+        return [d for d in added if d], [d for d in changed if d], [d for d in removed if d]
+
+    def save(self):
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        write_if_changed(self.path, json.dumps(self._used, sort_keys=True))
+        logger.info("Fragment cache %s: %d reused, %d rendered", self.path, self.hits, self.misses)
+
+def make_all_dirs(catalog_root, mode):
+    """
+    Ensures directory creation for a catalog.
+    """
+    d = os.path.join(catalog_root, mode)
+
+    if not os.path.exists(d):
+        logger.info("Creating %s", d)
+        try:
+            os.makedirs(d)
+        except OSError:
+            pass
+
+def slugify(value):
+    """
+    Normalizes string, removes non-alpha characters, and converts spaces to hyphens.
+    Pulled from Django
+    """
+    import unicodedata
+    import re
+    value = unicode(value)
+    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
+    value = unicode(re.sub('[^\w\s-]', '', value).strip())
+    return unicode(re.sub('[-\s]+', '-', value))
+
+def touch_flags(flag_dir, dataset_ids):
+    """
+    Touches an ERDDAP flag file for each dataset id, so ERDDAP reloads just those
+    datasets on its next pass rather than waiting for its own recheck.
+    """
+    for dataset_id in dataset_ids:
+        flag_path = os.path.join(flag_dir, dataset_id)
+        with open(flag_path, 'a'):
+            os.utime(flag_path, None)
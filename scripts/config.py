@@ -1,6 +1,16 @@
+import os
+
 # Configure Variables
 JSON_DIR = '/data/data/priv_erddap/'
 path2priv='/data/data/priv_erddap/'
 path2pub='/data/data/pub_erddap/'
 path2thredds = '/data/data/thredds/'
 SERVER="http://localhost:8080/erddap"
+# Deployments replicated concurrently by replicatePrivateErddapDeployments.py
+WORKERS = 4
+# Fetch only new rows from ERDDAP and merge them into the replicated files (needs netCDF4)
+INCREMENTAL = False
+# Replication state, and the retry backoff after a failure (doubling up to the max)
+STATE_DB = os.path.expanduser('~/.cache/glider-dac/replication.sqlite')
+RETRY_BACKOFF = 300
+RETRY_BACKOFF_MAX = 6 * 60 * 60
@@ -1,87 +1,203 @@
 #!/usr/bin/env python
+"""
+Replicates recently updated deployments from the private ERDDAP into the public
+ERDDAP and THREDDS data directories.
+
+Each deployment's tabledap .ncCFMA file is downloaded once, into pub_erddap, and
+hardlinked (or copied, across filesystems) into thredds. Deployments are
+processed by a pool of --workers threads, since the time is spent waiting on
+ERDDAP rather than locally.
+
+What has been replicated is kept in a SQLite state database (--state-db): the
+deployment.json update time last replicated, the last download's validators and
+any failures. A deployment is fetched when its source has been updated since,
+and a failed one is retried with exponential backoff. Failed deployments are
+logged but don't change the exit status, which is non-zero only when the run
+itself fails (listing deployments, the state database).
+
+Downloads are conditional on the ETag/Last-Modified of the previous one, and
+interrupted downloads are resumed. With --incremental (and netCDF4 installed)
+only rows newer than the replicated file are fetched and merged into it.
+"""
 import argparse
 import json
 import os
 import sys
-import urllib2
-import feedparser
-import calendar
 import time
-import sh
 import glob
+import shutil
+import logging
 import datetime
+from multiprocessing.pool import ThreadPool
 
 from config import *
+from replication_util import (fetch, fetch_increment, last_time, ReplicationState,
+                              netCDF4, NOT_MODIFIED, NO_DATA)
 
+logging.basicConfig(level=logging.INFO,
+                    format='[%(asctime)s | %(levelname)s | %(threadName)s]  %(message)s')
+logger = logging.getLogger(__name__)
 
-def get_mod_time(name):
+def get_source_updated(name):
+    """
+    When deployment name (user/deployment) was last updated in the private ERDDAP,
+    as epoch seconds: deployment.json's updated time, or the newest NetCDF file's
+    mtime if there is no deployment.json. None if there is nothing to replicate.
+    """
+    jsonFile = os.path.join(JSON_DIR, name, 'deployment.json')
 
-    jsonFile = os.path.join(JSON_DIR, name + '/deployment.json')
-    print "Inspecting", jsonFile
+    try:
+        with open(jsonFile, 'r') as fid:
+            return json.load(fid)['updated'] / 1000.
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        logger.info("No usable %s (%s), using the newest file time", jsonFile, e)
 
-    if not os.path.exists(jsonFile):
-        print "JSON file does not exist."
-        newest = max(glob.iglob(JSON_DIR+name+'/'+'*.nc') , key=os.path.getmtime)
-        jsonTime = os.path.getmtime(newest)
-        with  open(jsonFile, 'w') as outfile:
-            json.dump({'updated':jsonTime*1000}, outfile)
-        print "Initiated JSON file"
-        
+    mtimes = [os.path.getmtime(f) for f in glob.iglob(os.path.join(JSON_DIR, name, '*.nc'))]
+    return max(mtimes) if mtimes else None
 
-    with open(jsonFile, 'r') as fid:
-        dataset = json.load(fid)
-
-    print dataset['updated']
-    return (dataset['updated'])/1000
-
-def main():
+def list_deployments():
     deployments = []
-    for u in os.listdir(path2priv):
+    for u in sorted(os.listdir(path2priv)):
         if os.path.isdir(path2priv+u):
-            deployments.extend( [u+'/'+d for d in os.listdir(path2priv+u+'/')])
-    print "Processing the following deployments"
-    for d in deployments:
-        print " -", d
-    for d in deployments:
-        sync_deployment(d)
-
-def retrieve_data(where, d):
-    ud=where+d
-    pathDeployName = ud.split('/')[-1]
-    path_arg = ud + "/" + pathDeployName + ".nc3.nc"
-    host_arg = SERVER+"/tabledap/" + pathDeployName + ".ncCFMA"
-    print "Path Arg", path_arg
-    print "Host Arg", host_arg
-    args = [
-        "--no-host-directories",
-        "--cut-dirs=2",
-        "--output-document=%s" % path_arg,
-        host_arg
-     ]
-    print "Args:", ' '.join(args)
-    sh.wget(*args)
-
-
-def sync_deployment(deployment):
-    print "--------------------------------------------------------------------------------"
-    print "   Processing", deployment
-    print "--------------------------------------------------------------------------------"
+            deployments.extend( [u+'/'+d for d in sorted(os.listdir(path2priv+u+'/'))])
+    return deployments
+
+def replicate(deployments, state, workers=WORKERS, incremental=INCREMENTAL):
+    """
+    Runs sync_deployment for each deployment on a pool of workers threads,
+    returning their results.
+    """
+    if incremental and netCDF4 is None:
+        logger.warning("netCDF4 is not installed, fetching whole files instead of increments")
+        incremental = False
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(lambda d: sync_deployment(d, state, incremental), deployments)
+    finally:
+        pool.close()
+        pool.join()
+
+def main(deployments, state, workers=WORKERS, incremental=INCREMENTAL):
+    logger.info("Processing %d deployments with %d workers", len(deployments), workers)
+
+    start = time.time()
+    results = replicate(deployments, state, workers, incremental)
+
+    replicated = [r for r in results if r['status'] == 'replicated']
+    failed     = [r for r in results if r['status'] == 'failed']
+
+    for r in sorted(replicated, key=lambda r: r['seconds'], reverse=True):
+        logger.info("%-60s %7.1fs %12d bytes", r['deployment'], r['seconds'], r['bytes'])
+    for r in failed:
+        logger.info("%-60s failed, retrying after %s", r['deployment'],
+                    datetime.datetime.utcfromtimestamp(r['next_attempt']).isoformat())
+    logger.info("Replicated %d, failed %d, skipped %d in %.1fs, %d bytes transferred",
+                len(replicated), len(failed), len(results) - len(replicated) - len(failed),
+                time.time() - start, sum(r['bytes'] for r in results))
+
+    # a failed deployment is retried on a later run (see ReplicationState), so it
+    # doesn't fail the run and hold back the catalog jobs that require it
+    return 0
+
+def data_path(where, d):
+    """
+    Returns the replicated file path for deployment d (user/name) under where.
+    """
+    name = d.split('/')[-1]
+    return os.path.join(where, d, name + ".nc3.nc")
+
+def retrieve_data(where, d, state, incremental=False):
+    """
+    Brings the replicated file for deployment d under where up to date. Returns
+    (status, bytes received), status being one of replication_util's.
+    """
+    path = data_path(where, d)
+    url = SERVER + "/tabledap/" + d.split('/')[-1] + ".ncCFMA"
+    validators = (state.get(d) or {}).get('validators', {})
+
+    try:
+        since = last_time(path) if incremental else None
+        if since is not None:
+            logger.info("Fetching %s rows after %s", url, datetime.datetime.utcfromtimestamp(since).isoformat())
+            return fetch_increment(url, path, since, validators)
+
+        logger.info("Fetching %s", url)
+        return fetch(url, path, validators)
+    finally:
+        state.save_validators(d, validators)
+
+def link_or_copy(src, dest):
+    """
+    Replaces dest with a hardlink to src, falling back to a copy when they are on
+    different filesystems. The swap is done via a temporary name so readers never
+    see a missing or partial dest.
+    """
+    tmp = os.path.join(os.path.dirname(dest), '.%s.tmp' % os.path.basename(dest))
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.rename(tmp, dest)
+
+def sync_deployment(deployment, state, incremental=False, now=None):
+    """
+    Replicates one deployment if its source changed since it was last replicated,
+    or a failed attempt is due for a retry. Returns a dict with the deployment,
+    status ('replicated', 'up to date', 'backing off' or 'failed'), bytes received
+    and seconds taken.
+    """
     d = deployment
-    #Get Current Epoch Time and how far back in time to search
-    currentEpoch = time.time()
-    time_in_past = 3800
-    mTime=get_mod_time(d)
-    deltaT= int(currentEpoch) - int(mTime)
-    print "Synchronizing at ", datetime.datetime.utcnow().isoformat()
-    #print currentEpoch, deltaT, mTime
-    if deltaT <  time_in_past: 
-        #Retrieve Data and send to public
-        retrieve_data(path2pub, d)
-        #Retrieve Data and send to Thredds
-        retrieve_data(path2thredds, d)
-    else:
-        print "Everything is up to date"
-  
+    start = time.time()
+    now = now or start
+    result = {'deployment': d, 'status': 'up to date', 'bytes': 0}
+
+    try:
+        source_updated = get_source_updated(d)
+        previous = state.get(d) or {}
+
+        if previous.get('failures') and now < previous['next_attempt']:
+            logger.info("%s failed %d times, next attempt at %s", d, previous['failures'],
+                        datetime.datetime.utcfromtimestamp(previous['next_attempt']).isoformat())
+            result['status'] = 'backing off'
+        elif source_updated is None or (previous.get('source_updated') is not None and
+                                        source_updated <= previous['source_updated']):
+            logger.info("%s is up to date", d)
+        else:
+            logger.info("Synchronizing %s, updated %s", d,
+                        datetime.datetime.utcfromtimestamp(source_updated).isoformat())
+            #Retrieve Data once for public, and share it with Thredds
+            status, result['bytes'] = retrieve_data(path2pub, d, state, incremental)
+            thredds_path = data_path(path2thredds, d)
+            if status not in (NOT_MODIFIED, NO_DATA) or not os.path.exists(thredds_path):
+                link_or_copy(data_path(path2pub, d), thredds_path)
+
+            state.succeeded(d, source_updated)
+            if status in (NOT_MODIFIED, NO_DATA):
+                logger.info("%s: %s", d, status)
+            else:
+                result['status'] = 'replicated'
+    except Exception as e:
+        logger.exception("Failed to replicate %s", d)
+        result['status'] = 'failed'
+        result['next_attempt'] = state.failed(d, e, now)
+
+    result['seconds'] = time.time() - start
+    return result
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('deployments', nargs='*',
+                        help='user/deployment names to replicate, defaults to every deployment')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='Number of deployments replicated concurrently')
+    parser.add_argument('--incremental', action='store_true', default=INCREMENTAL,
+                        help='Fetch only rows newer than the replicated file and merge them in')
+    parser.add_argument('--state-db', default=STATE_DB,
+                        help='SQLite database recording what has been replicated')
+    args = parser.parse_args()
 
+    state = ReplicationState(args.state_db, RETRY_BACKOFF, RETRY_BACKOFF_MAX)
+    sys.exit(main(args.deployments or list_deployments(), state, args.workers, args.incremental))
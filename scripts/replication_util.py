@@ -0,0 +1,432 @@
+"""
+Helpers for replicating ERDDAP tabledap files: conditional, resumable downloads,
+merging an incremental fetch into the previously replicated file, and the state
+database recording what has been replicated.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import urllib2
+import threading
+from contextlib import closing
+
+try:
+    import numpy
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+NOT_MODIFIED = 'not modified'
+DOWNLOADED   = 'downloaded'
+NO_DATA      = 'no data'
+
+def _hidden(path, suffix):
+    return os.path.join(os.path.dirname(path), '.%s.%s' % (os.path.basename(path), suffix))
+
+def fetch(url, path, validators, conditional=True, timeout=600):
+    """
+    Downloads url to path through a temporary .part file that is renamed into place
+    once complete.
+
+    validators is a dict updated in place with the ETag/Last-Modified of the
+    download (and of an unfinished one, under 'partial'), which the caller persists
+    and passes back next time. With conditional=True and an existing path the
+    request carries If-None-Match/If-Modified-Since, and an unfinished .part file of
+    the same url is resumed with a Range request.
+
+    Returns (DOWNLOADED or NOT_MODIFIED, bytes received).
+    """
+    part = _hidden(path, 'part')
+    request = urllib2.Request(url)
+
+    if conditional and os.path.exists(path) and validators.get('url') == url:
+        if validators.get('etag'):
+            request.add_header('If-None-Match', validators['etag'])
+        if validators.get('last_modified'):
+            request.add_header('If-Modified-Since', validators['last_modified'])
+
+    partial = validators.get('partial') or {}
+    validator = partial.get('etag') or partial.get('last_modified')
+    offset = 0
+    if os.path.exists(part) and partial.get('url') == url and validator:
+        offset = os.path.getsize(part)
+        request.add_header('Range', 'bytes=%d-' % offset)
+        request.add_header('If-Range', validator)
+
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            return NOT_MODIFIED, 0
+        if e.code == 416 and offset:
+            # the partial download no longer lines up with the source, start over
+            logger.warning("Could not resume %s, restarting the download", url)
+            os.unlink(part)
+            validators.pop('partial', None)
+            return fetch(url, path, validators, conditional, timeout)
+        raise
+
+    with closing(response):
+        headers = response.info()
+        etag = headers.getheader('ETag')
+        last_modified = headers.getheader('Last-Modified')
+
+        if response.getcode() == 206:
+            logger.info("Resuming %s at %d bytes", url, offset)
+            mode = 'ab'
+        else:
+            mode = 'wb'
+
+        validators['partial'] = {'url': url, 'etag': etag, 'last_modified': last_modified}
+
+        received = 0
+        with open(part, mode) as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                f.write(chunk)
+                received += len(chunk)
+
+    os.chmod(part, 0644)
+    os.rename(part, path)
+
+    validators.pop('partial', None)
+    validators.update({'url'           : url,
+                       'etag'          : etag,
+                       'last_modified' : last_modified,
+                       'size'          : os.path.getsize(path),
+                       'fetched'       : time.time()})
+
+    return DOWNLOADED, received
+
+# ERDDAP's tabledap time unit, which time constraints are given in
+EPOCH_UNITS = 'seconds since 1970-01-01T00:00:00Z'
+
+# the body of ERDDAP's 404 for a query without matching rows, as opposed to an
+# unknown or removed dataset
+NO_MATCHING_RESULTS = 'Your query produced no matching results'
+
+def last_time(path):
+    """
+    Latest value of the time variable in a replicated file, as epoch seconds at
+    the file's own precision, or None if it cannot be read.
+    """
+    if netCDF4 is None or not os.path.exists(path):
+        return None
+
+    try:
+        with closing(netCDF4.Dataset(path)) as nc:
+            t = nc.variables['time']
+            latest = numpy.ma.max(t[:])
+            if latest is numpy.ma.masked:
+                return None
+            if t.units.replace(' ', 'T', 1).rstrip('Z') == EPOCH_UNITS.replace(' ', 'T', 1).rstrip('Z'):
+                return float(latest)
+            return float(netCDF4.date2num(netCDF4.num2date(latest, t.units), EPOCH_UNITS))
+    except Exception as e:
+        logger.warning("Could not read the latest time from %s: %s", path, e)
+        return None
+
+def _copy_attrs(src, dest):
+    dest.setncatts(dict((a, src.getncattr(a)) for a in src.ncattrs() if a != '_FillValue'))
+
+def _put(var, values, offsets=None):
+    if not var.dimensions:
+        var.assignValue(values)
+        return
+    offsets = offsets or [0] * len(values.shape)
+    var[tuple(slice(o, o + n) for o, n in zip(offsets, values.shape))] = values
+
+def _front(values, *axes):
+    """
+    values (masked) with axes moved to the front, in order.
+    """
+    values = numpy.ma.asarray(values)
+    dest = range(len(axes))
+    return numpy.ma.array(numpy.moveaxis(values.data, axes, dest),
+                          mask=numpy.moveaxis(numpy.ma.getmaskarray(values), axes, dest))
+
+def _back(values, *axes):
+    dest = range(len(axes))
+    return numpy.ma.array(numpy.moveaxis(values.data, dest, axes),
+                          mask=numpy.moveaxis(numpy.ma.getmaskarray(values), dest, axes))
+
+def _profile_keys(nc, concat_dim):
+    """
+    The identity of each profile along concat_dim: its profile_id (the variable
+    with cf_role profile_id), or failing that its time.
+    """
+    id_var = None
+    for name, var in nc.variables.iteritems():
+        if concat_dim in var.dimensions and getattr(var, 'cf_role', None) == 'profile_id':
+            id_var = var
+    if id_var is None:
+        id_var = nc.variables.get('profile_id', nc.variables.get('time'))
+
+    values = _front(id_var[:], id_var.dimensions.index(concat_dim))
+    return [tuple(numpy.ma.ravel(v).tolist()) for v in values]
+
+class _Profiles(object):
+    """
+    The profiles of an ncCFMA file: their keys, and for each the obs rows in use
+    with the time of each (the profile's time where time has no obs dimension).
+    """
+    def __init__(self, nc, concat_dim, obs_dim):
+        self.keys  = _profile_keys(nc, concat_dim)
+        self.index = dict((k, i) for i, k in enumerate(self.keys))
+
+        n_obs = len(nc.dimensions[obs_dim]) if obs_dim in nc.dimensions else 1
+        used = numpy.zeros((len(self.keys), n_obs), dtype=bool)
+        for var in nc.variables.itervalues():
+            if concat_dim in var.dimensions and obs_dim in var.dimensions and var.dtype.kind in 'iuf':
+                mask = _front(var[:], var.dimensions.index(concat_dim), var.dimensions.index(obs_dim)).mask
+                used |= ~mask.reshape(mask.shape[:2] + (-1,)).all(axis=2)
+        if obs_dim not in nc.dimensions:
+            used[:] = True
+
+        times = numpy.ma.masked_all(used.shape)
+        if 'time' in nc.variables:
+            t = nc.variables['time']
+            if concat_dim in t.dimensions:
+                axes = [t.dimensions.index(concat_dim)]
+                if obs_dim in t.dimensions:
+                    axes.append(t.dimensions.index(obs_dim))
+                values = _front(t[:], *axes)
+                values = values.reshape(values.shape[:len(axes)] + (-1,))[..., 0]
+                times[:] = values if values.ndim == 2 else values[:, numpy.newaxis]
+
+        self.rows = [[(k, None if times.mask[p, k] else float(times[p, k])) for k in numpy.flatnonzero(used[p])]
+                     for p in range(len(self.keys))]
+
+def merge_ncCFMA(existing_path, increment_path, out_path, concat_dim='profile', obs_dim='obs'):
+    """
+    Merges the profiles of increment_path into those of existing_path, writing the
+    result to out_path.
+
+    Profiles are matched on their profile_id (see _profile_keys). A profile in both
+    keeps the existing file's rows that the increment doesn't have again, by time,
+    followed by the increment's rows, ordered by time, and takes its profile
+    variables from the increment. New profiles are appended. Other dimensions
+    (string lengths) grow to the larger of the two, padded with fill values, and
+    variables without concat_dim take the increment's values.
+    """
+    with closing(netCDF4.Dataset(existing_path)) as old, \
+         closing(netCDF4.Dataset(increment_path)) as new, \
+         closing(netCDF4.Dataset(out_path, 'w', format=old.file_format)) as out:
+
+        old_profiles = _Profiles(old, concat_dim, obs_dim)
+        new_profiles = _Profiles(new, concat_dim, obs_dim)
+
+        # (old profile, its obs rows kept, new profile, its obs rows, source of each
+        # merged row in time order) of each merged profile
+        merged_profiles = []
+        for key in old_profiles.keys + [k for k in new_profiles.keys if k not in old_profiles.index]:
+            p_old, p_new = old_profiles.index.get(key), new_profiles.index.get(key)
+            new_rows = new_profiles.rows[p_new] if p_new is not None else []
+            refetched = set(t for _, t in new_rows)
+            old_rows = [r for r in old_profiles.rows[p_old] if r[1] not in refetched] if p_old is not None else []
+
+            rows = sorted([(t, 0, k) for k, t in old_rows] + [(t, 1, k) for k, t in new_rows])
+            merged_profiles.append((p_old, [k for t, src, k in rows if src == 0],
+                                    p_new, [k for t, src, k in rows if src == 1],
+                                    [src for t, src, k in rows]))
+
+        _copy_attrs(old, out)
+
+        n_obs = max([len(m[4]) for m in merged_profiles] + [1])
+        for name, dim in old.dimensions.iteritems():
+            if name == concat_dim:
+                out.createDimension(name, len(merged_profiles))
+            elif name == obs_dim:
+                out.createDimension(name, n_obs)
+            else:
+                n_new = len(new.dimensions[name]) if name in new.dimensions else 0
+                out.createDimension(name, max(len(dim), n_new))
+
+        for name, var in old.variables.iteritems():
+            fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+            merged = out.createVariable(name, var.dtype, var.dimensions, fill_value=fill)
+            _copy_attrs(var, merged)
+
+            if name not in new.variables:
+                _put(merged, var[:] if var.dimensions else var.getValue())
+                continue
+            inc = new.variables[name]
+            if concat_dim not in var.dimensions:
+                _put(merged, inc[:] if inc.dimensions else inc.getValue())
+                continue
+
+            axes = [var.dimensions.index(concat_dim)]
+            if obs_dim in var.dimensions:
+                axes.append(var.dimensions.index(obs_dim))
+            old_values, new_values = _front(var[:], *axes), _front(inc[:], *axes)
+            shape = [len(out.dimensions[var.dimensions[a]]) for a in axes] + \
+                    [len(out.dimensions[d]) for i, d in enumerate(var.dimensions) if i not in axes]
+            values = numpy.ma.masked_all(shape, dtype=var.dtype)
+
+            for i, (p_old, old_rows, p_new, new_rows, order) in enumerate(merged_profiles):
+                if len(axes) == 1:
+                    source = new_values[p_new] if p_new is not None else old_values[p_old]
+                else:
+                    parts = []
+                    if old_rows:
+                        parts.append(old_values[p_old][old_rows])
+                    if new_rows:
+                        parts.append(new_values[p_new][new_rows])
+                    if not parts:
+                        continue
+                    # back into time order, the old and new rows interleaved
+                    width = max(p.shape[1:] for p in parts)
+                    parts = [_pad(p, width) for p in parts]
+                    stacked = numpy.ma.concatenate(parts)
+                    source = stacked[_interleave(order)]
+                values[(i,) + tuple(slice(0, n) for n in source.shape)] = source
+
+            _put(merged, _back(values, *axes))
+
+def _pad(values, shape):
+    """
+    values padded with masked entries to shape along every axis but the first.
+    """
+    if values.shape[1:] == tuple(shape):
+        return values
+    padded = numpy.ma.masked_all((values.shape[0],) + tuple(shape), dtype=values.dtype)
+    padded[(slice(None),) + tuple(slice(0, n) for n in values.shape[1:])] = values
+    return padded
+
+def _interleave(order):
+    """
+    Indices into the old rows followed by the new rows that put them in order,
+    order being the source (0 old, 1 new) of each merged row in turn.
+    """
+    n_old = order.count(0)
+    taken = [0, 0]
+    indices = []
+    for src in order:
+        indices.append(taken[src] + (n_old if src else 0))
+        taken[src] += 1
+    return indices
+
+def fetch_increment(url, path, since, validators, timeout=600):
+    """
+    Fetches only the rows of url newer than since (epoch seconds, see last_time)
+    using a tabledap time constraint, and merges them into path (see
+    merge_ncCFMA, which also drops any row fetched again).
+
+    Returns (DOWNLOADED or NO_DATA, bytes received). A 404 other than ERDDAP's
+    for a query without matching rows, e.g. for a removed dataset, is raised.
+    """
+    increment = _hidden(path, 'increment')
+    merged = _hidden(path, 'merged')
+    constrained = url + '?&time%3E' + repr(since)
+
+    try:
+        _, received = fetch(constrained, increment, {}, conditional=False, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if e.code == 404 and NO_MATCHING_RESULTS in e.read():
+            return NO_DATA, 0
+        raise
+
+    try:
+        merge_ncCFMA(path, increment, merged)
+        os.chmod(merged, 0644)
+        os.rename(merged, path)
+    finally:
+        for p in (increment, merged):
+            if os.path.exists(p):
+                os.unlink(p)
+
+    validators.update({'size': os.path.getsize(path), 'merged': time.time()})
+    return DOWNLOADED, received
+
+class ReplicationState(object):
+    """
+    Per-deployment replication state in a local SQLite database: the source update
+    time last replicated, the last download's validators, size and time, and any
+    consecutive failures with the time of the next retry.
+
+    A single connection is shared by the worker threads, serialized by a lock.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS deployments (
+            deployment     TEXT PRIMARY KEY,
+            source_updated REAL,
+            etag           TEXT,
+            size           INTEGER,
+            fetched        REAL,
+            validators     TEXT,
+            failures       INTEGER NOT NULL DEFAULT 0,
+            last_error     TEXT,
+            next_attempt   REAL
+        )
+    """
+
+    def __init__(self, path, backoff=300, max_backoff=6*60*60):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        self.backoff     = backoff
+        self.max_backoff = max_backoff
+        self._lock       = threading.Lock()
+        self._conn       = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute(self.SCHEMA)
+
+    def get(self, deployment):
+        """
+        The state row of deployment as a dict, with validators decoded, or None.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM deployments WHERE deployment = ?",
+                                     (deployment,)).fetchone()
+        if row is None:
+            return None
+
+        state = dict(zip(row.keys(), row))
+        state['validators'] = json.loads(state['validators'] or '{}')
+        return state
+
+    def _upsert(self, deployment, **values):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO deployments (deployment) VALUES (?)", (deployment,))
+            self._conn.execute("UPDATE deployments SET %s WHERE deployment = ?" %
+                               ", ".join("%s = ?" % k for k in values),
+                               values.values() + [deployment])
+
+    def save_validators(self, deployment, validators):
+        """
+        Persists the validators of a (possibly unfinished) download.
+        """
+        self._upsert(deployment,
+                     validators = json.dumps(validators),
+                     etag       = validators.get('etag'),
+                     size       = validators.get('size'),
+                     fetched    = validators.get('fetched'))
+
+    def succeeded(self, deployment, source_updated):
+        self._upsert(deployment,
+                     source_updated = source_updated,
+                     failures       = 0,
+                     last_error     = None,
+                     next_attempt   = None)
+
+    def failed(self, deployment, error, now=None):
+        """
+        Records a failure, scheduling the retry after an exponential backoff.
+        Returns the time of the next attempt.
+        """
+        now = now or time.time()
+        state = self.get(deployment) or {}
+        failures = (state.get('failures') or 0) + 1
+        next_attempt = now + min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+
+        self._upsert(deployment,
+                     failures     = failures,
+                     last_error   = str(error),
+                     next_attempt = next_attempt)
+        return next_attempt
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Runs the DAP server's periodic jobs (replication, catalog builds, reloads) in
+dependency order, instead of independent cron entries that start at the same
+instant and overlap when one runs long.
+
+Jobs are declared in an ini file (see deploy/scheduler.ini). Running a job runs
+the jobs it requires first, and skips it if one of them fails or is skipped.
+Each job holds an flock on its mutex while running; if the mutex is already held,
+e.g. by last hour's run, the job is skipped rather than started a second time.
+Each run is appended to a JSON lines history with its duration, exit status and
+the CPU and block I/O its processes used.
+
+Usage:
+    ./scheduler.py --config ~/scheduler.ini run reload
+    ./scheduler.py --config ~/scheduler.ini history --hours 24
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import errno
+import signal
+import socket
+import logging
+import argparse
+import resource
+import subprocess
+import ConfigParser
+from contextlib import contextmanager
+from datetime import datetime
+
+logging.basicConfig(level=logging.INFO,
+                    format='[%(asctime)s | %(levelname)s]  %(message)s')
+logger = logging.getLogger(__name__)
+
+# ru_inblock/ru_oublock count 512 byte blocks
+BLOCK_SIZE = 512
+
+# seconds a timed out job gets to exit after SIGTERM before it is sent SIGKILL
+KILL_GRACE_SECONDS = 30
+
+class JobLocked(Exception):
+    pass
+
+@contextmanager
+def job_lock(path, blocking=False):
+    """
+    Holds an exclusive flock on path. Raises JobLocked if it is held elsewhere and
+    blocking is False.
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise JobLocked(path)
+            raise
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class Job(object):
+    def __init__(self, name, command, requires=None, mutex=None, log=None, timeout=None):
+        self.name     = name
+        self.command  = command
+        self.requires = requires or []
+        self.mutex    = mutex or name
+        self.log      = log
+        self.timeout  = timeout
+
+def load_config(path):
+    """
+    Reads the scheduler ini file, returning (settings dict, {name: Job}).
+    """
+    config = ConfigParser.RawConfigParser()
+    if not config.read(path):
+        raise ValueError("Could not read %s" % path)
+
+    settings = dict(config.items('scheduler')) if config.has_section('scheduler') else {}
+
+    jobs = {}
+    for section in config.sections():
+        if not section.startswith('job:'):
+            continue
+        options = dict(config.items(section))
+        name = section[len('job:'):]
+        jobs[name] = Job(name,
+                         options['command'],
+                         options.get('requires', '').split(),
+                         options.get('mutex'),
+                         options.get('log'),
+                         int(options['timeout']) if options.get('timeout') else None)
+
+    for job in jobs.itervalues():
+        for r in job.requires:
+            if r not in jobs:
+                raise ValueError("Job %s requires unknown job %s" % (job.name, r))
+
+    return settings, jobs
+
+def run_order(jobs, targets):
+    """
+    The jobs to run for targets, each after the jobs it requires.
+    """
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError("Job dependency cycle through %s" % name)
+        visiting.add(name)
+        for r in jobs[name].requires:
+            visit(r)
+        visiting.discard(name)
+        order.append(name)
+
+    for t in targets:
+        if t not in jobs:
+            raise ValueError("Unknown job %s" % t)
+        visit(t)
+
+    return [jobs[name] for name in order]
+
+def _killpg(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except OSError as e:
+        # the whole group already exited
+        if e.errno != errno.ESRCH:
+            raise
+
+def terminate(process, grace=KILL_GRACE_SECONDS):
+    """
+    Sends SIGTERM to the process group of process, then SIGKILL if it hasn't
+    exited after grace seconds, and waits for it, so a job that ignores SIGTERM
+    can't hold up the scheduler (and its mutex) forever.
+    """
+    _killpg(process.pid, signal.SIGTERM)
+
+    deadline = time.time() + grace
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+
+    if process.poll() is None:
+        logger.error("Process group %d ignored SIGTERM, sending SIGKILL", process.pid)
+        _killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+class Scheduler(object):
+    def __init__(self, jobs, lock_dir, history_path=None):
+        self.jobs         = jobs
+        self.lock_dir     = lock_dir
+        self.history_path = history_path
+
+    def run(self, targets):
+        """
+        Runs targets and the jobs they require. Returns {job name: status}, status
+        being 'ok', 'failed' or 'skipped'.
+        """
+        statuses = {}
+        for job in run_order(self.jobs, targets):
+            blocked = [r for r in job.requires if statuses.get(r) != 'ok']
+            if blocked:
+                statuses[job.name] = self._record(job, 'skipped', reason="%s did not succeed" % ", ".join(blocked))
+                continue
+
+            try:
+                with job_lock(os.path.join(self.lock_dir, '%s.lock' % job.mutex)):
+                    statuses[job.name] = self._execute(job)
+            except JobLocked:
+                statuses[job.name] = self._record(job, 'skipped', reason="%s is still running" % job.mutex)
+
+        return statuses
+
+    def _execute(self, job):
+        logger.info("Starting %s: %s", job.name, job.command)
+
+        start = time.time()
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        log = open(job.log, 'a') if job.log else None
+        try:
+            # own process group so a timeout can kill the whole pipeline
+            process = subprocess.Popen(job.command, shell=True, executable='/bin/bash',
+                                       cwd=os.path.expanduser('~'), stdout=log, stderr=subprocess.STDOUT,
+                                       preexec_fn=os.setsid)
+            timed_out = False
+            if job.timeout is None:
+                process.wait()
+            else:
+                while process.poll() is None:
+                    if time.time() - start > job.timeout:
+                        logger.error("%s exceeded its %ds timeout, killing it", job.name, job.timeout)
+                        timed_out = True
+                        terminate(process)
+                        break
+                    time.sleep(1)
+        finally:
+            if log:
+                log.close()
+
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage = {'user_seconds'   : after.ru_utime - before.ru_utime,
+                 'system_seconds' : after.ru_stime - before.ru_stime,
+                 'read_bytes'     : (after.ru_inblock - before.ru_inblock) * BLOCK_SIZE,
+                 'write_bytes'    : (after.ru_oublock - before.ru_oublock) * BLOCK_SIZE}
+
+        status = 'ok' if process.returncode == 0 and not timed_out else 'failed'
+        return self._record(job, status, start=start, returncode=process.returncode,
+                            reason='timeout' if timed_out else None, **usage)
+
+    def _record(self, job, status, start=None, reason=None, **details):
+        now = time.time()
+        entry = dict(details,
+                     job      = job.name,
+                     status   = status,
+                     reason   = reason,
+                     host     = socket.gethostname(),
+                     started  = datetime.utcfromtimestamp(start or now).isoformat(),
+                     finished = datetime.utcfromtimestamp(now).isoformat(),
+                     seconds  = now - start if start else 0)
+
+        if status == 'skipped':
+            logger.warning("Skipped %s: %s", job.name, reason)
+        else:
+            logger.log(logging.INFO if status == 'ok' else logging.ERROR,
+                       "Finished %s: %s in %.1fs, cpu %.1fs, read %.1f MB, wrote %.1f MB",
+                       job.name, status, entry['seconds'],
+                       entry['user_seconds'] + entry['system_seconds'],
+                       entry['read_bytes'] / 1e6, entry['write_bytes'] / 1e6)
+
+        if self.history_path:
+            with open(self.history_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+        return status
+
+def read_history(path, hours=24):
+    """
+    History entries started in the last hours.
+    """
+    since = datetime.utcfromtimestamp(time.time() - hours * 3600).isoformat()
+    entries = []
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry['started'] >= since:
+                entries.append(entry)
+    return entries
+
+def print_history(entries):
+    totals = {}
+    for e in entries:
+        t = totals.setdefault(e['job'], {'runs': 0, 'failed': 0, 'skipped': 0, 'seconds': 0,
+                                         'read_bytes': 0, 'write_bytes': 0})
+        t['runs'] += 1
+        if e['status'] in ('failed', 'skipped'):
+            t[e['status']] += 1
+        for k in ('seconds', 'read_bytes', 'write_bytes'):
+            t[k] += e.get(k) or 0
+
+    print "%-16s %5s %7s %8s %10s %10s %10s" % ("job", "runs", "failed", "skipped", "seconds", "read MB", "write MB")
+    for name, t in sorted(totals.iteritems(), key=lambda i: i[1]['write_bytes'] + i[1]['read_bytes'], reverse=True):
+        print "%-16s %5d %7d %8d %10.0f %10.1f %10.1f" % (name, t['runs'], t['failed'], t['skipped'], t['seconds'],
+                                                          t['read_bytes'] / 1e6, t['write_bytes'] / 1e6)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=os.path.expanduser('~/scheduler.ini'))
+    subparsers = parser.add_subparsers(dest='action')
+
+    run_parser = subparsers.add_parser('run', help='Run jobs and the jobs they require')
+    run_parser.add_argument('jobs', nargs='+')
+
+    history_parser = subparsers.add_parser('history', help='Summarize recent runs per job')
+    history_parser.add_argument('--hours', type=int, default=24)
+
+    args = parser.parse_args()
+    settings, jobs = load_config(args.config)
+    history_path = settings.get('history')
+
+    if args.action == 'history':
+        if not history_path or not os.path.exists(history_path):
+            parser.error("No history recorded yet")
+        print_history(read_history(history_path, args.hours))
+    else:
+        scheduler = Scheduler(jobs, settings.get('lock_dir', os.path.expanduser('~/locks')), history_path)
+        statuses = scheduler.run(args.jobs)
+        sys.exit(1 if 'failed' in statuses.values() else 0)